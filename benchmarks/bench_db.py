@@ -0,0 +1,67 @@
+"""Compara guardar una página de resultados fila a fila (search_item + add_item) con
+el camino por lotes (search_items + save_items) sobre una base de datos en disco.
+
+Uso: python benchmarks/bench_db.py [--pages 50] [--page-size 40] [--journal-mode WAL]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dbhelper import DBHelper  # noqa: E402
+
+
+def pages(n_pages, page_size):
+    for p in range(n_pages):
+        yield [(p * page_size + i, 'item %d' % i, 100 + i, 'slug-%d' % i, 'u%d' % i) for i in range(page_size)]
+
+
+def per_row(db, n_pages, page_size, chat_id):
+    for page in pages(n_pages, page_size):
+        for item_id, title, price, slug, user in page:
+            if db.search_item(item_id, chat_id) is None:
+                db.add_item(item_id, chat_id, title, price, slug, user)
+
+
+def batched(db, n_pages, page_size, chat_id):
+    for page in pages(n_pages, page_size):
+        known = db.search_items([x[0] for x in page], chat_id)
+        new_items = [(item_id, chat_id, title, price, slug, user)
+                     for item_id, title, price, slug, user in page if str(item_id) not in known]
+        db.save_items(new_items, [])
+
+
+def run(fn, args, chat_id):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DBHelper(os.path.join(tmp, 'bench.sqlite'), journal_mode=args.journal_mode,
+                      synchronous=args.synchronous)
+        db.setup()
+        start = time.perf_counter()
+        fn(db, args.pages, args.page_size, chat_id)
+        elapsed = time.perf_counter() - start
+        db.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--page-size', type=int, default=40)
+    parser.add_argument('--journal-mode', default=None)
+    parser.add_argument('--synchronous', default=None)
+    args = parser.parse_args()
+
+    rows = args.pages * args.page_size
+    t_row = run(per_row, args, '1')
+    t_batch = run(batched, args, '1')
+    print('%-10s %10s %12s' % ('path', 'time (s)', 'rows/s'))
+    print('%-10s %10.3f %12.0f' % ('per-row', t_row, rows / t_row))
+    print('%-10s %10.3f %12.0f' % ('batched', t_batch, rows / t_batch))
+    print('speedup: %.1fx' % (t_row / t_batch))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Memoria por entrada de ItemCache y tiempo de decidir novedades con ella (o solo con el filtro de Bloom)
+frente a search_items.
+
+Uso: python benchmarks/bench_item_cache.py [--entries 1000000] [--lookups 200]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dbhelper import DBHelper  # noqa: E402
+from item_cache import ItemCache  # noqa: E402
+from bloom import RotatingBloomFilter  # noqa: E402
+
+CHATS = ['%d' % (100000000 + n) for n in range(50)]
+
+
+def item_id(n):
+    # Los ids de Wallapop son cadenas cortas como 'nz04g9jde4j5'
+    return 'nz%010x' % n
+
+
+def memory_per_entry(entries):
+    cache = ItemCache(None, maxsize=entries * 2)
+    now = time.time()
+    tracemalloc.start()
+    with cache._lock:
+        for n in range(entries):
+            cache._store(cache._key(item_id(n), CHATS[n % len(CHATS)]), cache._pack(10000 + n % 50000, now))
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current / entries
+
+
+def lookups(entries, n_lookups, page_size):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DBHelper(os.path.join(tmp, 'bench.sqlite'), journal_mode='WAL', synchronous='NORMAL')
+        db.setup()
+        rows = [(item_id(n), CHATS[n % len(CHATS)], 'item', 10000 + n, 'slug', 'u') for n in range(entries)]
+        for start in range(0, len(rows), 10000):
+            db.save_items(rows[start:start + 10000], [])
+        cache = ItemCache(db, maxsize=entries * 2)
+        cache.warm()
+
+        pages = []
+        for _ in range(n_lookups):
+            chat = random.randrange(len(CHATS))
+            # Media página ya vista, media nueva
+            seen = [item_id(n) for n in random.sample(range(chat, entries, len(CHATS)), page_size // 2)]
+            pages.append((CHATS[chat], seen + [item_id(entries + n) for n in range(page_size // 2)]))
+
+        start = time.perf_counter()
+        for chat_id, ids in pages:
+            db.search_items(ids, chat_id)
+        t_db = (time.perf_counter() - start) / n_lookups
+        start = time.perf_counter()
+        for chat_id, ids in pages:
+            cache.prices(ids, chat_id)
+        t_cache = (time.perf_counter() - start) / n_lookups
+
+        # Caché casi vacía: solo el filtro de Bloom evita ir a la db por los nuevos
+        bloom = ItemCache(db, maxsize=2, seen_filter=RotatingBloomFilter(os.path.join(tmp, 'seen.bloom'), entries))
+        bloom.rebuild_filter()
+        start = time.perf_counter()
+        for chat_id, ids in pages:
+            bloom.prices(ids, chat_id)
+        t_bloom = (time.perf_counter() - start) / n_lookups
+        bloom.seen_filter.close()
+        return t_db, t_cache, t_bloom
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=1000000)
+    parser.add_argument('--lookup-entries', type=int, default=200000)
+    parser.add_argument('--lookups', type=int, default=200)
+    parser.add_argument('--page-size', type=int, default=40)
+    args = parser.parse_args()
+
+    per_entry = memory_per_entry(args.entries)
+    print('%d entradas: %.0f bytes por entrada, %.0f MB por millón' % (args.entries, per_entry, per_entry))
+    t_db, t_cache, t_bloom = lookups(args.lookup_entries, args.lookups, args.page_size)
+    print('Página de %d items (%d en db): search_items %.3f ms, ItemCache %.3f ms (%.0fx), '
+          'solo filtro de Bloom (los ya vistos van a la db) %.3f ms' % (args.page_size, args.lookup_entries, t_db * 1000, t_cache * 1000,
+                                            t_db / t_cache, t_bloom * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Tiempos de MarketStats sobre una consulta con muchos precios en SQLite.
+
+Llena item_price con --rows items de una consulta repartidos en 90 días
+(precios log-normales con un 2% de atípicos y una tendencia a la baja) y
+mide: primera lectura de la db, cálculo del resumen, resumen ya calculado,
+una página de 40 precios nuevos (save_items, invalidate y percentil 25,
+como en process_items), 40 bajadas de items ya cargados y el percentil
+con la caché al día.
+
+Uso: python benchmarks/bench_market.py [--rows 100000] [--repeat 20]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dbhelper import DBHelper  # noqa: E402
+from price_stats import MarketStats  # noqa: E402
+
+KEY = '["iphone 13", null, null, null, 400, "newest"]'
+DAY = 24 * 60 * 60
+
+
+def price(rng, age_days):
+    if rng.random() < 0.02:
+        return rng.choice((100, 99999900))
+    # ~400 € hoy, un 0,1% más caro por cada día hacia atrás
+    return int(rng.lognormvariate(0, 0.25) * 40000 * (1 + age_days / 1000))
+
+
+def fill(db, rows, now, rng):
+    # Por días, del más viejo al más nuevo: cada save_items apunta su `now` como firstTs
+    per_day = rows // 90 + 1
+    for day in range(90, 0, -1):
+        batch = [('i%d-%d' % (day, n), KEY, price(rng, day)) for n in range(per_day)]
+        db.save_items([], [], now=now - day * DAY + rng.random(), prices=batch)
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    rng = random.Random(1)
+    now = time.time()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DBHelper(os.path.join(tmp, 'market.sqlite'))
+        db.setup()
+        fill(db, args.rows, now, rng)
+
+        def cold():
+            MarketStats(db).summary(KEY, now)
+
+        def load():
+            MarketStats._table(db.get_price_series(KEY))
+
+        market = MarketStats(db)
+        series = market._get(KEY, now)
+
+        def compute():
+            series.reset()
+            market.summary(KEY, now)
+
+        def distribute():
+            series.reset()
+            market.percentile(KEY, 25, now)
+
+        market.summary(KEY, now)
+        pages = iter(range(10 ** 9))
+
+        def page():
+            n = next(pages)
+            prices = [('p%d-%d' % (n, x), KEY, price(rng, 0)) for x in range(40)]
+            db.save_items([], [], now=now + n, prices=prices)
+            market.invalidate(KEY)
+            market.percentile(KEY, 25, now + n)
+
+        def drops():
+            # Bajadas de items ya cargados: la relectura no trae ninguna fila nueva
+            n = next(pages)
+            prices = [('i1-%d' % x, KEY, 30000 - n) for x in range(40)]
+            db.save_items([], [], now=now + n, prices=prices)
+            market.invalidate(KEY)
+            market.percentile(KEY, 25, now + n)
+
+        results = [
+            ('lectura de la db', timed(load, args.repeat)),
+            ('percentiles (numpy)', timed(distribute, args.repeat)),
+            ('+ tendencia (numpy)', timed(compute, args.repeat)),
+            ('primera petición', timed(cold, args.repeat)),
+            ('resumen en caché', timed(lambda: market.summary(KEY, now), args.repeat)),
+            ('página nueva + p25', timed(page, args.repeat)),
+            ('40 bajadas + p25', timed(drops, args.repeat)),
+            ('p25 en caché', timed(lambda: market.percentile(KEY, 25, now), args.repeat)),
+        ]
+        summary = market.summary(KEY, now)
+        db.close()
+
+    print('%d precios, %d atípicos, p25/p50/p75 %.0f/%.0f/%.0f €, tendencia %+.1f%% en 30 días' % (
+        summary['count'], summary['outliers'], summary['percentiles'][25] / 100, summary['percentiles'][50] / 100,
+        summary['percentiles'][75] / 100, summary.get('trend_30d', 0) * 100))
+    for name, ms in results:
+        print('%-22s %10.3f ms' % (name, ms))
+
+
+if __name__ == '__main__':
+    main()
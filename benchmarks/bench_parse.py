@@ -0,0 +1,121 @@
+"""Memoria y tiempo de leer una página de resultados: response.json() frente a SearchStream.
+
+Usa las respuestas grabadas por replay.py si las hay; si no, una página
+sintética con items del tamaño de los de Wallapop (descripción, imágenes,
+ubicación...). La memoria es el pico de tracemalloc mientras se lee la
+página y se guardan los items que cumplen la búsqueda.
+
+Uso: python benchmarks/bench_parse.py [--items 40] [--repeat 50] [--keep 0.25]
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from search_parser import CHUNK_SIZE, SearchItem, SearchStream  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def synthetic_item(i):
+    images = [{
+        'average_color': '#ae9d8b',
+        'urls': {size: 'https://cdn.wallapop.com/images/10420/abc/__/c10420p%d/i%d.jpg?pictureSize=W%s'
+                       % (i, n, size) for size in ('320', '640', '800', '1024')},
+    } for n in range(5)]
+    return {
+        'id': 'z%09dq' % i,
+        'user_id': 'u%07dx' % (i % 997),
+        'title': 'Producto de prueba %d en buen estado' % i,
+        'description': 'Se vende por no usar, funciona perfectamente y tiene todas sus piezas. ' * 5,
+        'category_id': 12800,
+        'price': {'amount': 100.0 + i, 'currency': 'EUR'},
+        'images': images,
+        'reserved': {'flag': False},
+        'location': {'latitude': 40.4, 'longitude': -3.7, 'postal_code': '28001', 'city': 'Madrid',
+                     'region': 'Comunidad de Madrid', 'region2': 'Madrid', 'country_code': 'ES'},
+        'shipping': {'item_is_shippable': True, 'user_allows_shipping': True, 'cost_configuration_id': None},
+        'favorited': {'flag': False},
+        'bump': {'type': 'none'},
+        'web_slug': 'producto-de-prueba-%d' % i,
+        'created_at': 1700000000000 + i,
+        'modified_at': 1700000000000 + i,
+        'taxonomy': [{'id': 12800, 'name': 'Informática', 'icon': 'pc'}],
+        'is_favoriteable': {'flag': True},
+        'is_refurbished': {'flag': False},
+        'is_top_profile': {'flag': i % 10 == 0},
+        'has_warranty': {'flag': False},
+        'has_stock': {'flag': True},
+    }
+
+
+def pages(n_items):
+    paths = sorted(glob.glob(os.path.join(FIXTURES, 'search-*.json')))
+    if paths:
+        for path in paths:
+            with open(path, 'rb') as f:
+                yield os.path.basename(path), f.read()
+    else:
+        body = {'data': {'section': {'payload': {'items': [synthetic_item(i) for i in range(n_items)]}}},
+                'meta': {'next_page': 'eyJwYWdlIjogMn0='}}
+        yield 'sintética', json.dumps(body).encode()
+
+
+def chunks(raw):
+    # Lo que devolvería iter_content: el cuerpo va llegando por trozos
+    for start in range(0, len(raw), CHUNK_SIZE):
+        yield raw[start:start + CHUNK_SIZE]
+
+
+def read_json(raw, keep):
+    body = b''.join(chunks(raw))
+    data = json.loads(body)
+    items = data.get('data', {}).get('section', {}).get('payload', {}).get('items', [])
+    return [x for n, x in enumerate(items) if n % keep == 0], data.get('meta', {}).get('next_page')
+
+
+def read_stream(raw, keep):
+    page = SearchStream(chunks(raw))
+    with page:
+        matched = [x for n, x in enumerate(page) if n % keep == 0]
+    return matched, page.next_page
+
+
+def measure(fn, raw, keep, repeat):
+    tracemalloc.start()
+    fn(raw, keep)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(raw, keep)
+    return peak, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=40, help='Items de la página sintética')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--keep', type=float, default=0.25, help='Fracción de items que cumplen la búsqueda')
+    args = parser.parse_args()
+    keep = max(1, round(1 / args.keep)) if args.keep else 10 ** 9
+
+    print('%-20s %8s %14s %14s %12s %12s' % ('página', 'KB', 'json() pico KB', 'stream pico KB',
+                                             'json() ms', 'stream ms'))
+    for name, raw in pages(args.items):
+        old, new = read_json(raw, keep), read_stream(raw, keep)
+        assert [x['id'] for x in old[0]] == [x.id for x in new[0]] and old[1] == new[1]
+        peak_json, t_json = measure(read_json, raw, keep, args.repeat)
+        peak_stream, t_stream = measure(read_stream, raw, keep, args.repeat)
+        print('%-20s %8.0f %14.0f %14.0f %12.2f %12.2f' % (name[:20], len(raw) / 1024, peak_json / 1024,
+                                                           peak_stream / 1024, t_json * 1000, t_stream * 1000))
+    print('Tamaño de un SearchItem: %d bytes más sus cadenas' % sys.getsizeof(SearchItem(0, '', 0, '', '')))
+
+
+if __name__ == '__main__':
+    main()
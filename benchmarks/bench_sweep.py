@@ -0,0 +1,61 @@
+"""Tiempo de un barrido completo, en serie y con SearchExecutor, contra un servidor local.
+
+Uso: python benchmarks/bench_sweep.py [--latency 0.05] [--workers 8] [--per-host 8]
+"""
+import argparse
+import os
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from executor import SearchExecutor  # noqa: E402
+from stub_server import StubServer  # noqa: E402
+
+
+def fetch(executor, url):
+    if executor is None:
+        with urllib.request.urlopen(url) as r:
+            r.read()
+        return
+    with executor.host_slot(url):
+        with urllib.request.urlopen(url) as r:
+            r.read()
+
+
+def sweep(base_url, n, executor):
+    urls = ['%s/api/v3/search?keywords=item+%d&time_filter=today' % (base_url, i) for i in range(n)]
+    start = time.perf_counter()
+    if executor is None:
+        for u in urls:
+            fetch(None, u)
+    else:
+        executor.run(fetch, [(executor, u) for u in urls])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--per-host', type=int, default=8)
+    parser.add_argument('--sizes', default='10,100,1000')
+    parser.add_argument('--skip-serial-above', type=int, default=100)
+    args = parser.parse_args()
+
+    with StubServer(latency=args.latency) as server:
+        executor = SearchExecutor(max_workers=args.workers, per_host=args.per_host)
+        print('%8s %12s %12s %8s' % ('searches', 'serial (s)', 'pool (s)', 'speedup'))
+        for n in [int(x) for x in args.sizes.split(',')]:
+            pooled = sweep(server.base_url, n, executor)
+            if n <= args.skip_serial_above:
+                serial = sweep(server.base_url, n, None)
+                print('%8d %12.2f %12.2f %7.1fx' % (n, serial, pooled, serial / pooled))
+            else:
+                print('%8d %12s %12.2f %8s' % (n, '-', pooled, '-'))
+        executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
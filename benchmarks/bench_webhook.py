@@ -0,0 +1,145 @@
+"""Actualizaciones por segundo que atienden los handlers del bot en modo webhook.
+
+Levanta WebhookServer con el bot de ssbo (db temporal, API de Telegram
+imitada por stub_server con la latencia que se pida) y le hace POST de
+actualizaciones sintéticas (/start, /add, /lis y texto del asistente) con
+``--concurrency`` conexiones a la vez, como hace Telegram con
+``max_connections``. Para cada número de workers da actualizaciones/s, la
+latencia de la respuesta HTTP y la de los handlers. Antes comprueba que
+sin el secreto correcto el servidor responde 401.
+
+Uso: python benchmarks/bench_webhook.py [--updates 2000] [--workers 1,8,32] [--latency 0.05]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from stub_server import StubServer  # noqa: E402
+
+SECRET = 'bench-secret'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def synthetic_update(n, chats):
+    chat_id = 2000 + n % chats
+    text = ('/start', '/add bench %d,10-100' % n, '/lis', 'texto libre %d' % n)[n % 4]
+    message = {
+        'message_id': n, 'date': int(time.time()), 'text': text,
+        'chat': {'id': chat_id, 'type': 'private', 'username': 'bench'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench', 'username': 'bench'},
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return json.dumps({'update_id': n, 'message': message})
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+async def post_all(session, url, bodies, concurrency):
+    latencies = []
+    queue = asyncio.Queue()
+    for body in bodies:
+        queue.put_nowait(body)
+
+    async def client():
+        while not queue.empty():
+            body = queue.get_nowait()
+            start = time.perf_counter()
+            async with session.post(url, data=body, headers={'Content-Type': 'application/json',
+                                                              'X-Telegram-Bot-Api-Secret-Token': SECRET}) as resp:
+                await resp.read()
+                assert resp.status == 200, resp.status
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies
+
+
+async def bench(ssbo, args, workers, first_id):
+    import aiohttp
+    from webhook import UPDATE_LATENCY, WebhookServer
+
+    port = free_port()
+    url = 'http://127.0.0.1:%d/telegram' % port
+    server = WebhookServer(ssbo.bot, url, SECRET, host='127.0.0.1', port=port, workers=workers,
+                           queue_size=args.queue_size)
+    await server.start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, data='{}', headers={'X-Telegram-Bot-Api-Secret-Token': 'otro'}) as resp:
+                assert resp.status == 401, 'Sin el secreto correcto debería ser 401, es %d' % resp.status
+
+            bodies = [synthetic_update(first_id + n, args.chats) for n in range(args.updates)]
+            count0, total0 = UPDATE_LATENCY.summary()
+            start = time.perf_counter()
+            latencies = await post_all(session, url, bodies, args.concurrency)
+            await server.join()
+            elapsed = time.perf_counter() - start
+            count, total = UPDATE_LATENCY.summary()
+    finally:
+        await server.stop()
+    stats = server.stats()
+    return {
+        'workers': workers, 'updates': args.updates, 'seconds': elapsed, 'updates_per_s': args.updates / elapsed,
+        'post_p50_ms': percentile(latencies, 0.5) * 1000, 'post_p99_ms': percentile(latencies, 0.99) * 1000,
+        'handler_avg_ms': (total - total0) / (count - count0) * 1000 if count > count0 else 0.0,
+        'failed': stats['failed'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--workers', default='1,8,32', help='Tamaños del pool de workers a probar')
+    parser.add_argument('--concurrency', type=int, default=40, help='POST simultáneos (max_connections)')
+    parser.add_argument('--queue-size', type=int, default=100)
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05, help='Latencia simulada de la API de Telegram')
+    parser.add_argument('--json', help='Añade los resultados en formato JSON a este fichero')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='wallbot-webhook-')
+    os.environ.update({'PROFILE': 'bench', 'DB_DIR': tmp, 'LOG_DIR': tmp, 'BOT_TOKEN': '0:bench',
+                       'METRICS_PORT': '0', 'BLOOM_CAPACITY': '0'})
+    import ssbo
+    from telebot import asyncio_helper
+
+    with StubServer(latency=args.latency) as stub:
+        asyncio_helper.API_URL = stub.base_url + '/bot{0}/{1}'
+        ssbo.db.setup()
+        print('%8s %8s %8s %10s %12s %12s %14s %7s' % ('workers', 'updates', 'time(s)', 'updates/s',
+                                                      'POST p50 ms', 'POST p99 ms', 'handler avg ms', 'errors'))
+
+        async def run_all():
+            for n, workers in enumerate(int(x) for x in args.workers.split(',')):
+                result = await bench(ssbo, args, workers, n * args.updates)
+                print('%8d %8d %8.2f %10.0f %12.2f %12.2f %14.2f %7d' % (
+                    workers, result['updates'], result['seconds'], result['updates_per_s'], result['post_p50_ms'],
+                    result['post_p99_ms'], result['handler_avg_ms'], result['failed']))
+                if args.json:
+                    with open(args.json, 'a') as f:
+                        f.write(json.dumps(result) + '\n')
+            await ssbo.bot.close_session()
+
+        asyncio.run(run_all())
+    print('Telegram imitado con %.0f ms de latencia; db en %s' % (args.latency * 1000, tmp))
+    ssbo.executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
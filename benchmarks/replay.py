@@ -0,0 +1,221 @@
+"""Reproduce el pipeline completo del bot sin red: búsqueda -> filtrado -> db -> avisos.
+
+``record`` guarda respuestas reales de Wallapop (búsqueda y valoraciones) en
+``benchmarks/fixtures/``. ``run`` las sirve desde el servidor local, apunta
+``URL_ITEMS``, las valoraciones y Telegram a él y lanza, igual que un barrido
+de ``wallapop()``, una consulta por búsqueda con ``run_query``. Sin fixtures
+usa items sintéticos.
+
+Uso:
+    python benchmarks/replay.py record "iphone 13" "ps5" --pages 2 --reviews 20
+    python benchmarks/replay.py run --sizes 10,100,1000,10000 [--items 20] [--json resultados.jsonl]
+"""
+import argparse
+import glob
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from stub_server import StubServer, fake_items  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+WALLAPOP_SEARCH = 'https://api.wallapop.com/api/v3/search?source=search_box'
+WALLAPOP_USERS = 'https://api.wallapop.com/api/v3/users/'
+
+
+def record(args):
+    import requests
+    from urllib.parse import quote
+    from http_client import WALLAPOP_HEADERS, DEFAULT_USER_AGENT
+
+    os.makedirs(FIXTURES, exist_ok=True)
+    session = requests.Session()
+    session.headers.update(WALLAPOP_HEADERS)
+    session.headers['User-Agent'] = DEFAULT_USER_AGENT
+    users = []
+    for n, kws in enumerate(args.keywords):
+        url = WALLAPOP_SEARCH + '&keywords=' + quote(kws) + '&order_by=newest'
+        for page in range(args.pages):
+            response = session.get(url, timeout=15)
+            response.raise_for_status()
+            data = response.json()
+            path = os.path.join(FIXTURES, 'search-%d-%d.json' % (n, page))
+            with open(path, 'w') as f:
+                json.dump(data, f)
+            items = data.get('data', {}).get('section', {}).get('payload', {}).get('items', [])
+            print('%s: %d items' % (path, len(items)))
+            users.extend(x['user_id'] for x in items if x.get('user_id') not in users)
+            next_page = data.get('meta', {}).get('next_page')
+            if not next_page:
+                break
+            url = WALLAPOP_SEARCH + '&next_page=' + quote(next_page)
+
+    for user_id in users[:args.reviews]:
+        response = session.get(WALLAPOP_USERS + '%s/reviews' % user_id, timeout=15)
+        if response.status_code != 200:
+            print('%s: %s' % (user_id, response.status_code))
+            continue
+        with open(os.path.join(FIXTURES, 'reviews-%s.json' % user_id), 'w') as f:
+            json.dump(response.json(), f)
+    print('Guardadas valoraciones de %d vendedores' % min(len(users), args.reviews))
+
+
+def load_fixtures():
+    """Items de todas las búsquedas grabadas y valoraciones por vendedor"""
+    items = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, 'search-*.json'))):
+        with open(path) as f:
+            data = json.load(f)
+        items.extend(data.get('data', {}).get('section', {}).get('payload', {}).get('items', []))
+    reviews = {}
+    for path in glob.glob(os.path.join(FIXTURES, 'reviews-*.json')):
+        with open(path) as f:
+            reviews[os.path.basename(path)[len('reviews-'):-len('.json')]] = json.load(f)
+    return items, reviews
+
+
+class Workload:
+    """Respuestas de la búsqueda n: ``items`` items de las fixtures con ids únicos y las kws en el título"""
+
+    def __init__(self, recorded, per_search):
+        self.recorded = recorded or fake_items('producto', 200)
+        self.per_search = per_search
+        self.searches = {}
+        self.next_id = 10 ** 9
+
+    def add(self, kws):
+        base = self.next_id
+        self.next_id += self.per_search
+        self.searches[kws] = base
+
+    def items_for(self, kws, next_page):
+        base = self.searches.get(kws)
+        if base is None:
+            return [], None
+        items = []
+        for i in range(self.per_search):
+            x = dict(self.recorded[(base + i) % len(self.recorded)])
+            x['id'] = base + i
+            x['title'] = '%s %s' % (kws, x.get('title', ''))
+            # Más nuevo primero, como con order_by=newest
+            x['created_at'] = base + self.per_search - i
+            x.setdefault('web_slug', 'item-%d' % x['id'])
+            x.setdefault('price', {'amount': 100, 'currency': 'EUR'})
+            items.append(x)
+        return items, None
+
+
+def run(args):
+    tmp = tempfile.mkdtemp(prefix='wallbot-replay-')
+    # Configuración antes de importar ssbo: db temporal y sin límites que midan otra cosa
+    os.environ.update({
+        'PROFILE': 'replay', 'DB_DIR': tmp, 'LOG_DIR': tmp, 'BOT_TOKEN': '0:replay', 'METRICS_PORT': '0',
+        'SEARCH_WORKERS': str(args.workers), 'HOST_CONCURRENCY': str(args.workers),
+        'WALLAPOP_RATE': '1000000', 'WALLAPOP_BURST': '1000000', 'BREAKER_THRESHOLD': '1000000',
+        'TELEGRAM_GLOBAL_RATE': '1000000', 'TELEGRAM_CHAT_RATE': '1000000',
+        'NOTIFY_WORKERS': str(args.notify_workers),
+    })
+    import ssbo
+    from dbhelper import ChatSearch, DB_LATENCY
+    from http_client import HTTP_LATENCY
+    from notifier import NOTIFY_LATENCY
+    from matcher import compile_matcher
+
+    recorded, reviews = load_fixtures()
+    if not recorded:
+        print('Sin fixtures en %s: se usan items sintéticos' % FIXTURES)
+    workload = Workload(recorded, args.items)
+    stages = [
+        ('search', lambda: HTTP_LATENCY.summary(endpoint='search')),
+        ('reviews', lambda: HTTP_LATENCY.summary(endpoint='reviews')),
+        ('telegram', lambda: HTTP_LATENCY.summary(endpoint='telegram')),
+        ('search_items', lambda: DB_LATENCY.summary(op='search_items')),
+        ('save_items', lambda: DB_LATENCY.summary(op='save_items')),
+        ('add_outbox', lambda: DB_LATENCY.summary(op='add_outbox')),
+        ('query', ssbo.SWEEP_DURATION.summary),
+        ('notify', NOTIFY_LATENCY.summary),
+    ]
+
+    with StubServer(latency=args.latency, items_for=workload.items_for,
+                    reviews_for=lambda user_id: reviews.get(user_id, [{'review': {'scoring': 80}}])) as server:
+        ssbo.URL_ITEMS = server.base_url + '/api/v3/search?source=search_box'
+        ssbo.URL_WALLAPOP_API = server.base_url + '/api/v3'
+        ssbo.notifier.url = server.base_url + '/bot0:replay/sendMessage'
+        ssbo.db.setup()
+        ssbo.item_cache.warm()
+        ssbo.notifier.start()
+
+        print('%8s %8s %8s %9s %10s %s %8s' % ('searches', 'items', 'time(s)', 'items/s', 'searches/s',
+                                             ' '.join('%12s' % name for name, _ in stages), 'RSS(MB)'))
+        for size, n in enumerate(int(x) for x in args.sizes.split(',')):
+            # Búsquedas nuevas en cada tamaño para que todo sea novedad
+            for i in range(n):
+                kws = 'replay%d x%d' % (size, i)
+                workload.add(kws)
+                ssbo.db.add_search(ChatSearch(chat_id=str(1000 + i % args.chats), kws=kws, orde='newest',
+                                              username='replay', active=1))
+            groups = {k: g for k, g in ssbo.group_searches(ssbo.db.get_chats_searchs()).items()
+                      if g[0].kws.startswith('replay%d ' % size)}
+            ssbo.scheduler.sync(groups.keys())
+            matcher = compile_matcher(frozenset(kws for _, _, _, variants in groups.values() for kws in variants))
+            before = [fn() for _, fn in stages]
+
+            start = time.perf_counter()
+            ssbo.executor.run(ssbo.run_query, [(key, search, chat_ids, matcher, limits, variants)
+                                               for key, (search, chat_ids, limits, variants) in groups.items()])
+            # El barrido acaba cuando Telegram ha aceptado todos los avisos
+            while ssbo.db.get_outbox():
+                time.sleep(0.05)
+            elapsed = time.perf_counter() - start
+
+            items = n * args.items
+            result = {'searches': n, 'items': items, 'seconds': elapsed,
+                      'items_per_s': items / elapsed, 'searches_per_s': n / elapsed,
+                      'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+            cells = []
+            for (name, fn), (count0, total0) in zip(stages, before):
+                count, total = fn()
+                mean_ms = (total - total0) / (count - count0) * 1000 if count > count0 else 0.0
+                result[name + '_ms'] = mean_ms
+                cells.append('%12.2f' % mean_ms)
+            print('%8d %8d %8.2f %9.0f %10.1f %s %8.1f' % (n, items, elapsed, result['items_per_s'],
+                                                        result['searches_per_s'], ' '.join(cells),
+                                                        result['peak_rss_mb']))
+            if args.json:
+                with open(args.json, 'a') as f:
+                    f.write(json.dumps(result) + '\n')
+
+        print('Latencias: media en ms por llamada; db en %s' % tmp)
+        ssbo.executor.shutdown()
+        ssbo.notifier.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    rec = sub.add_parser('record', help='Graba respuestas reales de Wallapop en fixtures/')
+    rec.add_argument('keywords', nargs='+')
+    rec.add_argument('--pages', type=int, default=1)
+    rec.add_argument('--reviews', type=int, default=20, help='Vendedores de los que guardar valoraciones')
+    rep = sub.add_parser('run', help='Reproduce las fixtures contra el servidor local')
+    rep.add_argument('--sizes', default='10,100,1000')
+    rep.add_argument('--items', type=int, default=20, help='Items por búsqueda')
+    rep.add_argument('--chats', type=int, default=100, help='Chats entre los que se reparten las búsquedas')
+    rep.add_argument('--latency', type=float, default=0.0, help='Latencia simulada por petición (s)')
+    rep.add_argument('--workers', type=int, default=8)
+    rep.add_argument('--notify-workers', type=int, default=4)
+    rep.add_argument('--json', help='Añade los resultados (una línea por tamaño) a este fichero')
+    args = parser.parse_args()
+    if args.command == 'record':
+        record(args)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Lectores y escritores a la vez sobre DBHelper.
+
+Primero solo lectores (get_chat_searchs y search_items, como el bot y el
+filtro de novedades) y luego los mismos lectores con escritores guardando
+páginas con save_items y avisos en la outbox, como varios barridos en
+paralelo. Da lecturas/s y su latencia en las dos fases, escrituras/s,
+cuántas escrituras han ido en cada commit y los errores ("database is
+locked" y similares, que DBHelper imprime). Al final comprueba que están
+todos los items y avisos escritos.
+
+Los lectores no paran entre lectura y lectura, así que con muchos compiten
+por el GIL con los escritores: las páginas/s bajan aunque la db no esté
+ocupada. Con --reader-pause se parecen más al bot, que entre consulta y
+consulta espera a la red.
+
+Mide rendimiento; que no se pierda ninguna escritura con lectores y
+escritores a la vez lo prueba tests/test_storage.py en los dos almacenamientos.
+
+Uso: python benchmarks/stress_db.py [--readers 8] [--writers 4] [--seconds 5]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dbhelper import ChatSearch, DBHelper  # noqa: E402
+
+CHATS = ['%d' % (100000000 + n) for n in range(20)]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def reader(db, stop, latencies, page_size, pause):
+    n = 0
+    while not stop.wait(pause):
+        chat = CHATS[n % len(CHATS)]
+        start = time.perf_counter()
+        db.get_chat_searchs(chat)
+        db.search_items(['seed-%d' % x for x in range(n % 500, n % 500 + page_size)], chat)
+        latencies.append(time.perf_counter() - start)
+        n += 1
+
+
+def writer(db, stop, number, page_size, written, errors):
+    page = 0
+    while not stop.is_set():
+        chat = CHATS[page % len(CHATS)]
+        rows = [('w%d-%d' % (number, page * page_size + x), chat, 'item', 1000 + x, 'slug', 'u')
+                for x in range(page_size)]
+        if db.save_items(rows, []) is None:
+            errors.append('save_items')
+        else:
+            written['items'] += page_size
+        if db.add_outbox(chat, 'aviso %d' % page, time.time()) is None:
+            errors.append('add_outbox')
+        else:
+            written['outbox'] += 1
+        page += 1
+
+
+def phase(db, args, writers):
+    stop = threading.Event()
+    latencies = [[] for _ in range(args.readers)]
+    written = [{'items': 0, 'outbox': 0} for _ in range(writers)]
+    errors = []
+    threads = [threading.Thread(target=reader, args=(db, stop, latencies[n], args.page_size, args.reader_pause))
+               for n in range(args.readers)]
+    threads += [threading.Thread(target=writer, args=(db, stop, n, args.page_size, written[n], errors))
+                for n in range(writers)]
+    writes0, commits0 = db.writes, db.commits
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    reads = [x for chunk in latencies for x in chunk]
+    return {
+        'reads_per_s': len(reads) / elapsed,
+        'read_p50_ms': percentile(reads, 0.5) * 1000,
+        'read_p99_ms': percentile(reads, 0.99) * 1000,
+        'read_max_ms': max(reads, default=0) * 1000,
+        'pages_per_s': sum(w['outbox'] for w in written) / elapsed,
+        'writes': db.writes - writes0,
+        'commits': db.commits - commits0,
+        'items': sum(w['items'] for w in written),
+        'outbox': sum(w['outbox'] for w in written),
+        'errors': len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--page-size', type=int, default=40)
+    parser.add_argument('--reader-pause', type=float, default=0, help='Segundos de espera entre lecturas')
+    parser.add_argument('--journal-mode', default='WAL')
+    parser.add_argument('--synchronous', default='NORMAL')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DBHelper(os.path.join(tmp, 'stress.sqlite'), journal_mode=args.journal_mode,
+                      synchronous=args.synchronous, busy_timeout=5000)
+        db.setup()
+        for n, chat in enumerate(CHATS):
+            db.add_search(ChatSearch(chat_id=chat, kws='busqueda %d' % n, active=1))
+        db.save_items([('seed-%d' % x, chat, 'item', 1000, 'slug', 'u') for chat in CHATS for x in range(500)], [])
+        base = db.count_items()
+
+        printed = io.StringIO()
+        with contextlib.redirect_stdout(printed):
+            idle = phase(db, args, 0)
+            busy = phase(db, args, args.writers)
+        db_errors = [line for line in printed.getvalue().splitlines() if line.strip()]
+
+        print('%-22s %10s %10s %10s %10s %10s %10s' % ('', 'lecturas/s', 'p50 ms', 'p99 ms', 'max ms',
+                                                      'páginas/s', 'por commit'))
+        for name, r in (('%d lectores' % args.readers, idle),
+                        ('+ %d escritores' % args.writers, busy)):
+            print('%-22s %10.0f %10.2f %10.2f %10.2f %10.0f %10.1f' % (
+                name, r['reads_per_s'], r['read_p50_ms'], r['read_p99_ms'], r['read_max_ms'], r['pages_per_s'],
+                r['writes'] / r['commits'] if r['commits'] else 0))
+
+        missing_items = base + busy['items'] - db.count_items()
+        missing_outbox = busy['outbox'] - len(db.get_outbox())
+        print('Errores de la db: %d (%s); escrituras fallidas: %d; items que faltan: %d; avisos que faltan: %d' % (
+            len(db_errors), '; '.join(sorted(set(db_errors)))[:200] or '-', busy['errors'], missing_items,
+            missing_outbox))
+        db.close()
+    ok = not db_errors and not busy['errors'] and not missing_items and not missing_outbox
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Servidor local que imita las APIs de Wallapop y Telegram para los benchmarks"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+def fake_items(keywords, n=40, base_id=0):
+    return [{
+        'id': base_id + i,
+        'title': '%s %d' % (keywords, i),
+        'price': {'amount': 100 + i, 'currency': 'EUR'},
+        'web_slug': 'item-%d' % (base_id + i),
+        'user_id': 'u%d' % ((base_id + i) % 97),
+        'is_top_profile': {'flag': False},
+    } for i in range(n)]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Cabeceras y cuerpo van en dos escrituras; con Nagle cada respuesta tardaría ~40 ms de más
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send_json(self, status, body):
+        raw = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_GET(self):
+        server = self.server
+        # Con keep-alive hay que leer el cuerpo aunque no se use (los clientes async mandan form data)
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        time.sleep(server.latency)
+        with server.lock:
+            server.hits += 1
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        if parts.path.endswith('/reviews'):
+            user_id = parts.path.rstrip('/').split('/')[-2]
+            reviews = server.reviews_for(user_id) if server.reviews_for else [{'review': {'scoring': 100}}]
+            self._send_json(200, reviews)
+        elif parts.path.endswith('/search'):
+            kws = query.get('keywords', [''])[0].replace('+', ' ')
+            if server.items_for:
+                # items_for(keywords, next_page) -> (items, siguiente next_page o None)
+                items, next_page = server.items_for(kws, query.get('next_page', [None])[0])
+            else:
+                items, next_page = fake_items(kws, server.items_per_page), None
+            meta = {'next_page': next_page} if next_page else {}
+            self._send_json(200, {'data': {'section': {'payload': {'items': items}}}, 'meta': meta})
+        elif parts.path.endswith('/getMe'):
+            self._send_json(200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'stub',
+                                                         'username': 'stub'}})
+        elif parts.path.endswith('/getUpdates'):
+            # Long polling sin actualizaciones: Telegram se queda esperando antes de responder
+            time.sleep(1)
+            self._send_json(200, {'ok': True, 'result': []})
+        else:
+            # sendMessage y cualquier otra llamada a Telegram: un Message mínimo, que es lo que espera telebot
+            self._send_json(200, {'ok': True, 'result': {'message_id': 1, 'date': 0,
+                                                         'chat': {'id': 0, 'type': 'private'}}})
+
+    def do_POST(self):
+        self.do_GET()
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.05, items_per_page=40, items_for=None, reviews_for=None):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.items_per_page = items_per_page
+        self.items_for = items_for
+        self.reviews_for = reviews_for
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
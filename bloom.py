@@ -0,0 +1,184 @@
+"""Filtro de Bloom en un fichero mapeado en memoria (mmap).
+
+Guarda hashes de 64 bits (``dbhelper.pair_hash``) de los items que ya
+conoce cada chat. Si dice que no está, seguro que no está y no hace falta
+mirar en la db; si dice que sí, puede ser un falso positivo. Al estar en un
+fichero con mmap, arrancar no necesita leer ni cargar nada: el sistema trae
+las páginas según se usan.
+
+No admite borrados y la tasa de falsos positivos sube según se llena, así
+que ``RotatingBloomFilter`` lo rehace desde la db en un fichero nuevo, más
+grande si hace falta, y lo cambia por el viejo sin perder lo añadido
+mientras tanto.
+"""
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+
+MAGIC = b'WBBF'
+VERSION = 1
+# magic, versión, k, bits, elementos añadidos, capacidad
+HEADER = struct.Struct('<4sIIQQQ')
+HEADER_SIZE = 64
+MASK64 = (1 << 64) - 1
+
+
+class BloomFilter:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'r+b')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0)
+        except Exception:
+            self._file.close()
+            raise
+        magic, version, self.k, self.bits, self.count, self.capacity = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION or len(self._mm) < HEADER_SIZE + (self.bits + 7) // 8:
+            self.close()
+            raise ValueError('%s no es un filtro de Bloom válido' % path)
+
+    @classmethod
+    def create(cls, path, capacity, error_rate=0.01):
+        """Fichero nuevo (vacío) dimensionado para `capacity` elementos con esa tasa de falsos positivos"""
+        capacity = max(int(capacity), 1)
+        bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 64)
+        k = max(int(round(bits / capacity * math.log(2))), 1)
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, k, bits, 0, capacity).ljust(HEADER_SIZE, b'\0'))
+            f.truncate(HEADER_SIZE + (bits + 7) // 8)
+        return cls(path)
+
+    def _positions(self, h):
+        h &= MASK64
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+        bits = self.bits
+        return [(h1 + i * h2) % bits for i in range(self.k)]
+
+    def add(self, h):
+        mm = self._mm
+        new = False
+        for pos in self._positions(h):
+            byte = HEADER_SIZE + (pos >> 3)
+            mask = 1 << (pos & 7)
+            if not mm[byte] & mask:
+                mm[byte] |= mask
+                new = True
+        if new:
+            self.count += 1
+            HEADER.pack_into(mm, 0, MAGIC, VERSION, self.k, self.bits, self.count, self.capacity)
+
+    def __contains__(self, h):
+        # Lo normal es preguntar por items nuevos: se sale en cuanto falta un bit
+        mm = self._mm
+        h &= MASK64
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+        bits = self.bits
+        for i in range(self.k):
+            pos = (h1 + i * h2) % bits
+            if not mm[HEADER_SIZE + (pos >> 3)] & (1 << (pos & 7)):
+                return False
+        return True
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    def flush(self):
+        self._mm.flush()
+
+    def close(self):
+        try:
+            self._mm.close()
+        finally:
+            self._file.close()
+
+
+class RotatingBloomFilter:
+    """BloomFilter que se rehace entero cuando se llena.
+
+    Hasta que hay un filtro válido (primer arranque, fichero roto)
+    ``might_contain`` responde siempre que sí, para que se consulte la db.
+    """
+
+    def __init__(self, path, capacity, error_rate=0.01):
+        self.path = path
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rebuilds = 0
+        self._filter = None
+        self._pending = None
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                self._filter = BloomFilter(path)
+            except Exception as e:
+                logging.warning("Filtro de Bloom %s descartado: %s", path, e)
+
+    @property
+    def ready(self):
+        return self._filter is not None
+
+    @property
+    def needs_rebuild(self):
+        return self._filter is None or self._filter.full
+
+    def might_contain(self, h):
+        with self._lock:
+            return self._filter is None or h in self._filter
+
+    def add(self, h):
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(h)
+            if self._pending is not None:
+                self._pending.append(h)
+
+    def rebuild(self, hashes, count):
+        """Crea un filtro nuevo con `hashes` (iterable de los `count` elementos que hay ahora) y lo cambia por el actual"""
+        capacity = max(self.capacity, 2 * count)
+        tmp = self.path + '.tmp'
+        with self._lock:
+            self._pending = []
+        try:
+            new = BloomFilter.create(tmp, capacity, self.error_rate)
+            for h in hashes:
+                new.add(h)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            # Lo que se ha añadido mientras se leía la db
+            for h in self._pending:
+                new.add(h)
+            self._pending = None
+            new.flush()
+            os.replace(tmp, self.path)
+            new.path = self.path
+            old, self._filter = self._filter, new
+            self.rebuilds += 1
+        if old is not None:
+            old.close()
+
+    def stats(self):
+        with self._lock:
+            f = self._filter
+            return {
+                'ready': int(f is not None),
+                'count': f.count if f else 0,
+                'capacity': f.capacity if f else 0,
+                'size_bytes': HEADER_SIZE + (f.bits + 7) // 8 if f else 0,
+                'rebuilds': self.rebuilds,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._filter is not None:
+                self._filter.flush()
+                self._filter.close()
+                self._filter = None
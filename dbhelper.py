@@ -1,11 +1,65 @@
+import functools
+import hashlib
+import queue
 import sqlite3
+import threading
 import time
+from concurrent.futures import Future
+from decimal import Decimal
+
+import migrations
+from metrics import Histogram
+from storage import SEARCH_COLUMNS, Storage, search_row
+from tracing import TRACER
+
+DB_LATENCY = Histogram('wallbot_db_seconds', 'Duración de las operaciones de DBHelper', ('op', ),
+                       buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+
+
+def timed(fn):
+    """Mide la duración del método en la métrica wallbot_db_seconds{op=<nombre>} y en las trazas"""
+    span_name = 'db.' + fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with DB_LATENCY.time(op=fn.__name__), TRACER.span(span_name):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def to_cents(amount):
+    """Precio en euros (número o texto) a céntimos enteros"""
+    return int((Decimal(str(amount)) * 100).to_integral_value())
+
+
+def pair_hash(item_id, chat_id):
+    """Hash estable de 64 bits de (item, chat); no cambia entre ejecuciones como hash()"""
+    digest = hashlib.blake2b(('%s:%s' % (chat_id, item_id)).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+# Primer punto del item o cambio de precio; si el precio es el mismo no actualiza nada (rowcount 0)
+STMT_ITEM_PRICE = "insert into item_price (itemId, queryKey, firstCents, firstTs, minCents, lastCents, lastTs) " \
+                  "values (?, ?, ?, ?, ?, ?, ?) " \
+                  "on conflict (itemId) do update set minCents = min(minCents, excluded.lastCents), " \
+                  "lastCents = excluded.lastCents, lastTs = excluded.lastTs, changes = changes + 1 " \
+                  "where lastCents != excluded.lastCents"
+
+
+def _as_text(value):
+    # Los filtros numéricos de chat_search se devuelven como texto, igual que se introdujeron
+    if value is None or isinstance(value, str):
+        return value
+    if float(value).is_integer():
+        return str(int(value))
+    return str(value)
 
 
 class ChatSearch:
 
     def __init__(self, chat_id=None, kws=None, cat_ids=None, min_price=None, max_price=None,
-                 dist=None, publish_date=None, orde=None, username=None, name=None, active=None):
+                 dist=None, publish_date=None, orde=None, username=None, name=None, active=None,
+                 max_percentile=None):
         self.chat_id = chat_id
         self.kws = kws
         self.cat_ids = cat_ids
@@ -17,12 +71,25 @@ class ChatSearch:
         self.username = username
         self.name = name
         self.active = active
+        # Solo avisa de precios por debajo de este percentil de la consulta (None: de todos)
+        self.max_percentile = max_percentile
 
     def __str__(self) -> str:
         return "<ChatSearch chat_id:%s kws:%s cat_ids:%s min_price:%s max_price:%s " \
-               "dist:%s publish_date:%s orde:%s username:%s name:%s active:%s>" % \
+               "dist:%s publish_date:%s orde:%s username:%s name:%s active:%s max_percentile:%s>" % \
                (self.chat_id, self.kws, self.cat_ids, self.min_price, self.max_price,
-                self.dist, self.publish_date, self.orde, self.username, self.name, self.active)
+                self.dist, self.publish_date, self.orde, self.username, self.name, self.active,
+                self.max_percentile)
+
+    def query_key(self):
+        """Clave canónica de la consulta a Wallapop: dos búsquedas con la misma clave piden la misma url.
+
+        Solo las palabras positivas y ordenadas, como en get_url_list: "iphone",
+        "iphone -funda" y "-funda iphone" son una sola consulta; las negativas
+        se aplican después, al filtrar títulos para cada chat.
+        """
+        kws = " ".join(sorted(kw for kw in self.kws.lower().split() if not kw.startswith('-'))) if self.kws else ""
+        return kws, self.cat_ids, self.min_price, self.max_price, self.dist, self.orde
 
 
 class Item:
@@ -37,12 +104,158 @@ class Item:
         self.item = item
 
 
-class DBHelper:
-    def __init__(self, dbname="/data/db.sqlite"):
+class DBHelper(Storage):
+    """Almacenamiento en SQLite.
+
+    Las escrituras van a una cola y usan una única conexión de escritura: el
+    hilo que consigue el turno ejecuta todo lo que haya en la cola (hasta
+    WRITE_BATCH operaciones, suyas y de otros hilos) en una sola transacción,
+    cada una en su savepoint para que un error solo deshaga esa, y hace un
+    commit para todas; los demás se encuentran su resultado hecho. Cada hilo
+    lee con su propia conexión de solo lectura; en modo WAL una lectura no
+    espera a que acabe una escritura, así que las consultas del bot no
+    esperan a los barridos.
+    """
+
+    # Máximo de parámetros por consulta "in (...)" (SQLITE_MAX_VARIABLE_NUMBER antiguo es 999)
+    MAX_IN_PARAMS = 500
+    # Operaciones de escritura como máximo en cada commit
+    WRITE_BATCH = 64
+
+    def __init__(self, dbname="/data/db.sqlite", journal_mode=None, synchronous=None, cache_size=None,
+                 busy_timeout=None):
         self.dbname = dbname
-        self.conn = sqlite3.connect(dbname, check_same_thread=False)
+        self.cache_size = cache_size
+        self.busy_timeout = busy_timeout
+        self.conn = self._connect()
+        # En una db nueva se activa el auto_vacuum incremental (en una existente hace falta un VACUUM).
+        # Tiene que ser antes de pasar a WAL
+        if self.conn.execute("select count(*) from sqlite_master").fetchone()[0] == 0:
+            self.conn.execute("pragma auto_vacuum = incremental")
+        # Pragmas opcionales, p.ej. WAL + synchronous=NORMAL para no hacer fsync en cada commit en la SD
+        if journal_mode is not None:
+            self.conn.execute("pragma journal_mode = %s" % journal_mode)
+        if synchronous is not None:
+            self.conn.execute("pragma synchronous = %s" % synchronous)
+
+        # Escrituras pendientes; las ejecuta el hilo que consigue _write_lock, las suyas y las de los demás
+        self._queue = queue.Queue()
+        self._write_lock = threading.Lock()
+        self._closed = False
+        self._local = threading.local()
+        self._readers = {}
+        self._readers_lock = threading.Lock()
+        self.writes = 0
+        self.commits = 0
+
+    def _connect(self):
+        # check_same_thread=False solo para poder cerrarlas desde otro hilo: cada una la usa un solo hilo
+        conn = sqlite3.connect(self.dbname, check_same_thread=False)
+        if self.cache_size is not None:
+            conn.execute("pragma cache_size = %d" % int(self.cache_size))
+        # Con varios procesos (ROLE=bot/scraper) un commit puede tener que esperar al de otro
+        if self.busy_timeout is not None:
+            conn.execute("pragma busy_timeout = %d" % int(self.busy_timeout))
+        return conn
+
+    def _reader(self):
+        """Conexión de solo lectura del hilo actual"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            conn.execute("pragma query_only = 1")
+            self._local.conn = conn
+            with self._readers_lock:
+                # Las de hilos que ya han acabado se cierran aquí
+                for thread in [t for t in self._readers if not t.is_alive()]:
+                    self._readers.pop(thread).close()
+                self._readers[threading.current_thread()] = conn
+        return conn
+
+    def _write(self, fn, transaction=True):
+        """Ejecuta fn(conn) con la conexión de escritura y devuelve lo que devuelva, o lanza su excepción.
+
+        Con transaction=False se ejecuta sola y fuera de transacción (migraciones, pragmas)
+        """
+        future = Future()
+        self._queue.put((fn, future, transaction))
+        while not future.done():
+            with self._write_lock:
+                if self._closed:
+                    raise sqlite3.ProgrammingError('DBHelper cerrado')
+                # Mientras otro hilo hacía su commit puede que ya haya hecho también el nuestro
+                if not future.done():
+                    self._run_queued()
+        return future.result()
 
-    def setup(self, version=""):
+    def _run_queued(self):
+        """Ejecuta lo que haya en la cola: seguidas, hasta WRITE_BATCH operaciones en un solo commit"""
+        batch = []
+        while len(batch) < self.WRITE_BATCH:
+            try:
+                fn, future, transaction = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if transaction:
+                batch.append((fn, future))
+                continue
+            self._commit(batch)
+            batch = []
+            try:
+                future.set_result(fn(self.conn))
+            except Exception as e:
+                future.set_exception(e)
+            self.writes += 1
+        self._commit(batch)
+
+    def _commit(self, batch):
+        if not batch:
+            return
+        results = []
+        try:
+            self.conn.execute("begin")
+            for fn, future in batch:
+                self.conn.execute("savepoint job")
+                try:
+                    results.append((future, fn(self.conn), None))
+                except Exception as e:
+                    self.conn.execute("rollback to job")
+                    results.append((future, None, e))
+                self.conn.execute("release job")
+            self.conn.commit()
+        except Exception as e:
+            if self.conn.in_transaction:
+                self.conn.rollback()
+            results = [(future, None, e) for future, _ in batch]
+        self.writes += len(batch)
+        self.commits += 1
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def close(self):
+        """Cierra todas las conexiones; después las escrituras fallan"""
+        with self._write_lock:
+            self._closed = True
+            self.conn.close()
+        with self._readers_lock:
+            for conn in self._readers.values():
+                conn.close()
+            self._readers.clear()
+
+    def stats(self):
+        with self._readers_lock:
+            readers = len(self._readers)
+        return {
+            'write_queue': self._queue.qsize(),
+            'writes': self.writes,
+            'commits': self.commits,
+            'readers': readers,
+        }
+
+    def setup(self):
         tblstmtitem = "create table if not exists item " \
                   "(itemId integer, " \
                   "chatId text, " \
@@ -54,7 +267,6 @@ class DBHelper:
                   "observaciones text, " \
                   "item text, " \
                   " primary key (itemId,chatId))"
-        self.conn.execute(tblstmtitem)
 
         tblstmtchat = "create table if not exists chat_search " \
                       "(chat_id text, " \
@@ -68,140 +280,499 @@ class DBHelper:
                       "username text, " \
                       "name text, " \
                       "active int default 1)"
-        self.conn.execute(tblstmtchat)
 
-        if version == '1.0.6':
-            stmt = "update chat_search " \
-                   "set ord = \'newest\' " \
-                   "where ord = \'creationDate-des\'"
-            try:
-                self.conn.execute(stmt)
-                self.conn.commit()
-            except Exception as e:
-                print(e)
+        tblstmtseller = "create table if not exists seller " \
+                        "(userId text primary key, " \
+                        "reviewsCount integer, " \
+                        "averageRating real, " \
+                        "isTopProfile integer, " \
+                        "fetchedAt real)"
 
-        self.conn.commit()
+        def write(conn):
+            conn.execute(tblstmtitem)
+            conn.execute(tblstmtchat)
+            conn.execute(tblstmtseller)
+            conn.commit()
+            # Las tablas de arriba son el esquema original; el resto lo añaden las migraciones.
+            # Si una falla no se sigue: un proceso con el esquema a medias no debe arrancar
+            migrations.migrate(conn)
 
+        self._write(write, transaction=False)
+
+    @timed
     def add_search(self, chat_search):
-        stmt = "insert into chat_search (chat_id, kws"
-        valu = " values (?, ?"
-        args = (chat_search.chat_id, chat_search.kws)
-        if chat_search.cat_ids is not None:
-            stmt += ", cat_ids"
-            valu += ", ?"
-            args += (chat_search.cat_ids, )
-        if chat_search.min_price is not None:
-            stmt += ", min_price"
-            valu += ", ?"
-            args += (chat_search.min_price, )
-        if chat_search.max_price is not None:
-            stmt += ", max_price"
-            valu += ", ?"
-            args += (chat_search.max_price, )
-        if chat_search.dist is not None:
-            stmt += ", dist"
-            valu += ", ?"
-            args += (chat_search.dist, )
-        if chat_search.publish_date is not None:
-            stmt += ", publish_date"
-            valu += ", ?"
-            args += (chat_search.publish_date, )
-        if chat_search.orde is not None:
-            stmt += ", ord"
-            valu += ", ?"
-            args += (chat_search.orde, )
-        if chat_search.username is not None:
-            stmt += ", username"
-            valu += ", ?"
-            args += (chat_search.username, )
-        if chat_search.name is not None:
-            stmt += ", name"
-            valu += ", ?"
-            args += (chat_search.name, )
-        if chat_search.active is not None:
-            stmt += ", active"
-            valu += ", ?"
-            args += (chat_search.active, )
-        stmt += ")" + valu + ")"
-        try:
-            self.conn.execute(stmt, args)
-            self.conn.commit()
+        # (chat_id, kws) es único: volver a añadir una búsqueda la reemplaza y reactiva
+        stmt = "insert or replace into chat_search (%s) values (%s)" % (
+            ", ".join(SEARCH_COLUMNS), ", ".join("?" * len(SEARCH_COLUMNS)))
+        try:
+            self._write(lambda conn: conn.execute(stmt, search_row(chat_search)))
         except sqlite3.IntegrityError as e:
             print(e)
 
+    @timed
     def add_item(self, item_id, chat_id, title, price, url, user, publish_date=None, observaciones=None):
         stmt = "insert into item (itemId, chatId, title, price, url, user, publishDate, observaciones) " \
                "values (?, ?, ?, ?, ?, ?, ?, ?)"
         args = (item_id, chat_id, title, price, url, user, publish_date, observaciones)
         try:
-            self.conn.execute(stmt, args)
-            self.conn.commit()
+            self._write(lambda conn: conn.execute(stmt, args))
         except Exception as e:
             print(e)
 
     # Actualiza el precio pero no el campo observaciones
-    def update_item(self, item_id, price, obs):
+    @timed
+    def update_item(self, item_id, price, obs, chat_id):
         stmt = "update item " \
                   "set price = ?, " \
                   "observaciones = ? " \
-                  "where itemId = ?"
+                  "where itemId = ? and chatId = ?"
         try:
-            self.conn.execute(stmt, (price, obs, item_id))
-            self.conn.commit()
+            self._write(lambda conn: conn.execute(stmt, (price, obs, item_id, chat_id)))
         except Exception as e:
             print(e)
 
+    @timed
     def delete_items(self, hours_live):
         millis = int(round(time.time() * 1000))
         millis -= hours_live*60*60*1000
         stmt = "delete from item where publishDate < (?)"
         args = (millis, )
         try:
-            self.conn.execute(stmt, args)
-            self.conn.commit()
+            self._write(lambda conn: conn.execute(stmt, args))
         except Exception as e:
             print(e)
 
+    @timed
     def search_item(self, item_id, chat_id):
         stmt = "select itemId, chatId, title, price, url, publishDate, observaciones, user " \
                  "from item where itemId = (?) and chatId = (?)"
         args = (item_id, chat_id)
         try:
-            for row in self.conn.execute(stmt, args):
-                i = Item(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7])
-                return i
+            row = self._reader().execute(stmt, args).fetchone()
+            if row is not None:
+                return Item(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7])
+        except Exception as e:
+            print(e)
+        return None
+
+    @timed
+    def search_items(self, item_ids, chat_id):
+        """Busca de una vez varios items de un chat. Devuelve {str(itemId): Item}"""
+        found = {}
+        item_ids = list(item_ids)
+        try:
+            conn = self._reader()
+            for n in range(0, len(item_ids), self.MAX_IN_PARAMS):
+                chunk = item_ids[n:n + self.MAX_IN_PARAMS]
+                stmt = "select itemId, chatId, title, price, url, publishDate, observaciones, user " \
+                       "from item where chatId = ? and itemId in (%s)" % ", ".join("?" * len(chunk))
+                for row in conn.execute(stmt, [chat_id] + chunk):
+                    found[str(row[0])] = Item(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7])
+        except Exception as e:
+            print(e)
+        return found
+
+    @timed
+    def save_items(self, new_items, updates, seen=(), now=None, prices=()):
+        """Inserta items nuevos y actualiza precios en una única transacción.
+
+        new_items: tuplas (item_id, chat_id, title, price, url, user)
+        updates: tuplas (price, observaciones, item_id, chat_id)
+        seen: tuplas como new_items de items ya conocidos; solo se les actualiza
+        lastSeen (o se vuelven a insertar si habían caducado)
+        prices: tuplas (item_id, clave de consulta, precio) de los nuevos y las
+        bajadas, para price_history e item_price
+        Devuelve el conjunto de (str(item_id), str(chat_id)) que ha insertado o
+        abaratado esta llamada, o None si no se ha podido guardar. Si otro
+        proceso se ha adelantado con el mismo item o la misma bajada, no está
+        en el conjunto y no hay que avisar otra vez.
+        """
+        if not new_items and not updates and not seen and not prices:
+            return set()
+        now = now or time.time()
+        stmt_seen = "insert into item (itemId, chatId, title, price, url, user, lastSeen) " \
+                    "values (?, ?, ?, ?, ?, ?, ?) " \
+                    "on conflict (itemId, chatId) do update set lastSeen = excluded.lastSeen"
+        stmt_add = "insert or ignore into item (itemId, chatId, title, price, url, user, lastSeen) " \
+                   "values (?, ?, ?, ?, ?, ?, ?)"
+        stmt_upd = "update item set price = ?, observaciones = ?, lastSeen = ? " \
+                   "where itemId = ? and chatId = ? and price > ?"
+
+        def write(conn):
+            claimed = set()
+            if seen:
+                conn.executemany(stmt_seen, [row + (now, ) for row in seen])
+            for row in new_items:
+                if conn.execute(stmt_add, row + (now, )).rowcount:
+                    claimed.add((str(row[0]), str(row[1])))
+            for price, obs, item_id, chat_id in updates:
+                if conn.execute(stmt_upd, (price, obs, now, item_id, chat_id, price)).rowcount:
+                    claimed.add((str(item_id), str(chat_id)))
+            for item_id, query_key, cents in prices:
+                # Sin cambio de precio el upsert no toca nada y no hay punto nuevo
+                if conn.execute(STMT_ITEM_PRICE, (str(item_id), query_key, cents, now, cents, cents, now)).rowcount:
+                    conn.execute("insert or ignore into price_history (itemId, ts, cents) values (?, ?, ?)",
+                                 (str(item_id), now, cents))
+            return claimed
+
+        try:
+            return self._write(write)
+        except Exception as e:
+            print(e)
+        return None
+
+    @timed
+    def find_item(self, chat_id, ref):
+        stmt = "select itemId, chatId, title, price, url, publishDate, observaciones, user " \
+               "from item where chatId = ? and (itemId = ? or url = ?)"
+        try:
+            row = self._reader().execute(stmt, (chat_id, ref, ref)).fetchone()
+            if row is not None:
+                return Item(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7])
+        except Exception as e:
+            print(e)
+        return None
+
+    @timed
+    def get_item_prices(self, limit):
+        """(itemId, chatId, precio en céntimos, lastSeen) de los `limit` items más recientes, del más nuevo al más viejo"""
+        stmt = "select itemId, chatId, price, lastSeen from item order by rowid desc limit ?"
+        try:
+            return self._reader().execute(stmt, (limit, )).fetchall()
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def get_item_pairs(self, after_rowid, limit):
+        """(rowid, itemId, chatId) de hasta `limit` items a partir de `after_rowid`, para recorrer la tabla por trozos"""
+        stmt = "select rowid, itemId, chatId from item where rowid > ? order by rowid limit ?"
+        try:
+            return self._reader().execute(stmt, (after_rowid, limit)).fetchall()
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def count_items(self):
+        try:
+            return self._reader().execute("select count(*) from item").fetchone()[0]
+        except Exception as e:
+            print(e)
+        return 0
+
+    @timed
+    def expire_items(self, cutoff, limit, now=None):
+        """Borra hasta `limit` items no vistos desde `cutoff` dejando su lápida.
+
+        Devuelve [(itemId, chatId, hash)] de los borrados.
+        """
+        now = now or time.time()
+        stmt = "select rowid, itemId, chatId, price from item where lastSeen < ? limit ?"
+
+        def write(conn):
+            rows = conn.execute(stmt, (cutoff, limit)).fetchall()
+            expired = [(item_id, chat_id, pair_hash(item_id, chat_id)) for _, item_id, chat_id, _ in rows]
+            conn.executemany("insert or replace into item_tombstone (hash, price, expiredAt) values (?, ?, ?)",
+                             [(h, row[3], now) for row, (_, _, h) in zip(rows, expired)])
+            conn.executemany("delete from item where rowid = ?", [(row[0], ) for row in rows])
+            return expired
+
+        try:
+            return self._write(write)
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def expire_tombstones(self, cutoff, limit):
+        """Borra hasta `limit` lápidas anteriores a `cutoff`. Devuelve cuántas"""
+        stmt = "delete from item_tombstone where hash in " \
+               "(select hash from item_tombstone where expiredAt < ? limit ?)"
+        try:
+            return self._write(lambda conn: conn.execute(stmt, (cutoff, limit)).rowcount)
+        except Exception as e:
+            print(e)
+        return 0
+
+    @timed
+    def get_tombstone_hashes(self):
+        try:
+            return [row[0] for row in self._reader().execute("select hash from item_tombstone")]
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def get_tombstones(self, hashes):
+        """{hash: último precio} de las lápidas que existan"""
+        found = {}
+        hashes = list(hashes)
+        try:
+            conn = self._reader()
+            for n in range(0, len(hashes), self.MAX_IN_PARAMS):
+                chunk = hashes[n:n + self.MAX_IN_PARAMS]
+                stmt = "select hash, price from item_tombstone where hash in (%s)" % ", ".join("?" * len(chunk))
+                found.update(conn.execute(stmt, chunk).fetchall())
+        except Exception as e:
+            print(e)
+        return found
+
+    @timed
+    def get_price_history(self, item_id, limit=50):
+        stmt = "select ts, cents from price_history where itemId = ? order by ts desc limit ?"
+        try:
+            return self._reader().execute(stmt, (str(item_id), limit)).fetchall()[::-1]
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def get_item_price(self, item_id):
+        stmt = "select queryKey, firstCents, firstTs, minCents, lastCents, lastTs, changes from item_price " \
+               "where itemId = ?"
+        try:
+            return self._reader().execute(stmt, (str(item_id), )).fetchone()
+        except Exception as e:
+            print(e)
+        return None
+
+    @timed
+    def get_search_prices(self, query_key, limit):
+        stmt = "select itemId, lastCents from item_price where queryKey = ? order by lastTs desc limit ?"
+        try:
+            return self._reader().execute(stmt, (query_key, limit)).fetchall()
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def get_price_series(self, query_key, since=0):
+        stmt = "select rowid, firstTs, firstCents, lastCents, lastTs from item_price " \
+               "where queryKey = ? and lastTs >= ?"
+        try:
+            return self._reader().execute(stmt, (query_key, since)).fetchall()
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def expire_price_history(self, cutoff, limit):
+        stmt = "select itemId from item_price where lastTs < ? " \
+               "and not exists (select 1 from item where item.itemId = item_price.itemId) limit ?"
+
+        def write(conn):
+            ids = [(row[0], ) for row in conn.execute(stmt, (cutoff, limit))]
+            conn.executemany("delete from price_history where itemId = ?", ids)
+            conn.executemany("delete from item_price where itemId = ?", ids)
+            return len(ids)
+
+        try:
+            return self._write(write)
+        except Exception as e:
+            print(e)
+        return 0
+
+    @timed
+    def compact(self, pages=1000):
+        """Devuelve al sistema hasta `pages` páginas libres y vacía el WAL en el fichero principal"""
+        def write(conn):
+            if conn.execute("pragma auto_vacuum").fetchone()[0] == 2:
+                # Libera una página por paso; execute solo da uno y executescript llega hasta el final
+                conn.executescript("pragma incremental_vacuum(%d);" % int(pages))
+            if conn.execute("pragma journal_mode").fetchone()[0] == 'wal':
+                conn.execute("pragma wal_checkpoint(TRUNCATE)").fetchall()
+            return conn.execute("pragma freelist_count").fetchone()[0]
+
+        try:
+            return self._write(write, transaction=False)
         except Exception as e:
             print(e)
         return None
 
+    @timed
     def get_chat_searchs(self, chat_id):
-        stmt = "select chat_id, kws, cat_ids, min_price, max_price, dist, publish_date, ord from chat_search " \
-                "where chat_id = ? and active = 1"
+        stmt = "select chat_id, kws, cat_ids, min_price, max_price, dist, publish_date, ord, max_percentile " \
+               "from chat_search where chat_id = ? and active = 1"
         lista = []
         try:
-            for row in self.conn.execute(stmt, (chat_id, )):
-                c = ChatSearch(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7])
+            rows = self._reader().execute(stmt, (chat_id, )).fetchall()
+            for row in rows:
+                c = ChatSearch(row[0], row[1], row[2], _as_text(row[3]), _as_text(row[4]), _as_text(row[5]),
+                               row[6], row[7], max_percentile=row[8])
                 lista.append(c)
         except Exception as e:
             print(e)
         return lista
 
+    @timed
     def get_chats_searchs(self):
-        stmt = "select chat_id, kws, cat_ids, min_price, max_price, dist, publish_date, ord from chat_search " \
-                "where active = 1"
+        stmt = "select chat_id, kws, cat_ids, min_price, max_price, dist, publish_date, ord, max_percentile " \
+               "from chat_search where active = 1"
         lista = []
         try:
-            for row in self.conn.execute(stmt):
-                c = ChatSearch(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7])
+            rows = self._reader().execute(stmt).fetchall()
+            for row in rows:
+                c = ChatSearch(row[0], row[1], row[2], _as_text(row[3]), _as_text(row[4]), _as_text(row[5]),
+                               row[6], row[7], max_percentile=row[8])
                 lista.append(c)
         except Exception as e:
             print(e)
         return lista
 
+    @timed
     def del_chat_search(self, chat_id, kws):
         stmt = "update chat_search set active = 0 where chat_id = ? and kws = ?"
         try:
-            self.conn.execute(stmt, (chat_id, kws))
-            self.conn.commit()
+            self._write(lambda conn: conn.execute(stmt, (chat_id, kws)))
+        except Exception as e:
+            print(e)
+
+    @timed
+    def set_search_percentile(self, chat_id, kws, percentile):
+        stmt = "update chat_search set max_percentile = ? where chat_id = ? and kws = ? and active = 1"
+        try:
+            return self._write(lambda conn: conn.execute(stmt, (percentile, str(chat_id), kws)).rowcount) > 0
+        except Exception as e:
+            print(e)
+        return False
+
+    @timed
+    def get_seller(self, user_id):
+        stmt = "select fetchedAt, reviewsCount, averageRating, isTopProfile from seller where userId = ?"
+        try:
+            row = self._reader().execute(stmt, (user_id, )).fetchone()
+            if row is not None:
+                info = {'reviews_count': row[1], 'is_top_profile': bool(row[3])}
+                if row[2] is not None:
+                    info['average_rating'] = row[2]
+                return row[0], info
+        except Exception as e:
+            print(e)
+        return None
+
+    @timed
+    def save_seller(self, user_id, info, fetched_at):
+        stmt = "insert or replace into seller (userId, reviewsCount, averageRating, isTopProfile, fetchedAt) " \
+               "values (?, ?, ?, ?, ?)"
+        args = (user_id, info.get('reviews_count', 0), info.get('average_rating'),
+                int(bool(info.get('is_top_profile'))), fetched_at)
+        try:
+            self._write(lambda conn: conn.execute(stmt, args))
+        except Exception as e:
+            print(e)
+
+    @timed
+    def add_outbox(self, chat_id, text, created_at):
+        stmt = "insert into outbox (chatId, text, createdAt) values (?, ?, ?)"
+        try:
+            return self._write(lambda conn: conn.execute(stmt, (chat_id, text, created_at)).lastrowid)
+        except Exception as e:
+            print(e)
+        return None
+
+    @timed
+    def get_outbox(self):
+        """Mensajes pendientes: tuplas (id, chat_id, text, created_at, attempts, 0.0)"""
+        stmt = "select id, chatId, text, createdAt, attempts from outbox order by id"
+        try:
+            rows = self._reader().execute(stmt).fetchall()
+            return [(row[0], row[1], row[2], row[3], row[4], 0.0) for row in rows]
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def delete_outbox(self, outbox_id):
+        try:
+            self._write(lambda conn: conn.execute("delete from outbox where id = ?", (outbox_id, )))
+        except Exception as e:
+            print(e)
+
+    @timed
+    def retry_outbox(self, outbox_id, attempts):
+        try:
+            self._write(lambda conn: conn.execute("update outbox set attempts = ? where id = ?",
+                                                  (attempts, outbox_id)))
+        except Exception as e:
+            print(e)
+
+    @timed
+    def get_search_state(self, query_key):
+        """(último item_id, su fecha de creación, último barrido completo) o None"""
+        stmt = "select lastItemId, lastTs, lastFullScan from search_state where queryKey = ?"
+        try:
+            return self._reader().execute(stmt, (query_key, )).fetchone()
+        except Exception as e:
+            print(e)
+        return None
+
+    @timed
+    def save_search_state(self, query_key, last_item_id, last_ts, last_full_scan):
+        stmt = "insert or replace into search_state (queryKey, lastItemId, lastTs, lastFullScan) " \
+               "values (?, ?, ?, ?)"
+        try:
+            self._write(lambda conn: conn.execute(stmt, (query_key, last_item_id, last_ts, last_full_scan)))
+        except Exception as e:
+            print(e)
+
+    @timed
+    def heartbeat_worker(self, worker_id, role, now):
+        stmt = "insert into worker (workerId, role, startedAt, heartbeat) values (?, ?, ?, ?) " \
+               "on conflict (workerId) do update set heartbeat = excluded.heartbeat"
+        try:
+            self._write(lambda conn: conn.execute(stmt, (worker_id, role, now, now)))
+        except Exception as e:
+            print(e)
+
+    @timed
+    def get_workers(self, alive_since, role='scraper'):
+        """Ids de los procesos de ese rol con latido posterior a `alive_since`"""
+        stmt = "select workerId from worker where role = ? and heartbeat >= ? order by workerId"
+        try:
+            return [row[0] for row in self._reader().execute(stmt, (role, alive_since))]
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def delete_workers(self, before=None, worker_id=None):
+        """Borra los procesos sin latido desde `before`, o el de `worker_id`"""
+        def write(conn):
+            if worker_id is not None:
+                conn.execute("delete from worker where workerId = ?", (worker_id, ))
+            else:
+                conn.execute("delete from worker where heartbeat < ?", (before, ))
+
+        try:
+            self._write(write)
+        except Exception as e:
+            print(e)
+
+    @timed
+    def get_assignments(self, worker_id=None):
+        """{clave de consulta: workerId}; con `worker_id`, solo las de ese proceso"""
+        try:
+            conn = self._reader()
+            if worker_id is None:
+                return dict(conn.execute("select queryKey, workerId from search_assignment"))
+            return dict(conn.execute("select queryKey, workerId from search_assignment where workerId = ?",
+                                     (worker_id, )))
+        except Exception as e:
+            print(e)
+        return None
+
+    @timed
+    def save_assignments(self, assigned, removed, now):
+        """assigned: [(clave de consulta, workerId)] nuevas o que cambian de dueño; removed: claves que ya no existen"""
+        def write(conn):
+            conn.executemany("insert or replace into search_assignment (queryKey, workerId, assignedAt) "
+                             "values (?, ?, ?)", [(key, worker, now) for key, worker in assigned])
+            conn.executemany("delete from search_assignment where queryKey = ?", [(key, ) for key in removed])
+
+        try:
+            self._write(write)
+            return True
         except Exception as e:
             print(e)
+        return False
@@ -0,0 +1,71 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+
+
+class SearchExecutor:
+    """Ejecuta las búsquedas en paralelo con concurrencia limitada.
+
+    Un pool de hilos reparte las búsquedas y, además, cada host tiene su
+    propio semáforo para no abrir más de ``per_host`` peticiones simultáneas
+    contra el mismo servidor (api.wallapop.com, api.telegram.org...).
+    """
+
+    def __init__(self, max_workers=8, per_host=4):
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='search')
+        self._hosts = {}
+        self._hosts_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def host_slot(self, url):
+        """Semáforo del host de la url, para usar con ``with``"""
+        host = urlsplit(url).netloc
+        with self._hosts_lock:
+            sem = self._hosts.get(host)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self.per_host)
+                self._hosts[host] = sem
+        return sem
+
+    @property
+    def stopping(self):
+        return self._stopping.is_set()
+
+    def run(self, fn, jobs):
+        """Lanza ``fn(*job)`` para cada job y espera a que terminen todos.
+
+        Devuelve el número de jobs que han terminado sin excepción.
+        """
+        futures = []
+        for job in jobs:
+            if self._stopping.is_set():
+                break
+            futures.append(self._pool.submit(self._call, fn, job))
+        done, _ = wait(futures)
+        return sum(1 for f in done if f.result())
+
+    def _call(self, fn, job):
+        if self._stopping.is_set():
+            return False
+        try:
+            fn(*job)
+            return True
+        except Exception as e:
+            logging.error("Error en búsqueda %s: %s", job, e)
+            return False
+
+    def shutdown(self, wait_running=True):
+        """Deja de aceptar búsquedas, descarta las pendientes y espera a las que están en curso"""
+        self._stopping.set()
+        self._pool.shutdown(wait=wait_running, cancel_futures=True)
+
+    def wait(self, timeout):
+        """Duerme ``timeout`` segundos o hasta que se pida parar. Devuelve True si hay que parar"""
+        return self._stopping.wait(timeout)
+
+    def submit(self, fn, *job):
+        """Lanza ``fn(*job)`` sin esperar a que termine"""
+        return self._pool.submit(self._call, fn, job)
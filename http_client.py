@@ -0,0 +1,136 @@
+import logging
+import random
+import threading
+
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import Counter, Histogram
+
+HTTP_REQUESTS = Counter('wallbot_http_requests_total', 'Peticiones HTTP por endpoint y código de respuesta',
+                        ('endpoint', 'status'))
+HTTP_LATENCY = Histogram('wallbot_http_request_seconds', 'Latencia de las peticiones HTTP por endpoint',
+                         ('endpoint', ))
+
+# Cabeceras que manda la web de Wallapop; el User-Agent se rota en cada petición
+WALLAPOP_HEADERS = {
+    'Accept': 'application/json, text/plain, */*',
+    'Accept-Language': 'es,ru;q=0.9,en;q=0.8,de;q=0.7,pt;q=0.6',
+    'Connection': 'keep-alive',
+    'DeviceOS': '0',
+    'Origin': 'https://es.wallapop.com',
+    'Referer': 'https://es.wallapop.com/',
+    'Sec-Fetch-Dest': 'empty',
+    'Sec-Fetch-Mode': 'cors',
+    'Sec-Fetch-Site': 'same-site',
+    'X-AppVersion': '75491',
+    'X-DeviceOS': '0',
+    'sec-ch-ua-mobile': '?0',
+}
+
+DEFAULT_USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 ' \
+                     '(KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'
+
+
+class UserAgentPool:
+    """User-Agents cargados una sola vez al arrancar, en vez de crear un UserAgent() por petición"""
+
+    def __init__(self, size=50):
+        self.agents = []
+        try:
+            from fake_useragent import UserAgent
+            ua = UserAgent()
+            self.agents = list({ua.random for _ in range(size)})
+        except Exception as e:
+            logging.warning("No se pudieron cargar User-Agents: %s", e)
+        if not self.agents:
+            self.agents = [DEFAULT_USER_AGENT]
+
+    def random(self):
+        return random.choice(self.agents)
+
+
+class HttpPool:
+    """Sesión de requests con conexiones keep-alive reutilizables para un host.
+
+    Todas las peticiones llevan timeout. Opcionalmente pasan por un TokenBucket
+    (``limiter``) y un CircuitBreaker (``breaker``) compartidos por todas las
+    llamadas al host. ``stats()`` devuelve el uso del pool para poder
+    dimensionarlo.
+    """
+
+    def __init__(self, name, pool_size=10, timeout=15, headers=None, limiter=None, breaker=None):
+        self.name = name
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        if headers:
+            self.session.headers.update(headers)
+        self.limiter = limiter
+        self.breaker = breaker
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def get(self, url, endpoint=None, **kwargs):
+        """GET con el timeout del pool; ``endpoint`` es la etiqueta de las métricas (por defecto el pool)"""
+        endpoint = endpoint or self.name
+        kwargs.setdefault('timeout', self.timeout)
+        if self.breaker is not None:
+            self.breaker.before_request()
+        if self.limiter is not None:
+            self.limiter.acquire()
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        start = time.perf_counter()
+        try:
+            response = self.session.get(url, **kwargs)
+        except Exception:
+            HTTP_REQUESTS.inc(endpoint=endpoint, status='error')
+            with self._lock:
+                self.errors += 1
+            if self.breaker is not None:
+                self.breaker.record(None)
+            raise
+        finally:
+            HTTP_LATENCY.observe(time.perf_counter() - start, endpoint=endpoint)
+            with self._lock:
+                self.in_flight -= 1
+        HTTP_REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+        if self.breaker is not None:
+            self.breaker.record(response.status_code)
+        return response
+
+    def connections(self):
+        """Conexiones TCP abiertas hasta ahora por el pool (una nueva por cada handshake)"""
+        total = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                total += pool.num_connections
+        return total
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pool': self.name,
+                'pool_size': self.pool_size,
+                'requests': self.requests,
+                'errors': self.errors,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'connections': self.connections(),
+            }
+
+    def close(self):
+        self.session.close()
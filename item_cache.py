@@ -0,0 +1,220 @@
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from dbhelper import pair_hash
+
+DAY = 24 * 60 * 60
+
+
+class ItemCache:
+    """Precio (en céntimos) de cada (item, chat) ya visto, en memoria delante de la tabla ``item``.
+
+    Con ella la decisión de si un item es nuevo o ha bajado de precio no
+    necesita SQL. Se carga al arrancar con los items más recientes de la db y
+    se actualiza con cada ``save``, después de guardar en la db. Solo se va a
+    la db para los items que no están en la caché si alguna vez se ha quedado
+    fuera alguno (por el límite de tamaño).
+
+    Cada entrada es una clave ``chat_id:item_id`` y un entero en un dict con
+    el precio y el día en que se vio por última vez (``precio << 16 | día``),
+    así ``lastSeen`` se escribe como mucho una vez al día por item. El límite
+    es aproximadamente LRU con dos generaciones: cuando la nueva llega a
+    ``maxsize / 2`` entradas, la vieja se descarta entera. Lo que se lee de la
+    vieja pasa a la nueva.
+
+    Los items caducados por la retención dejan una lápida en la db; aquí se
+    guardan solo sus hashes (8 bytes cada uno, en un array ordenado) para
+    saber sin SQL si un item desconocido es de verdad nuevo.
+
+    Si la caché no tiene toda la tabla, ``seen_filter`` (un
+    RotatingBloomFilter con los items y las lápidas) evita ir a la db por los
+    items que seguro que son nuevos.
+
+    Con ``shared`` otros procesos escriben en la misma db (ROLE=scraper): la
+    caché nunca se da por completa y las lápidas se miran en la db.
+    """
+
+    REBUILD_PAGE = 10000
+
+    def __init__(self, db, maxsize=200000, seen_filter=None, shared=False):
+        self.db = db
+        self.maxsize = maxsize
+        self.seen_filter = seen_filter
+        self.shared = shared
+        self.filtered = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.revived = 0
+        # Mientras esté toda la tabla en memoria, lo que no está en la caché es nuevo
+        self.complete = False
+        self._young = {}
+        self._old = {}
+        self._tombstones = array('q')
+        self._recent_tombstones = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(item_id, chat_id):
+        return '%s:%s' % (chat_id, item_id)
+
+    @staticmethod
+    def _pack(price, seen):
+        return int(price) << 16 | int(seen // DAY) & 0xffff
+
+    def warm(self):
+        self.load_tombstones()
+        if self.maxsize <= 0:
+            return
+        rows = [row for row in self.db.get_item_prices(self.maxsize + 1) if row[2] is not None]
+        half = self.maxsize // 2
+        with self._lock:
+            self._young = {self._key(item_id, chat_id): self._pack(price, seen or 0)
+                           for item_id, chat_id, price, seen in rows[:half]}
+            self._old = {self._key(item_id, chat_id): self._pack(price, seen or 0)
+                         for item_id, chat_id, price, seen in rows[half:self.maxsize]}
+            self.complete = len(rows) <= self.maxsize and not self.shared
+
+    def load_tombstones(self):
+        tombstones = array('q', sorted(self.db.get_tombstone_hashes()))
+        with self._lock:
+            self._tombstones = tombstones
+            self._recent_tombstones = set()
+
+    def _is_tombstone(self, h):
+        if h in self._recent_tombstones:
+            return True
+        i = bisect_left(self._tombstones, h)
+        return i < len(self._tombstones) and self._tombstones[i] == h
+
+    def prices(self, item_ids, chat_id, now=None):
+        """Precios de los items que el chat ya conoce: ({str(item_id): céntimos}, {str(item_id) a marcar como vistos})
+
+        Los segundos son los que no se han marcado hoy y los que vuelven tras caducar.
+        """
+        today = int((now or time.time()) // DAY) & 0xffff
+        found = {}
+        stale = set()
+        missing = []
+        with self._lock:
+            for item_id in item_ids:
+                key = self._key(item_id, chat_id)
+                value = self._young.get(key)
+                if value is None:
+                    value = self._old.pop(key, None)
+                    if value is not None:
+                        self._store(key, value)
+                if value is not None:
+                    found[str(item_id)] = value >> 16
+                    if value & 0xffff != today:
+                        stale.add(str(item_id))
+                else:
+                    missing.append(item_id)
+            self.hits += len(found)
+            if not self.complete:
+                self.misses += len(missing)
+        if missing and not self.complete and self.seen_filter is not None:
+            # Los que el filtro no ha visto nunca son nuevos: ni db ni lápida
+            maybe = [item_id for item_id in missing if self.seen_filter.might_contain(pair_hash(item_id, chat_id))]
+            with self._lock:
+                self.filtered += len(missing) - len(maybe)
+            missing = maybe
+        if missing and not self.complete:
+            known = self.db.search_items(missing, chat_id)
+            with self._lock:
+                for item_id, item in known.items():
+                    found[item_id] = int(item.price)
+                    stale.add(item_id)
+                    self._store(self._key(item_id, chat_id), self._pack(item.price, 0))
+            missing = [item_id for item_id in missing if str(item_id) not in known]
+
+        # Los que caducaron vuelven con su último precio, para no avisar de ellos como nuevos
+        with self._lock:
+            hashes = {pair_hash(item_id, chat_id): item_id for item_id in missing}
+            if not self.shared:
+                hashes = {h: item_id for h, item_id in hashes.items() if self._is_tombstone(h)}
+        if hashes:
+            for h, price in self.db.get_tombstones(hashes).items():
+                found[str(hashes[h])] = price
+                stale.add(str(hashes[h]))
+                with self._lock:
+                    self.revived += 1
+        return found, stale
+
+    def save(self, new_items, updates, seen=(), now=None, prices=()):
+        """Guarda en la db (save_items) y, si va bien, en la caché. Devuelve lo que devuelve save_items"""
+        now = now or time.time()
+        claimed = self.db.save_items(new_items, updates, seen, now, prices)
+        if claimed is None:
+            return None
+        with self._lock:
+            for item_id, chat_id, _, price, _, _ in list(seen) + list(new_items):
+                self._store(self._key(item_id, chat_id), self._pack(price, now))
+            for price, _, item_id, chat_id in updates:
+                self._store(self._key(item_id, chat_id), self._pack(price, now))
+        if self.seen_filter is not None:
+            for item_id, chat_id, _, _, _, _ in new_items:
+                self.seen_filter.add(pair_hash(item_id, chat_id))
+        return claimed
+
+    def rebuild_filter(self):
+        """Rehace seen_filter con todos los items y lápidas de la db, leyendo la tabla por trozos"""
+        tombstones = self.db.get_tombstone_hashes()
+
+        def hashes():
+            yield from tombstones
+            last = 0
+            while True:
+                rows = self.db.get_item_pairs(last, self.REBUILD_PAGE)
+                for _, item_id, chat_id in rows:
+                    yield pair_hash(item_id, chat_id)
+                if len(rows) < self.REBUILD_PAGE:
+                    return
+                last = rows[-1][0]
+
+        self.seen_filter.rebuild(hashes(), self.db.count_items() + len(tombstones))
+
+    def forget(self, expired):
+        """Quita los items caducados ([(item_id, chat_id, hash)]) y apunta sus lápidas"""
+        with self._lock:
+            for item_id, chat_id, h in expired:
+                key = self._key(item_id, chat_id)
+                self._young.pop(key, None)
+                self._old.pop(key, None)
+                self._recent_tombstones.add(h)
+
+    def clear(self):
+        """Vacía la caché, p.ej. después de borrar items de la db"""
+        with self._lock:
+            self._young = {}
+            self._old = {}
+            self.complete = False
+
+    def _store(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._young[key] = value
+        self._old.pop(key, None)
+        if len(self._young) >= self.maxsize // 2 and self._young:
+            if self._old:
+                self.evicted += len(self._old)
+                self.complete = False
+            self._old = self._young
+            self._young = {}
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._young) + len(self._old),
+                'tombstones': len(self._tombstones) + len(self._recent_tombstones),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evicted': self.evicted,
+                'revived': self.revived,
+                'filtered': self.filtered,
+                'complete': int(self.complete),
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
@@ -0,0 +1,113 @@
+import unicodedata
+from collections import deque
+from functools import lru_cache
+
+
+def normalize(text):
+    """Minúsculas y sin acentos: 'Cámara' -> 'camara'"""
+    text = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+
+def split_keywords(kws):
+    """Separa las palabras de una búsqueda en (positivas, negativas). '-funda' es negativa"""
+    positive = []
+    negative = []
+    for kw in kws.split():
+        if kw.startswith('-') and len(kw) > 1:
+            negative.append(normalize(kw[1:]))
+        elif kw != '-':
+            positive.append(normalize(kw))
+    return positive, negative
+
+
+class KeywordMatcher:
+    """Autómata Aho-Corasick con las palabras de todas las búsquedas.
+
+    Una sola pasada por el título encuentra todas las palabras que contiene y,
+    con ellas, todas las búsquedas que cumple: todas sus palabras positivas y
+    ninguna negativa (comparación por subcadena, sin acentos ni mayúsculas).
+    """
+
+    def __init__(self, queries):
+        self.queries = list(dict.fromkeys(queries))
+        terms = {}
+        # Por término: [(índice de búsqueda, es_negativa)]
+        self._term_queries = []
+        self._required = []
+        self._no_positive = []
+        for qi, kws in enumerate(self.queries):
+            positive, negative = split_keywords(kws)
+            positive = set(positive)
+            self._required.append(len(positive))
+            if not positive:
+                self._no_positive.append(qi)
+            for term, neg in [(t, False) for t in positive] + [(t, True) for t in set(negative)]:
+                if term not in terms:
+                    terms[term] = len(terms)
+                    self._term_queries.append([])
+                self._term_queries[terms[term]].append((qi, neg))
+        self._build(terms)
+
+    def _build(self, terms):
+        self._goto = [{}]
+        self._out = [[]]
+        for term, ti in terms.items():
+            node = 0
+            for c in term:
+                nxt = self._goto[node].get(c)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][c] = nxt
+                    self._goto.append({})
+                    self._out.append([])
+                node = nxt
+            self._out[node].append(ti)
+
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for c, nxt in self._goto[node].items():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f and c not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(c, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def terms_in(self, title):
+        """Índices de los términos que aparecen en el título"""
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        found = set()
+        node = 0
+        for c in normalize(title):
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+    def match(self, title):
+        """Búsquedas (su texto de kws) que cumple el título"""
+        counts = {}
+        excluded = set()
+        for ti in self.terms_in(title):
+            for qi, neg in self._term_queries[ti]:
+                if neg:
+                    excluded.add(qi)
+                else:
+                    counts[qi] = counts.get(qi, 0) + 1
+        matched = {self.queries[qi] for qi, n in counts.items()
+                   if n == self._required[qi] and qi not in excluded}
+        matched.update(self.queries[qi] for qi in self._no_positive if qi not in excluded)
+        return matched
+
+
+@lru_cache(maxsize=8)
+def compile_matcher(queries):
+    """Matcher para un frozenset de búsquedas; se reutiliza mientras no cambien"""
+    return KeywordMatcher(sorted(queries))
@@ -0,0 +1,227 @@
+"""Métricas en formato de texto de Prometheus y servidor HTTP con /metrics y /healthz.
+
+Cada módulo declara sus métricas a nivel de módulo (igual que con
+prometheus_client) y se registran solas en ``REGISTRY``. Los valores que ya
+llevan otros objetos (profundidad de la cola, estado del circuito...) se
+copian a gauges justo antes de cada lectura con ``REGISTRY.on_collect``.
+"""
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.callbacks = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def on_collect(self, callback):
+        with self._lock:
+            self.callbacks.append(callback)
+
+    def render(self):
+        for callback in list(self.callbacks):
+            try:
+                callback()
+            except Exception as e:
+                logging.warning("Error recogiendo métricas: %s", e)
+        lines = []
+        for metric in list(self.metrics):
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.label_names)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return ['%s%s %s' % (self.name, _labels(self.label_names, k), v) for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        with self._lock:
+            return ['%s%s %s' % (self.name, _labels(self.label_names, k), v) for k, v in self._values.items()]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def summary(self, **labels):
+        """(número de observaciones, suma) de unas etiquetas"""
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return (entry[2], entry[1]) if entry else (0, 0.0)
+
+    def samples(self):
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                for bound, n in zip(self.buckets, counts):
+                    lines.append('%s_bucket%s %d' % (self.name, _labels(self.label_names, key, ('le', bound)), n))
+                lines.append('%s_bucket%s %d' % (self.name, _labels(self.label_names, key, ('le', '+Inf')), count))
+                lines.append('%s_sum%s %s' % (self.name, _labels(self.label_names, key), total))
+                lines.append('%s_count%s %d' % (self.name, _labels(self.label_names, key), count))
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Heartbeat:
+    """Marca de tiempo del último barrido del planificador y de la última consulta que ha ido bien, para /healthz.
+
+    Falla si el planificador no da vueltas en `max_age` segundos o si, con
+    consultas que hacer, ninguna ha ido bien en `max_age` más el intervalo
+    de la consulta más frecuente (circuito abierto, todas las peticiones
+    fallando). Un proceso sin consultas (ROLE=bot) solo mira el planificador.
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.started = time.time()
+        self.last_beat = None
+        self.last_success = None
+        self.active = 0
+        self.active_since = None
+        self.interval = 0
+
+    def beat(self, active=0, interval=0):
+        """Una vuelta del planificador con `active` consultas, la más frecuente cada `interval` segundos"""
+        now = time.time()
+        self.last_beat = now
+        if active and not self.active:
+            self.active_since = now
+        self.active = active
+        self.interval = interval or 0
+
+    def success(self):
+        self.last_success = time.time()
+
+    def status(self):
+        now = time.time()
+        # Mientras arranca se cuenta desde el inicio del proceso
+        age = now - (self.last_beat or self.started)
+        ok = age <= self.max_age
+        # Desde la última consulta buena, o desde que hay consultas si es más reciente
+        success_age = now - max(self.last_success or self.started, self.active_since or self.started)
+        if self.active:
+            ok = ok and success_age <= self.max_age + self.interval
+        return ok, {
+            'last_sweep_age': round(age, 1),
+            'last_success_age': round(now - self.last_success, 1) if self.last_success else None,
+            'active_queries': self.active,
+            'max_age': self.max_age,
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send(self, status, body, content_type):
+        raw = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._send(200, self.server.registry.render(), 'text/plain; version=0.0.4; charset=utf-8')
+        elif self.path == '/healthz':
+            ok, info = self.server.heartbeat.status()
+            self._send(200 if ok else 503, json.dumps(info), 'application/json')
+        else:
+            self._send(404, 'not found\n', 'text/plain')
+
+
+def start_http_server(port, heartbeat, registry=REGISTRY, host='0.0.0.0'):
+    """Arranca el servidor de métricas en un hilo aparte"""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.registry = registry
+    server.heartbeat = heartbeat
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
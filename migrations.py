@@ -0,0 +1,180 @@
+"""Migraciones de esquema de la base de datos.
+
+Cada migración tiene un número de versión; la última aplicada se guarda en
+``pragma user_version``, así que arrancar varias veces no repite ninguna.
+Cada una se ejecuta en su propia transacción y reconstruye las tablas con un
+único ``insert ... select`` para que bases de datos grandes migren rápido.
+"""
+
+
+def ord_newest(conn):
+    # Antes dependía de arrancar con VERSION == 1.0.6
+    conn.execute("update chat_search set ord = 'newest' where ord = 'creationDate-des'")
+
+
+def typed_prices(conn):
+    # item.price pasa de texto a céntimos enteros
+    conn.execute("create table item_new "
+                 "(itemId integer, "
+                 "chatId text, "
+                 "title text, "
+                 "price integer, "
+                 "url text, "
+                 "user text, "
+                 "publishDate integer, "
+                 "observaciones text, "
+                 "item text, "
+                 " primary key (itemId,chatId))")
+    conn.execute("insert into item_new "
+                 "select itemId, chatId, title, cast(round(cast(price as real) * 100) as integer), "
+                 "url, user, publishDate, observaciones, item from item")
+    conn.execute("drop table item")
+    conn.execute("alter table item_new rename to item")
+
+    # Los filtros de precio y distancia de las búsquedas pasan a ser numéricos
+    conn.execute("create table chat_search_new "
+                 "(chat_id text, "
+                 "kws text, "
+                 "cat_ids text, "
+                 "min_price real, "
+                 "max_price real, "
+                 "dist integer default 400, "
+                 "publish_date integer default 24, "
+                 "ord text default 'newest', "
+                 "username text, "
+                 "name text, "
+                 "active int default 1)")
+    conn.execute("insert into chat_search_new "
+                 "select chat_id, kws, cat_ids, "
+                 "case when trim(min_price) = '' then null else cast(min_price as real) end, "
+                 "case when trim(max_price) = '' then null else cast(max_price as real) end, "
+                 "case when trim(dist) = '' then null else cast(dist as integer) end, "
+                 "publish_date, ord, username, name, active from chat_search")
+    conn.execute("drop table chat_search")
+    conn.execute("alter table chat_search_new rename to chat_search")
+
+
+def indexes(conn):
+    # delete_items filtra por publishDate y cada barrido por active
+    conn.execute("create index if not exists idx_item_publish_date on item (publishDate)")
+    conn.execute("create index if not exists idx_chat_search_active on chat_search (active, chat_id)")
+
+
+def unique_chat_search(conn):
+    # Una sola fila por (chat_id, kws): se queda la activa o, si no hay, la más reciente
+    conn.execute("delete from chat_search where rowid not in "
+                 "(select coalesce(max(case when active = 1 then rowid end), max(rowid)) "
+                 "from chat_search group by chat_id, kws)")
+    conn.execute("create unique index if not exists idx_chat_search_chat_kws on chat_search (chat_id, kws)")
+
+
+def outbox(conn):
+    # Mensajes a Telegram pendientes de enviar
+    conn.execute("create table if not exists outbox "
+                 "(id integer primary key autoincrement, "
+                 "chatId text, "
+                 "text text, "
+                 "createdAt real, "
+                 "attempts integer default 0)")
+
+
+def search_state(conn):
+    # Último item visto por cada consulta, para leer solo lo nuevo
+    conn.execute("create table if not exists search_state "
+                 "(queryKey text primary key, "
+                 "lastItemId text, "
+                 "lastTs integer, "
+                 "lastFullScan real)")
+
+
+def item_last_seen(conn):
+    # Última vez que una búsqueda ha visto cada item, para caducar los que ya no salen
+    conn.execute("alter table item add column lastSeen real")
+    conn.execute("update item set lastSeen = cast(strftime('%s', 'now') as real)")
+    conn.execute("create index if not exists idx_item_last_seen on item (lastSeen)")
+    # Lápidas de los items caducados (hash de item y chat y último precio) para que no vuelvan como nuevos
+    conn.execute("create table if not exists item_tombstone "
+                 "(hash integer primary key, "
+                 "price integer, "
+                 "expiredAt real)")
+    conn.execute("create index if not exists idx_item_tombstone_expired on item_tombstone (expiredAt)")
+
+
+def sharding(conn):
+    # Procesos scraper vivos (latido) y qué consulta (clave json) hace cada uno
+    conn.execute("create table if not exists worker "
+                 "(workerId text primary key, "
+                 "role text, "
+                 "startedAt real, "
+                 "heartbeat real)")
+    conn.execute("create table if not exists search_assignment "
+                 "(queryKey text primary key, "
+                 "workerId text, "
+                 "assignedAt real)")
+    conn.execute("create index if not exists idx_search_assignment_worker on search_assignment (workerId)")
+
+
+def price_history(conn):
+    # Un punto por cambio de precio (sin rowid: los de un item van juntos en disco) y, por item, el primer
+    # precio, el mínimo y el último, con la consulta en la que se vio por primera vez
+    conn.execute("create table if not exists price_history "
+                 "(itemId text, "
+                 "ts real, "
+                 "cents integer, "
+                 "primary key (itemId, ts)) without rowid")
+    conn.execute("create table if not exists item_price "
+                 "(itemId text primary key, "
+                 "queryKey text, "
+                 "firstCents integer, "
+                 "firstTs real, "
+                 "minCents integer, "
+                 "lastCents integer, "
+                 "lastTs real, "
+                 "changes integer default 0)")
+    conn.execute("create index if not exists idx_item_price_query on item_price (queryKey, lastTs)")
+    conn.execute("create index if not exists idx_item_price_last on item_price (lastTs)")
+
+
+def search_percentile(conn):
+    # Búsquedas que solo avisan por debajo de un percentil de los precios de su consulta (/p25)
+    conn.execute("alter table chat_search add column max_percentile integer")
+
+
+MIGRATIONS = [
+    (1, ord_newest),
+    (2, typed_prices),
+    (3, indexes),
+    (4, unique_chat_search),
+    (5, outbox),
+    (6, search_state),
+    (7, item_last_seen),
+    (8, sharding),
+    (9, price_history),
+    (10, search_percentile),
+]
+
+
+def migrate(conn):
+    """Aplica las migraciones pendientes. Devuelve la versión final del esquema.
+
+    Varios procesos pueden arrancar a la vez sobre la misma db (bot y
+    scrapers): cada paso abre con ``begin immediate`` y vuelve a leer la
+    versión ya con el bloqueo, así el que ha esperado no repite lo que ha
+    aplicado otro (``typed_prices`` multiplicaría los precios otra vez).
+    """
+    current = conn.execute("pragma user_version").fetchone()[0]
+    for version, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            conn.execute("begin immediate")
+            current = conn.execute("pragma user_version").fetchone()[0]
+            if version > current:
+                migration(conn)
+                conn.execute("pragma user_version = %d" % version)
+                current = version
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return current
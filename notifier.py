@@ -0,0 +1,189 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from metrics import Histogram
+from ratelimit import KeyedRateLimit, TokenBucket
+
+NOTIFY_LATENCY = Histogram('wallbot_notification_latency_seconds',
+                           'Tiempo desde que se encola un mensaje hasta que Telegram lo acepta')
+
+
+class NotificationDispatcher:
+    """Cola de salida de mensajes a Telegram con workers propios.
+
+    El barrido solo encola: cada mensaje se guarda en la tabla ``outbox`` y se
+    borra cuando Telegram lo acepta, así que un reinicio no pierde alertas.
+    Respeta el límite global (~30 msg/s) y por chat (~1 msg/s) de Telegram,
+    el ``retry_after`` de los 429 y reintenta con backoff exponencial los
+    errores de red y 5xx.
+
+    Con varios procesos (ROLE=bot/scraper) los scrapers se crean con
+    ``workers=0``, así que solo guardan en ``outbox``, y el del bot lee cada
+    ``poll_interval`` segundos los pendientes de la tabla y encola los que no
+    tiene ya en cola. No vale quedarse con el id más alto leído: en PostgreSQL
+    el id se asigna al insertar, no al hacer commit, y un mensaje con id menor
+    puede aparecer después.
+    """
+
+    def __init__(self, db, http, url, workers=2, global_rate=30, chat_rate=1, max_retries=5, poll_interval=0):
+        self.db = db
+        self.http = http
+        self.url = url + "sendMessage"
+        self.workers = workers
+        self.max_retries = max_retries
+        self.poll_interval = poll_interval
+        # Ids de outbox en la cola o enviándose, para no encolarlos dos veces
+        self._queued = set()
+        self.global_limit = TokenBucket(global_rate)
+        self.chat_limit = KeyedRateLimit(chat_rate)
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        # Mensajes que quedaron pendientes en la última ejecución
+        pending = self._load()
+        if pending:
+            logging.info("Recuperados %d mensajes pendientes de enviar", pending)
+        for n in range(self.workers):
+            t = threading.Thread(target=self._worker, name='notifier-%d' % n, daemon=True)
+            t.start()
+            self._threads.append(t)
+        if self.poll_interval > 0:
+            t = threading.Thread(target=self._poller, name='notifier-poll', daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def _load(self):
+        """Encola los mensajes de la tabla outbox que aún no estén en cola. Devuelve cuántos"""
+        rows = self.db.get_outbox()
+        with self._cond:
+            rows = [row for row in rows if row[0] not in self._queued]
+            self._queued.update(row[0] for row in rows)
+        for row in rows:
+            self._push(*row)
+        return len(rows)
+
+    def _poller(self):
+        while not self._stop.wait(self.poll_interval):
+            self._load()
+
+    def enqueue(self, chat_id, text):
+        created_at = time.time()
+        outbox_id = self.db.add_outbox(chat_id, text, created_at)
+        # Sin workers propios lo envía el proceso que lee la tabla
+        if self.workers:
+            with self._cond:
+                self._queued.add(outbox_id)
+            self._push(outbox_id, chat_id, text, created_at, 0, 0.0)
+
+    def _push(self, outbox_id, chat_id, text, created_at, attempts, ready_at):
+        with self._cond:
+            heapq.heappush(self._heap, (ready_at, next(self._seq), outbox_id, chat_id, text, created_at, attempts))
+            self._cond.notify()
+
+    def _pop(self):
+        """Saca el siguiente mensaje listo para enviar, o None si hay que parar"""
+        with self._cond:
+            while not self._stop.is_set():
+                if self._heap:
+                    wait = self._heap[0][0] - time.time()
+                    if wait <= 0:
+                        return heapq.heappop(self._heap)
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+        return None
+
+    def _worker(self):
+        while True:
+            entry = self._pop()
+            if entry is None:
+                return
+            _, _, outbox_id, chat_id, text, created_at, attempts = entry
+            wait = self.chat_limit.reserve(chat_id)
+            if wait > 0:
+                self._push(outbox_id, chat_id, text, created_at, attempts, time.time() + wait)
+                continue
+            if not self.global_limit.acquire(self._stop):
+                self._push(outbox_id, chat_id, text, created_at, attempts, 0.0)
+                return
+            self._send(outbox_id, chat_id, text, created_at, attempts)
+
+    def _send(self, outbox_id, chat_id, text, created_at, attempts):
+        params = {'chat_id': chat_id, 'parse_mode': 'markdown', 'text': text}
+        retry_after = None
+        try:
+            response = self.http.get(self.url, endpoint='telegram', params=params)
+            status = response.status_code
+            if status == 200:
+                # Primero se borra de la tabla: si no, la siguiente lectura lo volvería a encolar
+                self.db.delete_outbox(outbox_id)
+                latency = time.time() - created_at
+                NOTIFY_LATENCY.observe(latency)
+                with self._cond:
+                    self._queued.discard(outbox_id)
+                    self.sent += 1
+                    self.latency_sum += latency
+                    self.latency_max = max(self.latency_max, latency)
+                return
+            if status == 429:
+                try:
+                    retry_after = response.json().get('parameters', {}).get('retry_after')
+                except ValueError:
+                    pass
+                retry_after = float(retry_after or 1)
+                self.chat_limit.delay(chat_id, retry_after)
+            elif status < 500:
+                # 400 (markdown mal formado), 403 (bot bloqueado)... reintentar no sirve
+                logging.error("Telegram rechaza el mensaje para %s: %s %s", chat_id, status, response.text)
+                self._drop(outbox_id)
+                return
+        except Exception as e:
+            logging.warning("Error enviando mensaje a %s: %s", chat_id, e)
+
+        attempts += 1
+        if attempts > self.max_retries:
+            logging.error("Descartado mensaje para %s tras %d intentos", chat_id, attempts)
+            self._drop(outbox_id)
+            return
+        backoff = retry_after if retry_after is not None else min(2 ** attempts, 300)
+        self.db.retry_outbox(outbox_id, attempts)
+        with self._cond:
+            self.retried += 1
+        self._push(outbox_id, chat_id, text, created_at, attempts, time.time() + backoff)
+
+    def _drop(self, outbox_id):
+        self.db.delete_outbox(outbox_id)
+        with self._cond:
+            self._queued.discard(outbox_id)
+            self.failed += 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                'queue_depth': len(self._heap),
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'latency_avg': self.latency_sum / self.sent if self.sent else 0.0,
+                'latency_max': self.latency_max,
+            }
+
+    def shutdown(self, timeout=5):
+        """Para los workers; lo que no se haya enviado sigue en la tabla outbox"""
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout)
@@ -0,0 +1,657 @@
+"""Almacenamiento en PostgreSQL (DATABASE_URL=postgresql://...).
+
+Con varios procesos scraper (ROLE=scraper) SQLite solo deja escribir a uno
+a la vez; PostgreSQL bloquea por fila. Mismos métodos y semántica que
+``DBHelper`` (ver ``storage.Storage``), con un pool de conexiones
+compartido por los hilos del proceso. El camino de los items
+(``save_items``) son tres sentencias por lote: ``insert ... on conflict do
+nothing returning`` para los nuevos, ``update ... from (values ...) where
+price > nuevo returning`` para las bajadas y ``insert ... on conflict do
+update`` para los vistos. Lo que devuelven es lo que ha ganado esta
+transacción, así que dos procesos con el mismo item no avisan dos veces.
+
+El esquema se crea ya en la última versión de ``migrations``; ``item.id``
+hace de rowid para recorrer la tabla por trozos.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import psycopg2
+    import psycopg2.pool
+    from psycopg2.extras import execute_values
+except ImportError:
+    psycopg2 = None
+
+from dbhelper import ChatSearch, Item, _as_text, pair_hash, timed
+from storage import SEARCH_COLUMNS, Storage, search_row
+
+SCHEMA = [
+    "create table if not exists item "
+    "(id bigserial unique, "
+    "itemId text, "
+    "chatId text, "
+    "title text, "
+    "price bigint, "
+    "url text, "
+    "\"user\" text, "
+    "publishDate bigint, "
+    "observaciones text, "
+    "item text, "
+    "lastSeen double precision, "
+    "primary key (itemId, chatId))",
+    "create index if not exists idx_item_publish_date on item (publishDate)",
+    "create index if not exists idx_item_last_seen on item (lastSeen)",
+
+    "create table if not exists chat_search "
+    "(chat_id text, "
+    "kws text, "
+    "cat_ids text, "
+    "min_price double precision, "
+    "max_price double precision, "
+    "dist integer default 400, "
+    "publish_date integer default 24, "
+    "ord text default 'newest', "
+    "username text, "
+    "name text, "
+    "active integer default 1, "
+    "max_percentile integer, "
+    "primary key (chat_id, kws))",
+    "alter table chat_search add column if not exists max_percentile integer",
+    "create index if not exists idx_chat_search_active on chat_search (active, chat_id)",
+
+    "create table if not exists seller "
+    "(userId text primary key, "
+    "reviewsCount integer, "
+    "averageRating double precision, "
+    "isTopProfile integer, "
+    "fetchedAt double precision)",
+
+    "create table if not exists outbox "
+    "(id bigserial primary key, "
+    "chatId text, "
+    "text text, "
+    "createdAt double precision, "
+    "attempts integer default 0)",
+
+    "create table if not exists search_state "
+    "(queryKey text primary key, "
+    "lastItemId text, "
+    "lastTs bigint, "
+    "lastFullScan double precision)",
+
+    "create table if not exists item_tombstone "
+    "(hash bigint primary key, "
+    "price bigint, "
+    "expiredAt double precision)",
+    "create index if not exists idx_item_tombstone_expired on item_tombstone (expiredAt)",
+
+    "create table if not exists worker "
+    "(workerId text primary key, "
+    "role text, "
+    "startedAt double precision, "
+    "heartbeat double precision)",
+
+    "create table if not exists search_assignment "
+    "(queryKey text primary key, "
+    "workerId text, "
+    "assignedAt double precision)",
+    "create index if not exists idx_search_assignment_worker on search_assignment (workerId)",
+
+    "create table if not exists price_history "
+    "(itemId text, "
+    "ts double precision, "
+    "cents bigint, "
+    "primary key (itemId, ts))",
+    "create table if not exists item_price "
+    "(id bigserial unique, "
+    "itemId text primary key, "
+    "queryKey text, "
+    "firstCents bigint, "
+    "firstTs double precision, "
+    "minCents bigint, "
+    "lastCents bigint, "
+    "lastTs double precision, "
+    "changes integer default 0)",
+    "alter table item_price add column if not exists id bigserial unique",
+    "create index if not exists idx_item_price_query on item_price (queryKey, lastTs)",
+    "create index if not exists idx_item_price_last on item_price (lastTs)",
+]
+
+ITEM_COLUMNS = "itemId, chatId, title, price, url, publishDate, observaciones, \"user\""
+
+
+def _text(value):
+    # Las claves son texto; psycopg2 pasaría un int como número y "text = integer" no existe
+    return None if value is None else str(value)
+
+
+def _number(value):
+    # En SQLite un filtro de precio no numérico se guardaba como texto; aquí se descarta
+    try:
+        return None if value is None else float(value)
+    except ValueError:
+        return None
+
+
+class PgHelper(Storage):
+    """Almacenamiento en PostgreSQL con un pool de hasta `maxconn` conexiones"""
+
+    def __init__(self, dsn, minconn=1, maxconn=10):
+        if psycopg2 is None:
+            raise RuntimeError('DATABASE_URL apunta a PostgreSQL pero falta psycopg2 (pip install psycopg2-binary)')
+        self.dsn = dsn
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn)
+        # ThreadedConnectionPool da error en vez de esperar cuando no quedan conexiones
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    @contextmanager
+    def _cursor(self):
+        """Cursor de una conexión del pool en una transacción: commit al salir o rollback si hay excepción"""
+        with self._slots:
+            conn = self.pool.getconn()
+            try:
+                with conn, conn.cursor() as cur:
+                    yield cur
+            finally:
+                # Si la conexión se ha caído el pool abre otra la próxima vez
+                self.pool.putconn(conn, close=bool(conn.closed))
+
+    def setup(self):
+        # Sin try, como en DBHelper: un proceso con el esquema a medias no debe arrancar
+        with self._cursor() as cur:
+            # Varios procesos arrancando a la vez: solo uno crea las tablas
+            cur.execute("select pg_advisory_xact_lock(hashtext('wallbot.setup'))")
+            for stmt in SCHEMA:
+                cur.execute(stmt)
+
+    def close(self):
+        self.pool.closeall()
+
+    @timed
+    def add_search(self, chat_search):
+        row = list(search_row(chat_search))
+        row[3], row[4] = _number(row[3]), _number(row[4])
+        stmt = "insert into chat_search (%s) values (%s) on conflict (chat_id, kws) do update set %s" % (
+            ", ".join(SEARCH_COLUMNS), ", ".join(["%s"] * len(SEARCH_COLUMNS)),
+            ", ".join("%s = excluded.%s" % (col, col) for col in SEARCH_COLUMNS[2:]))
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, row)
+        except Exception as e:
+            print(e)
+
+    @timed
+    def add_item(self, item_id, chat_id, title, price, url, user, publish_date=None, observaciones=None):
+        stmt = "insert into item (itemId, chatId, title, price, url, \"user\", publishDate, observaciones) " \
+               "values (%s, %s, %s, %s, %s, %s, %s, %s)"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (_text(item_id), _text(chat_id), title, price, url, user, publish_date,
+                                   observaciones))
+        except Exception as e:
+            print(e)
+
+    @timed
+    def update_item(self, item_id, price, obs, chat_id):
+        stmt = "update item set price = %s, observaciones = %s where itemId = %s and chatId = %s"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (price, obs, _text(item_id), _text(chat_id)))
+        except Exception as e:
+            print(e)
+
+    @timed
+    def delete_items(self, hours_live):
+        millis = int(round(time.time() * 1000))
+        millis -= hours_live*60*60*1000
+        try:
+            with self._cursor() as cur:
+                cur.execute("delete from item where publishDate < %s", (millis, ))
+        except Exception as e:
+            print(e)
+
+    @timed
+    def search_item(self, item_id, chat_id):
+        stmt = "select " + ITEM_COLUMNS + " from item where itemId = %s and chatId = %s"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (_text(item_id), _text(chat_id)))
+                row = cur.fetchone()
+            if row is not None:
+                return Item(*row)
+        except Exception as e:
+            print(e)
+        return None
+
+    @timed
+    def search_items(self, item_ids, chat_id):
+        """Busca de una vez varios items de un chat. Devuelve {str(itemId): Item}"""
+        stmt = "select " + ITEM_COLUMNS + " from item where chatId = %s and itemId = any(%s)"
+        found = {}
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (_text(chat_id), [str(item_id) for item_id in item_ids]))
+                for row in cur:
+                    found[row[0]] = Item(*row)
+        except Exception as e:
+            print(e)
+        return found
+
+    @timed
+    def save_items(self, new_items, updates, seen=(), now=None, prices=()):
+        """Inserta items nuevos y actualiza precios en una única transacción (ver Storage.save_items)"""
+        if not new_items and not updates and not seen and not prices:
+            return set()
+        now = now or time.time()
+        # Siempre en el mismo orden, para que dos procesos con filas en común no se bloqueen entre sí
+        new_items = sorted({(_text(r[0]), _text(r[1])): (_text(r[0]), _text(r[1])) + tuple(r[2:]) + (now, )
+                            for r in new_items}.items())
+        seen = sorted({(_text(r[0]), _text(r[1])): (_text(r[0]), _text(r[1])) + tuple(r[2:]) + (now, )
+                       for r in seen}.items())
+        updates = sorted(((_text(item_id), _text(chat_id)), (price, obs, _text(item_id), _text(chat_id), now))
+                         for price, obs, item_id, chat_id in updates)
+        # Un upsert por lotes no puede tocar dos veces la misma fila
+        prices = sorted({_text(item_id): (_text(item_id), query_key, cents, now, cents, cents, now)
+                         for item_id, query_key, cents in prices}.items())
+        claimed = set()
+        try:
+            with self._cursor() as cur:
+                if seen:
+                    execute_values(cur, "insert into item (itemId, chatId, title, price, url, \"user\", lastSeen) "
+                                        "values %s on conflict (itemId, chatId) "
+                                        "do update set lastSeen = excluded.lastSeen",
+                                   [row for _, row in seen])
+                if new_items:
+                    rows = execute_values(cur, "insert into item (itemId, chatId, title, price, url, \"user\", "
+                                               "lastSeen) values %s on conflict do nothing returning itemId, chatId",
+                                          [row for _, row in new_items], fetch=True)
+                    claimed.update(rows)
+                if updates:
+                    rows = execute_values(cur, "update item set price = v.price, observaciones = v.obs, "
+                                               "lastSeen = v.seen from (values %s) as v (price, obs, itemId, chatId, "
+                                               "seen) where item.itemId = v.itemId and item.chatId = v.chatId "
+                                               "and item.price > v.price returning item.itemId, item.chatId",
+                                          [row for _, row in updates], fetch=True,
+                                          template="(%s::bigint, %s::text, %s::text, %s::text, "
+                                                   "%s::double precision)")
+                    claimed.update(rows)
+                if prices:
+                    # Sin cambio de precio el upsert no devuelve la fila y no hay punto nuevo
+                    rows = execute_values(cur, "insert into item_price (itemId, queryKey, firstCents, firstTs, "
+                                               "minCents, lastCents, lastTs) values %s on conflict (itemId) do update "
+                                               "set minCents = least(item_price.minCents, excluded.lastCents), "
+                                               "lastCents = excluded.lastCents, lastTs = excluded.lastTs, "
+                                               "changes = item_price.changes + 1 "
+                                               "where item_price.lastCents <> excluded.lastCents "
+                                               "returning itemId, lastCents",
+                                          [row for _, row in prices], fetch=True)
+                    if rows:
+                        execute_values(cur, "insert into price_history (itemId, ts, cents) values %s "
+                                            "on conflict do nothing", [(item_id, now, cents) for item_id, cents in rows])
+            return claimed
+        except Exception as e:
+            print(e)
+        return None
+
+    @timed
+    def find_item(self, chat_id, ref):
+        stmt = "select " + ITEM_COLUMNS + " from item where chatId = %s and (itemId = %s or url = %s)"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (_text(chat_id), _text(ref), _text(ref)))
+                row = cur.fetchone()
+            if row is not None:
+                return Item(*row)
+        except Exception as e:
+            print(e)
+        return None
+
+    @timed
+    def get_item_prices(self, limit):
+        stmt = "select itemId, chatId, price, lastSeen from item order by id desc limit %s"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (limit, ))
+                return cur.fetchall()
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def get_item_pairs(self, after_rowid, limit):
+        stmt = "select id, itemId, chatId from item where id > %s order by id limit %s"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (after_rowid, limit))
+                return cur.fetchall()
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def count_items(self):
+        try:
+            with self._cursor() as cur:
+                cur.execute("select count(*) from item")
+                return cur.fetchone()[0]
+        except Exception as e:
+            print(e)
+        return 0
+
+    @timed
+    def expire_items(self, cutoff, limit, now=None):
+        now = now or time.time()
+        # skip locked: si hay otro proceso caducando a la vez, cada uno se lleva filas distintas
+        stmt = "delete from item where id in " \
+               "(select id from item where lastSeen < %s limit %s for update skip locked) " \
+               "returning itemId, chatId, price"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (cutoff, limit))
+                rows = cur.fetchall()
+                expired = [(item_id, chat_id, pair_hash(item_id, chat_id)) for item_id, chat_id, _ in rows]
+                if rows:
+                    execute_values(cur, "insert into item_tombstone (hash, price, expiredAt) values %s "
+                                        "on conflict (hash) do update set price = excluded.price, "
+                                        "expiredAt = excluded.expiredAt",
+                                   list({h: (h, row[2], now) for row, (_, _, h) in zip(rows, expired)}.values()))
+            return expired
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def expire_tombstones(self, cutoff, limit):
+        stmt = "delete from item_tombstone where hash in " \
+               "(select hash from item_tombstone where expiredAt < %s limit %s)"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (cutoff, limit))
+                return cur.rowcount
+        except Exception as e:
+            print(e)
+        return 0
+
+    @timed
+    def get_tombstone_hashes(self):
+        try:
+            with self._cursor() as cur:
+                cur.execute("select hash from item_tombstone")
+                return [row[0] for row in cur]
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def get_tombstones(self, hashes):
+        try:
+            with self._cursor() as cur:
+                cur.execute("select hash, price from item_tombstone where hash = any(%s)", (list(hashes), ))
+                return dict(cur.fetchall())
+        except Exception as e:
+            print(e)
+        return {}
+
+    @timed
+    def get_price_history(self, item_id, limit=50):
+        stmt = "select ts, cents from price_history where itemId = %s order by ts desc limit %s"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (_text(item_id), limit))
+                return cur.fetchall()[::-1]
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def get_item_price(self, item_id):
+        stmt = "select queryKey, firstCents, firstTs, minCents, lastCents, lastTs, changes from item_price " \
+               "where itemId = %s"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (_text(item_id), ))
+                return cur.fetchone()
+        except Exception as e:
+            print(e)
+        return None
+
+    @timed
+    def get_search_prices(self, query_key, limit):
+        stmt = "select itemId, lastCents from item_price where queryKey = %s order by lastTs desc limit %s"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (query_key, limit))
+                return cur.fetchall()
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def get_price_series(self, query_key, since=0):
+        stmt = "select id, firstTs, firstCents, lastCents, lastTs from item_price where queryKey = %s and lastTs >= %s"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (query_key, since))
+                return cur.fetchall()
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def expire_price_history(self, cutoff, limit):
+        stmt = "delete from item_price where itemId in " \
+               "(select itemId from item_price where lastTs < %s " \
+               "and not exists (select 1 from item where item.itemId = item_price.itemId) limit %s) " \
+               "returning itemId"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (cutoff, limit))
+                ids = [row[0] for row in cur.fetchall()]
+                if ids:
+                    cur.execute("delete from price_history where itemId = any(%s)", (ids, ))
+                return len(ids)
+        except Exception as e:
+            print(e)
+        return 0
+
+    def compact(self, pages=1000):
+        # De esto se encarga el autovacuum de PostgreSQL
+        return None
+
+    @timed
+    def get_chat_searchs(self, chat_id):
+        return self._get_searchs("where chat_id = %s and active = 1", (_text(chat_id), ))
+
+    @timed
+    def get_chats_searchs(self):
+        return self._get_searchs("where active = 1", ())
+
+    def _get_searchs(self, where, args):
+        stmt = "select chat_id, kws, cat_ids, min_price, max_price, dist, publish_date, ord, max_percentile " \
+               "from chat_search " + where
+        lista = []
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, args)
+                rows = cur.fetchall()
+            for row in rows:
+                lista.append(ChatSearch(row[0], row[1], row[2], _as_text(row[3]), _as_text(row[4]),
+                                        _as_text(row[5]), row[6], row[7], max_percentile=row[8]))
+        except Exception as e:
+            print(e)
+        return lista
+
+    @timed
+    def del_chat_search(self, chat_id, kws):
+        try:
+            with self._cursor() as cur:
+                cur.execute("update chat_search set active = 0 where chat_id = %s and kws = %s",
+                            (_text(chat_id), kws))
+        except Exception as e:
+            print(e)
+
+    @timed
+    def set_search_percentile(self, chat_id, kws, percentile):
+        stmt = "update chat_search set max_percentile = %s where chat_id = %s and kws = %s and active = 1"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (percentile, _text(chat_id), kws))
+                return cur.rowcount > 0
+        except Exception as e:
+            print(e)
+        return False
+
+    @timed
+    def get_seller(self, user_id):
+        stmt = "select fetchedAt, reviewsCount, averageRating, isTopProfile from seller where userId = %s"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (_text(user_id), ))
+                row = cur.fetchone()
+            if row is not None:
+                info = {'reviews_count': row[1], 'is_top_profile': bool(row[3])}
+                if row[2] is not None:
+                    info['average_rating'] = row[2]
+                return row[0], info
+        except Exception as e:
+            print(e)
+        return None
+
+    @timed
+    def save_seller(self, user_id, info, fetched_at):
+        stmt = "insert into seller (userId, reviewsCount, averageRating, isTopProfile, fetchedAt) " \
+               "values (%s, %s, %s, %s, %s) on conflict (userId) do update set " \
+               "reviewsCount = excluded.reviewsCount, averageRating = excluded.averageRating, " \
+               "isTopProfile = excluded.isTopProfile, fetchedAt = excluded.fetchedAt"
+        args = (_text(user_id), info.get('reviews_count', 0), info.get('average_rating'),
+                int(bool(info.get('is_top_profile'))), fetched_at)
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, args)
+        except Exception as e:
+            print(e)
+
+    @timed
+    def add_outbox(self, chat_id, text, created_at):
+        stmt = "insert into outbox (chatId, text, createdAt) values (%s, %s, %s) returning id"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (_text(chat_id), text, created_at))
+                return cur.fetchone()[0]
+        except Exception as e:
+            print(e)
+        return None
+
+    @timed
+    def get_outbox(self):
+        """Mensajes pendientes: tuplas (id, chat_id, text, created_at, attempts, 0.0)"""
+        stmt = "select id, chatId, text, createdAt, attempts from outbox order by id"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt)
+                return [row + (0.0, ) for row in cur]
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def delete_outbox(self, outbox_id):
+        try:
+            with self._cursor() as cur:
+                cur.execute("delete from outbox where id = %s", (outbox_id, ))
+        except Exception as e:
+            print(e)
+
+    @timed
+    def retry_outbox(self, outbox_id, attempts):
+        try:
+            with self._cursor() as cur:
+                cur.execute("update outbox set attempts = %s where id = %s", (attempts, outbox_id))
+        except Exception as e:
+            print(e)
+
+    @timed
+    def get_search_state(self, query_key):
+        stmt = "select lastItemId, lastTs, lastFullScan from search_state where queryKey = %s"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (query_key, ))
+                return cur.fetchone()
+        except Exception as e:
+            print(e)
+        return None
+
+    @timed
+    def save_search_state(self, query_key, last_item_id, last_ts, last_full_scan):
+        stmt = "insert into search_state (queryKey, lastItemId, lastTs, lastFullScan) values (%s, %s, %s, %s) " \
+               "on conflict (queryKey) do update set lastItemId = excluded.lastItemId, " \
+               "lastTs = excluded.lastTs, lastFullScan = excluded.lastFullScan"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (query_key, _text(last_item_id), last_ts, last_full_scan))
+        except Exception as e:
+            print(e)
+
+    @timed
+    def heartbeat_worker(self, worker_id, role, now):
+        stmt = "insert into worker (workerId, role, startedAt, heartbeat) values (%s, %s, %s, %s) " \
+               "on conflict (workerId) do update set heartbeat = excluded.heartbeat"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (worker_id, role, now, now))
+        except Exception as e:
+            print(e)
+
+    @timed
+    def get_workers(self, alive_since, role='scraper'):
+        stmt = "select workerId from worker where role = %s and heartbeat >= %s order by workerId"
+        try:
+            with self._cursor() as cur:
+                cur.execute(stmt, (role, alive_since))
+                return [row[0] for row in cur]
+        except Exception as e:
+            print(e)
+        return []
+
+    @timed
+    def delete_workers(self, before=None, worker_id=None):
+        try:
+            with self._cursor() as cur:
+                if worker_id is not None:
+                    cur.execute("delete from worker where workerId = %s", (worker_id, ))
+                else:
+                    cur.execute("delete from worker where heartbeat < %s", (before, ))
+        except Exception as e:
+            print(e)
+
+    @timed
+    def get_assignments(self, worker_id=None):
+        try:
+            with self._cursor() as cur:
+                if worker_id is None:
+                    cur.execute("select queryKey, workerId from search_assignment")
+                else:
+                    cur.execute("select queryKey, workerId from search_assignment where workerId = %s",
+                                (worker_id, ))
+                return dict(cur.fetchall())
+        except Exception as e:
+            print(e)
+        return None
+
+    @timed
+    def save_assignments(self, assigned, removed, now):
+        try:
+            with self._cursor() as cur:
+                if assigned:
+                    execute_values(cur, "insert into search_assignment (queryKey, workerId, assignedAt) values %s "
+                                        "on conflict (queryKey) do update set workerId = excluded.workerId, "
+                                        "assignedAt = excluded.assignedAt",
+                                   [(key, worker, now) for key, worker in assigned])
+                if removed:
+                    cur.execute("delete from search_assignment where queryKey = any(%s)", (list(removed), ))
+            return True
+        except Exception as e:
+            print(e)
+        return False
@@ -0,0 +1,319 @@
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from itertools import chain
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DAY = 24 * 60 * 60
+PERCENTILES = (10, 25, 50, 75, 90)
+# Columnas de las tablas de MarketStats, en el orden de get_price_series
+ID, FIRST_TS, FIRST_CENTS, LAST_CENTS, LAST_TS = range(5)
+
+
+class RollingPrices:
+    """Mediana de los últimos precios de cada consulta, para puntuar chollos.
+
+    Por consulta guarda los `window` items vistos más recientemente (un precio
+    por item) y los mismos precios ordenados, así que añadir uno y sacar la
+    mediana no recorre nada. La primera vez que se usa una consulta se carga
+    de ``item_price``, para no empezar de cero tras reiniciar.
+    """
+
+    def __init__(self, db, window=200, min_samples=10):
+        self.db = db
+        self.window = window
+        self.min_samples = min_samples
+        self._items = {}
+        self._sorted = {}
+        self._lock = threading.Lock()
+
+    def _load(self, key):
+        # Sin el lock: es una consulta a la db; si dos hilos cargan a la vez se queda la primera
+        rows = self.db.get_search_prices(key, self.window)
+        items = OrderedDict((str(item_id), cents) for item_id, cents in reversed(rows) if cents is not None)
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = items
+                self._sorted[key] = sorted(items.values())
+
+    def add(self, key, item_id, cents):
+        if key not in self._items:
+            self._load(key)
+        item_id = str(item_id)
+        with self._lock:
+            items, prices = self._items[key], self._sorted[key]
+            old = items.pop(item_id, None)
+            if old is not None:
+                del prices[bisect_left(prices, old)]
+            items[item_id] = cents
+            insort(prices, cents)
+            if len(items) > self.window:
+                _, oldest = items.popitem(last=False)
+                del prices[bisect_left(prices, oldest)]
+
+    def median(self, key):
+        """Mediana en céntimos, o None si la consulta aún no tiene `min_samples` precios"""
+        if key not in self._items:
+            self._load(key)
+        with self._lock:
+            prices = self._sorted[key]
+            n = len(prices)
+            if n < max(self.min_samples, 1):
+                return None
+            return prices[n // 2] if n % 2 else (prices[n // 2 - 1] + prices[n // 2]) / 2
+
+    def score(self, key, cents):
+        """(fracción por debajo de la mediana, mediana): 0.3 es un 30% más barato. None sin mediana"""
+        median = self.median(key)
+        if not median:
+            return None
+        return (median - cents) / median, median
+
+    def stats(self):
+        with self._lock:
+            return {
+                'searches': len(self._items),
+                'prices': sum(len(items) for items in self._items.values()),
+            }
+
+
+def _quantiles(values, qs):
+    """Percentiles de un array ya ordenado, con la interpolación lineal de np.percentile"""
+    pos = np.asarray(qs, dtype=np.float64) / 100 * (len(values) - 1)
+    lo = pos.astype(np.int64)
+    hi = np.minimum(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+class _Series:
+    """Filas de item_price de una consulta, ordenadas por id, y lo calculado con ellas.
+
+    Las filas van en un buffer con hueco al final, así una página de precios
+    nuevos se añade sin copiar la tabla entera.
+    """
+
+    def __init__(self, table, now):
+        self._buf = table[np.argsort(table[:, ID], kind='stable')]
+        self.size = len(table)
+        self.until = float(table[:, LAST_TS].max()) if len(table) else 0.0
+        self.loaded = now
+        self.checked = now
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.clean = None
+        self.distribution = None
+        self.summary = None
+        self.cuts = {}
+
+    @property
+    def table(self):
+        return self._buf[:self.size]
+
+    def append(self, rows):
+        if self.size + len(rows) > len(self._buf):
+            buf = np.empty((max(2 * len(self._buf), self.size + len(rows)), 5))
+            buf[:self.size] = self.table
+            self._buf = buf
+        # Los ids de item_price crecen: casi siempre basta con añadir al final
+        unsorted = self.size and rows[0, ID] < self._buf[self.size - 1, ID]
+        self._buf[self.size:self.size + len(rows)] = rows
+        self.size += len(rows)
+        if unsorted:
+            self._buf[:self.size] = self.table[np.argsort(self.table[:, ID], kind='stable')]
+
+
+class MarketStats:
+    """Percentiles, bandas de atípicos y tendencia de los precios de cada consulta (/stats y /p25).
+
+    Los precios salen de ``item_price`` (una fila por item, con su primer y
+    su último precio) y se guardan por consulta en un array de NumPy de
+    (id, firstTs, firstCents, lastCents, lastTs). La primera vez se lee la
+    consulta entera; después solo las filas con ``lastTs`` desde la última
+    lectura, que sustituyen por id a las que ya estaban. ``invalidate`` (al
+    guardar items de la consulta) hace que se relean en la siguiente
+    petición; sin invalidar, como mucho cada `check_interval` segundos, para
+    ver lo que guardan otros procesos. Cada `max_age` segundos se lee entera
+    otra vez porque la retención borra filas. Lo calculado se guarda hasta
+    que cambia algún precio, y ``percentile`` (en cada página con /p25) no
+    calcula la tendencia, solo ``summary`` (/stats).
+
+    Los percentiles y la tendencia se calculan sin los atípicos, los precios
+    fuera de [Q1 - 1,5·IQR, Q3 + 1,5·IQR] (el "1 €" de quien quiere que le
+    escriban o el "99.999 €" de quien no quiere vender).
+    """
+
+    # Solapamiento al releer: lastTs se apunta antes del commit
+    OVERLAP = 60
+
+    def __init__(self, db, min_samples=20, trend_days=90, check_interval=60, max_age=3600, maxsize=256):
+        if np is None:
+            raise RuntimeError('Las estadísticas de mercado necesitan numpy (pip install numpy)')
+        self.db = db
+        self.min_samples = min_samples
+        self.trend_days = trend_days
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self.maxsize = maxsize
+        self._series = OrderedDict()
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.refreshes = 0
+        self.computes = 0
+
+    @staticmethod
+    def _table(rows):
+        # Sin pasar por una lista de arrays: un solo fromiter sobre todas las columnas
+        flat = np.fromiter(chain.from_iterable(rows), dtype=np.float64, count=len(rows) * 5)
+        return flat.reshape(len(rows), 5)
+
+    def invalidate(self, key):
+        """Hay precios nuevos de la consulta: se releen en la siguiente petición"""
+        with self._lock:
+            series = self._series.get(key)
+        if series is not None:
+            series.dirty = True
+
+    def _get(self, key, now):
+        with self._lock:
+            series = self._series.get(key)
+            if series is not None:
+                self._series.move_to_end(key)
+        if series is not None and not series.dirty and now - series.checked < self.check_interval \
+                and now - series.loaded < self.max_age:
+            return series
+        if series is None or now - series.loaded >= self.max_age:
+            series = _Series(self._table(self.db.get_price_series(key)), now)
+            with self._lock:
+                self.loads += 1
+                self._series[key] = series
+                while len(self._series) > self.maxsize:
+                    self._series.popitem(last=False)
+            return series
+        with series.lock:
+            if series.dirty or now - series.checked >= self.check_interval:
+                series.dirty = False
+                series.checked = now
+                self._merge(series, self._table(self.db.get_price_series(key, series.until - self.OVERLAP)))
+        return series
+
+    def _merge(self, series, new):
+        if not len(new):
+            return
+        new = new[np.argsort(new[:, ID])]
+        # Antes de quitar las ya conocidas: una bajada trae solo filas que ya estaban
+        series.until = max(series.until, float(new[:, LAST_TS].max()))
+        table = series.table
+        if len(table):
+            # Filas que ya estaban: por búsqueda binaria en los ids ordenados
+            pos = np.minimum(np.searchsorted(table[:, ID], new[:, ID]), len(table) - 1)
+            found = table[pos, ID] == new[:, ID]
+            changed = found & (table[pos] != new).any(axis=1)
+            if not changed.any() and found.all():
+                # Solo el solapamiento: nada ha cambiado
+                return
+            table[pos[changed]] = new[changed]
+            new = new[~found]
+        if len(new):
+            series.append(new)
+        series.reset()
+        with self._lock:
+            self.refreshes += 1
+
+    def _distribute(self, series):
+        """Percentiles y bandas de atípicos; deja en series.clean los precios sin atípicos, ordenados"""
+        table = series.table
+        distribution = {'count': len(table), 'updated': series.until}
+        if len(table) >= max(self.min_samples, 1):
+            # Una sola ordenación: cuartiles, bandas y percentiles salen de indexar el array ordenado
+            prices = np.sort(table[:, LAST_CENTS])
+            q1, q3 = _quantiles(prices, (25, 75))
+            low, high = max(q1 - 1.5 * (q3 - q1), 0.0), q3 + 1.5 * (q3 - q1)
+            clean = prices[np.searchsorted(prices, low, 'left'):np.searchsorted(prices, high, 'right')]
+            distribution.update({
+                'outliers': len(prices) - len(clean),
+                'low': float(low),
+                'high': float(high),
+                'mean': float(clean.mean()),
+                'percentiles': dict(zip(PERCENTILES, (float(x) for x in _quantiles(clean, PERCENTILES)))),
+            })
+            series.clean = clean
+        series.distribution = distribution
+        with self._lock:
+            self.computes += 1
+
+    def _trend(self, series, now):
+        """Cambio de precio en 30 días y mediana por semana de los publicados en los últimos trend_days"""
+        distribution = series.distribution
+        low, high, median = distribution['low'], distribution['high'], distribution['percentiles'][50]
+        table = series.table
+        ts, first = table[:, FIRST_TS], table[:, FIRST_CENTS]
+        recent = (ts >= now - self.trend_days * DAY) & (first >= low) & (first <= high)
+        ts, first = ts[recent], first[recent]
+        if len(ts) < self.min_samples or ts.max() - ts.min() < DAY or median <= 0:
+            return {}
+        # Mínimos cuadrados sin polyfit: pendiente = cov(x, y) / var(x), en céntimos por día
+        days = (ts - now) / DAY
+        days -= days.mean()
+        slope = days @ (first - first.mean()) / (days @ days)
+        # Semana (0 = la última) y precio en un solo float (exacto, son enteros) para ordenar una vez
+        # en vez de lexsort; la mediana de cada tramo sale por índice
+        span = high + 1
+        keys = np.sort((now - ts) // (7 * DAY) * span + first)
+        weeks = keys // span
+        first = keys - weeks * span
+        labels, starts, counts = np.unique(weeks, return_index=True, return_counts=True)
+        medians = (first[starts + (counts - 1) // 2] + first[starts + counts // 2]) / 2
+        return {
+            'trend_30d': float(slope * 30 / median),
+            'weeks': [(int(w), float(m), int(c)) for w, m, c in zip(labels, medians, counts)],
+        }
+
+    def summary(self, key, now=None):
+        """Resumen de la consulta en céntimos.
+
+        Siempre count y updated; con `min_samples` precios o más, outliers,
+        low/high (bandas de atípicos), mean y percentiles {10, 25, 50, 75, 90};
+        si además hay bastantes publicados en los últimos trend_days,
+        trend_30d (cambio en 30 días como fracción de la mediana) y weeks
+        [(semanas atrás, mediana, items)].
+        """
+        now = now or time.time()
+        series = self._get(key, now)
+        with series.lock:
+            if series.summary is None:
+                if series.distribution is None:
+                    self._distribute(series)
+                series.summary = dict(series.distribution)
+                if series.clean is not None:
+                    series.summary.update(self._trend(series, now))
+            return series.summary
+
+    def percentile(self, key, q, now=None):
+        """Percentil `q` (sin atípicos) en céntimos, o None si la consulta aún no tiene `min_samples` precios"""
+        series = self._get(key, now or time.time())
+        with series.lock:
+            if series.distribution is None:
+                self._distribute(series)
+            if series.clean is None:
+                return None
+            if q not in series.cuts:
+                series.cuts[q] = float(_quantiles(series.clean, (q, ))[0])
+            return series.cuts[q]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'searches': len(self._series),
+                'rows': sum(series.size for series in self._series.values()),
+                'loads': self.loads,
+                'refreshes': self.refreshes,
+                'computes': self.computes,
+            }
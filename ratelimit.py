@@ -0,0 +1,173 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Token bucket: ``rate`` peticiones por segundo con ráfagas de hasta ``capacity``"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.waited = 0.0
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        """Coge un token si hay. Si no, devuelve los segundos que faltan para el siguiente"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, stop=None):
+        """Espera hasta tener un token. Devuelve False si ``stop`` (threading.Event) se activa antes"""
+        start = time.monotonic()
+        while True:
+            wait = self.try_acquire()
+            if wait == 0.0:
+                with self._lock:
+                    self.acquired += 1
+                    self.waited += time.monotonic() - start
+                return True
+            if stop is None:
+                time.sleep(wait)
+            elif stop.wait(wait):
+                return False
+
+    def stats(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                'rate': self.rate,
+                'tokens': self._tokens,
+                'acquired': self.acquired,
+                'waited': self.waited,
+            }
+
+
+class KeyedRateLimit:
+    """Intervalo mínimo entre usos de una misma clave (p.ej. 1 mensaje por segundo y chat)"""
+
+    MAX_KEYS = 10000
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, key):
+        """Reserva el siguiente hueco de la clave. Devuelve 0 si es ya, o los segundos que faltan"""
+        with self._lock:
+            now = time.monotonic()
+            ready = self._next.get(key, 0.0)
+            if ready > now:
+                return ready - now
+            self._next[key] = now + self.interval
+            if len(self._next) > self.MAX_KEYS:
+                self._prune(now)
+            return 0.0
+
+    def delay(self, key, seconds):
+        """Bloquea la clave durante ``seconds`` (p.ej. el retry_after de un 429)"""
+        with self._lock:
+            self._next[key] = max(self._next.get(key, 0.0), time.monotonic() + seconds)
+
+    def _prune(self, now):
+        # Olvida las claves que ya no tienen espera pendiente
+        for key in [k for k, t in self._next.items() if t <= now]:
+            del self._next[key]
+
+
+class CircuitOpenError(Exception):
+    """El circuito está abierto: no se hacen peticiones hasta que pase la espera"""
+
+
+class CircuitBreaker:
+    """Corta las peticiones a un servicio que está fallando o limitándonos.
+
+    Tras ``threshold`` respuestas malas seguidas (403, 429, 5xx o error de red)
+    se abre durante ``cooldown`` segundos; después deja pasar una sola
+    petición de prueba (semiabierto). Si la prueba va bien se cierra, y si
+    falla se vuelve a abrir con el doble de espera, hasta ``max_cooldown``.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    BAD_STATUS = (403, 429)
+
+    def __init__(self, threshold=5, cooldown=30, max_cooldown=900):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opens = 0
+        self._current_cooldown = cooldown
+        self._open_until = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def is_bad(self, status):
+        return status in self.BAD_STATUS or status >= 500
+
+    def before_request(self):
+        """Lanza CircuitOpenError si no se puede hacer la petición ahora"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() < self._open_until:
+                    raise CircuitOpenError("circuito abierto %.0fs más" % (self._open_until - time.monotonic()))
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    raise CircuitOpenError("circuito semiabierto, esperando la petición de prueba")
+                self._probing = True
+
+    def record(self, status=None):
+        """Apunta el resultado de una petición: su código HTTP, o None si falló la conexión"""
+        with self._lock:
+            if status is not None and not self.is_bad(status):
+                self.state = self.CLOSED
+                self.failures = 0
+                self._probing = False
+                self._current_cooldown = self.cooldown
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self._current_cooldown = min(self._current_cooldown * 2, self.max_cooldown)
+                self._open()
+            elif self.state == self.CLOSED and self.failures >= self.threshold:
+                self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opens += 1
+        self._probing = False
+        self._open_until = time.monotonic() + self._current_cooldown
+
+    def retry_in(self):
+        """Segundos hasta que se pueda volver a probar (0 si no está abierto)"""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self._open_until - time.monotonic())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'opens': self.opens,
+                'cooldown': self._current_cooldown,
+            }
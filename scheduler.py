@@ -0,0 +1,124 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+class SearchState:
+    __slots__ = ('key', 'interval', 'next_run', 'last_run', 'runs', 'hits')
+
+    def __init__(self, key, interval, next_run):
+        self.key = key
+        self.interval = interval
+        self.next_run = next_run
+        self.last_run = None
+        self.runs = 0
+        self.hits = 0
+
+
+class SearchScheduler:
+    """Planificador de búsquedas con una próxima ejecución propia para cada una.
+
+    El intervalo de cada búsqueda se adapta a lo que encuentra: se reduce a la
+    mitad cuando trae novedades y crece un 25% cuando no, siempre entre
+    ``min_interval`` y ``max_interval``. Cada ejecución lleva un ``jitter``
+    aleatorio y, al arrancar, las búsquedas se reparten a lo largo del
+    intervalo base para no lanzarlas todas a la vez.
+    """
+
+    SPEED_UP = 0.5
+    SLOW_DOWN = 1.25
+
+    def __init__(self, base_interval=300, min_interval=60, max_interval=1800, jitter=0.1):
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self._states = {}
+        # Solo el primer sync reparte: si el bot arranca sin búsquedas, las que lleguen después van ya
+        self._started = False
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def _schedule(self, state, when):
+        state.next_run = when
+        heapq.heappush(self._heap, (when, next(self._seq), state.key))
+
+    def _jittered(self, interval):
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def sync(self, keys):
+        """Da de alta las búsquedas nuevas y olvida las que ya no están activas"""
+        now = time.time()
+        keys = set(keys)
+        with self._lock:
+            startup = not self._started
+            self._started = True
+            for key in keys - self._states.keys():
+                state = SearchState(key, self.base_interval, now)
+                self._states[key] = state
+                # Al arrancar se reparten en el intervalo base; las que se añaden después van ya
+                self._schedule(state, now + random.uniform(0, self.base_interval) if startup else now)
+            for key in self._states.keys() - keys:
+                del self._states[key]
+
+    def due(self):
+        """Búsquedas a las que les toca ejecutarse. Quedan fuera de la cola hasta llamar a ``done``"""
+        now = time.time()
+        keys = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                when, _, key = heapq.heappop(self._heap)
+                state = self._states.get(key)
+                # Entradas de búsquedas borradas o reprogramadas
+                if state is None or state.next_run != when:
+                    continue
+                state.next_run = None
+                keys.append(key)
+        return keys
+
+    def done(self, key, hits):
+        """Registra el resultado de una ejecución y programa la siguiente"""
+        now = time.time()
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                return
+            state.runs += 1
+            state.hits += hits
+            state.last_run = now
+            factor = self.SPEED_UP if hits > 0 else self.SLOW_DOWN
+            state.interval = min(self.max_interval, max(self.min_interval, state.interval * factor))
+            self._schedule(state, now + self._jittered(state.interval))
+
+    def shortest_interval(self):
+        """Intervalo (con el jitter máximo) de la búsqueda más frecuente, o 0 sin búsquedas"""
+        with self._lock:
+            intervals = [s.interval for s in self._states.values()]
+        return min(intervals) * (1 + self.jitter) if intervals else 0
+
+    def next_wakeup(self):
+        """Segundos hasta la próxima búsqueda programada"""
+        with self._lock:
+            while self._heap:
+                when, _, key = self._heap[0]
+                state = self._states.get(key)
+                if state is not None and state.next_run == when:
+                    return max(0.0, when - time.time())
+                heapq.heappop(self._heap)
+        return float(self.base_interval)
+
+    def snapshot(self):
+        """Estado actual ordenado por próxima ejecución (las que están en curso primero)"""
+        with self._lock:
+            rows = [{
+                'key': s.key,
+                'interval': s.interval,
+                'next_run': s.next_run,
+                'last_run': s.last_run,
+                'runs': s.runs,
+                'hits': s.hits,
+            } for s in self._states.values()]
+        return sorted(rows, key=lambda r: r['next_run'] or 0)
@@ -0,0 +1,164 @@
+"""Lectura en streaming de las respuestas de búsqueda de Wallapop.
+
+``response.json()`` necesita a la vez el cuerpo entero y el documento
+decodificado. Aquí el cuerpo se lee por trozos y cada elemento del array
+``data.section.payload.items`` se decodifica por separado con
+``JSONDecoder.raw_decode`` y se convierte en un ``SearchItem`` con solo los
+campos que usa el bot. En memoria hay como mucho un trozo más un item; un
+valor de más de ``max_value`` caracteres se considera una respuesta rota.
+"""
+import codecs
+import json
+
+ITEMS_PATH = ('data', 'section', 'payload', 'items')
+NEXT_PAGE_PATH = ('meta', 'next_page')
+CHUNK_SIZE = 16 * 1024
+MAX_VALUE_SIZE = 1024 * 1024
+_WHITESPACE = ' \t\n\r'
+
+
+class SearchItem:
+    """Lo que se usa de un item del buscador"""
+    __slots__ = ('id', 'title', 'price', 'web_slug', 'user_id', 'top_profile', 'created_at')
+
+    def __init__(self, id, title, price, web_slug, user_id, top_profile=False, created_at=None):
+        self.id = id
+        self.title = title
+        self.price = price
+        self.web_slug = web_slug
+        self.user_id = user_id
+        self.top_profile = top_profile
+        self.created_at = created_at
+
+    @classmethod
+    def from_json(cls, x):
+        return cls(x['id'], x['title'], x['price']['amount'], x['web_slug'], x['user_id'],
+                   (x.get('is_top_profile') or {}).get('flag', False), x.get('created_at'))
+
+    def __repr__(self):
+        return 'SearchItem(%r, %r, %r)' % (self.id, self.title, self.price)
+
+
+class SearchStream:
+    """Items de una página de resultados según van llegando; ``next_page`` queda al final.
+
+    ``chunks`` es un iterable de bytes (``response.iter_content``). Si se deja
+    de iterar antes de tiempo, ``close()`` lee lo que falta sin decodificarlo
+    para que la conexión vuelva al pool, y llama a ``on_close``.
+    """
+
+    def __init__(self, chunks, on_close=None, max_value=MAX_VALUE_SIZE):
+        self._chunks = iter(chunks)
+        self._on_close = on_close
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self.max_value = max_value
+        self.next_page = None
+        self.count = 0
+        # Mayor buffer de texto que ha hecho falta, para medir
+        self.max_buffer = 0
+
+    def __iter__(self):
+        return self._object(())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        for _ in self._chunks:
+            pass
+        self._eof = True
+        if self._on_close is not None:
+            self._on_close()
+            self._on_close = None
+
+    def _fill(self):
+        """Añade otro trozo al buffer descartando lo ya leído; False si no quedan"""
+        if self._eof:
+            return False
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        if len(self._buf) > self.max_value:
+            raise ValueError('Valor JSON de más de %d caracteres' % self.max_value)
+        for chunk in self._chunks:
+            if chunk:
+                self._buf += self._utf8.decode(chunk)
+                self.max_buffer = max(self.max_buffer, len(self._buf))
+                return True
+        self._buf += self._utf8.decode(b'', final=True)
+        self._eof = True
+        return False
+
+    def _peek(self):
+        """Siguiente carácter que no sea un espacio, sin consumirlo"""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise ValueError('Respuesta JSON incompleta')
+
+    def _expect(self, chars):
+        c = self._peek()
+        if c not in chars:
+            raise ValueError('Se esperaba %r y llega %r' % (chars, c))
+        self._pos += 1
+        return c
+
+    def _value(self):
+        """Decodifica el siguiente valor completo, leyendo más trozos si está cortado"""
+        self._peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # Un número al final del buffer puede seguir en el siguiente trozo
+            if end == len(self._buf) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def _object(self, path):
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            if not isinstance(key, str):
+                raise ValueError('Clave JSON no válida: %r' % (key, ))
+            self._expect(':')
+            sub = path + (key, )
+            if sub == ITEMS_PATH and self._peek() == '[':
+                yield from self._items()
+            elif sub == NEXT_PAGE_PATH:
+                self.next_page = self._value()
+            elif self._peek() == '{' and (ITEMS_PATH[:len(sub)] == sub or NEXT_PAGE_PATH[:len(sub)] == sub):
+                yield from self._object(sub)
+            else:
+                self._value()
+            if self._expect(',}') == '}':
+                return
+
+    def _items(self):
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            x = self._value()
+            self.count += 1
+            yield SearchItem.from_json(x)
+            if self._expect(',]') == ']':
+                return
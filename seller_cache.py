@@ -0,0 +1,68 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class SellerCache:
+    """Caché LRU con caducidad de la información de vendedores (valoraciones).
+
+    Guarda por user_id un dict con reviews_count, average_rating e
+    is_top_profile. Si se le pasa un DBHelper, las entradas se guardan también
+    en la tabla ``seller`` para que sobrevivan a un reinicio.
+    """
+
+    def __init__(self, ttl=6 * 60 * 60, maxsize=5000, db=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.db = db
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is not None:
+                fetched_at, info = entry
+                if now - fetched_at < self.ttl:
+                    self._data.move_to_end(user_id)
+                    self.hits += 1
+                    return dict(info)
+                del self._data[user_id]
+
+        if self.db is not None:
+            row = self.db.get_seller(user_id)
+            if row is not None and now - row[0] < self.ttl:
+                with self._lock:
+                    self._store(user_id, row[0], row[1])
+                    self.hits += 1
+                return dict(row[1])
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, user_id, info):
+        now = time.time()
+        with self._lock:
+            self._store(user_id, now, dict(info))
+        if self.db is not None:
+            self.db.save_seller(user_id, info, now)
+
+    def _store(self, user_id, fetched_at, info):
+        self._data[user_id] = (fetched_at, info)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
@@ -0,0 +1,127 @@
+"""Reparto de las consultas entre varios procesos scraper (ROLE=scraper).
+
+Cada scraper se apunta en la tabla ``worker`` y renueva su latido cada
+pocos segundos. El coordinador, que va en el proceso del bot
+(ROLE=bot), pone los scrapers vivos en un anillo de hash consistente y
+guarda en ``search_assignment`` qué scraper hace cada consulta; cada
+scraper solo planifica las suyas. Cuando entra un scraper o muere uno (sin
+latido en ``dead_after`` segundos) solo cambian de dueño las consultas de su
+tramo del anillo, y el nuevo dueño sigue desde ``search_state``.
+
+Lo que ya se ha avisado se decide en la db (``DBHelper.save_items``), así
+que si dos scrapers hacen la misma consulta durante un cambio de dueño no se
+avisa dos veces.
+"""
+import hashlib
+import logging
+import os
+import socket
+import time
+from bisect import bisect
+from collections import Counter
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+def default_worker_id():
+    # En Docker el hostname es el id del contenedor
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+class HashRing:
+    """Anillo de hash consistente con ``vnodes`` puntos por miembro, para que el reparto salga parejo"""
+
+    def __init__(self, members, vnodes=64):
+        self.members = sorted(set(members))
+        points = sorted((_hash('%s#%d' % (member, n)), member) for member in self.members for n in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._owners = [member for _, member in points]
+
+    def owner(self, key):
+        """Miembro al que le toca `key`, o None si el anillo está vacío"""
+        if not self._hashes:
+            return None
+        return self._owners[bisect(self._hashes, _hash(key)) % len(self._hashes)]
+
+
+class ShardMember:
+    """Un proceso scraper: su latido y las consultas que tiene asignadas"""
+
+    def __init__(self, db, worker_id=None):
+        self.db = db
+        self.worker_id = worker_id or default_worker_id()
+        self._owned = set()
+
+    def beat(self, now=None):
+        self.db.heartbeat_worker(self.worker_id, 'scraper', now or time.time())
+
+    def owned(self):
+        """Claves (json) de las consultas asignadas; si la db falla, las últimas que se leyeron"""
+        assignments = self.db.get_assignments(self.worker_id)
+        if assignments is not None:
+            self._owned = set(assignments)
+        return self._owned
+
+    def leave(self):
+        """Se borra de la tabla worker al parar, para que el coordinador reparta ya sus consultas"""
+        self.db.delete_workers(worker_id=self.worker_id)
+
+
+class ShardCoordinator:
+    """Asigna las consultas a los scrapers vivos y las reparte de nuevo cuando cambian"""
+
+    def __init__(self, db, dead_after=30, vnodes=64):
+        self.db = db
+        self.dead_after = dead_after
+        self.vnodes = vnodes
+        self.workers = []
+        self.assignment = {}
+        self.rebalances = 0
+        self.moved = 0
+
+    def rebalance(self, query_keys, now=None):
+        """Reparte `query_keys` (claves json) entre los scrapers vivos. Devuelve cuántas han cambiado de dueño"""
+        now = now or time.time()
+        self.db.delete_workers(before=now - self.dead_after)
+        workers = self.db.get_workers(now - self.dead_after)
+        current = self.db.get_assignments()
+        if current is None:
+            return 0
+        if workers != self.workers:
+            logging.info("Scrapers vivos: %s (antes %s)", workers, self.workers)
+            self.workers = workers
+            self.rebalances += 1
+        if not workers:
+            # Sin nadie a quien dárselas, las consultas se quedan con su último dueño hasta que vuelva alguno
+            if query_keys:
+                logging.warning("No hay scrapers vivos para %d consultas", len(query_keys))
+            self.assignment = current
+            return 0
+        ring = HashRing(workers, self.vnodes)
+        wanted = {key: ring.owner(key) for key in query_keys}
+        assigned = [(key, worker) for key, worker in wanted.items() if current.get(key) != worker]
+        removed = [key for key in current if key not in wanted]
+        if (assigned or removed) and not self.db.save_assignments(assigned, removed, now):
+            return 0
+        moved = sum(1 for key, _ in assigned if key in current)
+        if assigned or removed:
+            logging.info("Reparto: %d consultas entre %d scrapers; %d nuevas, %d cambian de dueño, %d quitadas",
+                         len(wanted), len(workers), len(assigned) - moved, moved, len(removed))
+        self.moved += moved
+        self.assignment = wanted
+        return len(assigned)
+
+    def snapshot(self):
+        """Consultas asignadas a cada scraper vivo"""
+        counts = Counter(self.assignment.values())
+        return {worker: counts.get(worker, 0) for worker in self.workers}
+
+    def stats(self):
+        return {
+            'workers': len(self.workers),
+            'queries': len(self.assignment),
+            'rebalances': self.rebalances,
+            'moved': self.moved,
+        }
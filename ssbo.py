@@ -1,35 +1,180 @@
 #!/usr/bin/python3.5
 
-import requests
+import asyncio
 import time
 import datetime
-import telebot
+import json
 from telebot import types
-from dbhelper import DBHelper, ChatSearch, Item
+from telebot.async_telebot import AsyncTeleBot
+from dbhelper import DBHelper, ChatSearch, to_cents
+from pghelper import PgHelper
 from re import sub
-from decimal import Decimal
+from urllib.parse import quote
 import logging
 from logging.handlers import RotatingFileHandler
-import sys
 import threading
 import os
 import locale
-from fake_useragent import UserAgent
+import secrets
+import signal
+import statistics
+from executor import SearchExecutor
+from http_client import HttpPool, UserAgentPool, WALLAPOP_HEADERS
+from seller_cache import SellerCache
+from item_cache import ItemCache
+from bloom import RotatingBloomFilter
+from notifier import NotificationDispatcher
+from scheduler import SearchScheduler
+from matcher import compile_matcher
+from search_parser import CHUNK_SIZE, SearchStream
+from ratelimit import CircuitBreaker, CircuitOpenError, TokenBucket
+import metrics
+from tracing import TRACER
+from sharding import ShardCoordinator, ShardMember
+from price_stats import MarketStats, RollingPrices
+from webhook import WebhookServer
 
 TOKEN = os.getenv("BOT_TOKEN", "Bot Token does not exist")
 URL = "https://api.telegram.org/bot{}/".format(TOKEN)
-URL_ITEMS = "https://api.wallapop.com/api/v3/search?source=search_box"
+URL_WALLAPOP_API = "https://api.wallapop.com/api/v3"
+URL_ITEMS = URL_WALLAPOP_API + "/search?source=search_box"
 PROFILE = os.getenv("PROFILE")
+# all: todo en un proceso. Con varios procesos sobre la misma db, uno con ROLE=bot (Telegram,
+# notificaciones, retención y reparto de consultas) y N con ROLE=scraper (solo las consultas asignadas)
+ROLE = os.getenv('ROLE', 'all')
+if ROLE not in ('all', 'bot', 'scraper'):
+    raise ValueError('ROLE tiene que ser all, bot o scraper, no %r' % ROLE)
 
 # Configurar base de datos según el entorno
-if PROFILE is None:
-    db = DBHelper()
+# WAL + synchronous=NORMAL evitan un fsync por commit en la tarjeta SD de la Raspberry
+db_pragmas = {
+    'journal_mode': os.getenv('DB_JOURNAL_MODE', 'WAL') or None,
+    'synchronous': os.getenv('DB_SYNCHRONOUS', 'NORMAL') or None,
+    'cache_size': os.getenv('DB_CACHE_SIZE') or None,
+    'busy_timeout': os.getenv('DB_BUSY_TIMEOUT', '30000') or None,
+}
+# Con DATABASE_URL=postgresql://... los datos van a PostgreSQL (varios scrapers escribiendo a la vez)
+DATABASE_URL = os.getenv('DATABASE_URL')
+if DATABASE_URL:
+    db = PgHelper(DATABASE_URL, maxconn=int(os.getenv('DB_POOL_SIZE', '10')))
+    # Aquí solo van el filtro de Bloom y similares
+    data_dir = os.getenv('DB_DIR', '/app/data') if PROFILE is not None else '.'
+    os.makedirs(data_dir, exist_ok=True)
+elif PROFILE is None:
+    db = DBHelper(**db_pragmas)
+    data_dir = os.path.dirname(db.dbname) or '.'
 else:
     # En Docker o entornos controlados, usar directorio específico para persistencia
-    db_dir = os.getenv('DB_DIR', '/app/data')
-    os.makedirs(db_dir, exist_ok=True)
-    db_path = os.path.join(db_dir, 'db.sqlite')
-    db = DBHelper(db_path)
+    data_dir = os.getenv('DB_DIR', '/app/data')
+    os.makedirs(data_dir, exist_ok=True)
+    db = DBHelper(os.path.join(data_dir, 'db.sqlite'), **db_pragmas)
+
+# Búsquedas en paralelo: hilos totales y peticiones simultáneas por host
+executor = SearchExecutor(max_workers=int(os.getenv('SEARCH_WORKERS', '8')),
+                          per_host=int(os.getenv('HOST_CONCURRENCY', '4')))
+
+# Cada consulta tiene su propio intervalo, que se adapta a las novedades que encuentra
+SWEEP_INTERVAL = int(os.getenv('SWEEP_INTERVAL', '300'))
+scheduler = SearchScheduler(base_interval=SWEEP_INTERVAL,
+                            min_interval=int(os.getenv('SEARCH_MIN_INTERVAL', '60')),
+                            max_interval=int(os.getenv('SEARCH_MAX_INTERVAL', '1800')),
+                            jitter=float(os.getenv('SEARCH_JITTER', '0.1')))
+# Cada cuánto se relee entera una búsqueda (para ver bajadas de precio) y máximo de páginas por consulta
+FULL_SCAN_INTERVAL = int(os.getenv('FULL_SCAN_INTERVAL', '3600'))
+MAX_PAGES = int(os.getenv('MAX_PAGES', '5'))
+# Cada cuánto se releen las búsquedas de la db aunque no toque ninguna
+SCHEDULER_TICK = 30
+# Métricas Prometheus y /healthz (METRICS_PORT=0 lo desactiva)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '8080'))
+heartbeat = metrics.Heartbeat(max_age=int(os.getenv('HEALTH_MAX_AGE', '300')))
+SWEEP_DURATION = metrics.Histogram('wallbot_sweep_duration_seconds',
+                                   'Duración de cada consulta: descarga, filtrado, db y encolado de avisos')
+ITEMS = metrics.Counter('wallbot_items_total', 'Items que cumplen una búsqueda (seen), nuevos (new), bajadas '
+                        '(price_drop), avisos de chollo (deal), avisos omitidos por encima del percentil de la '
+                        'búsqueda (above_percentile) y caducados por la retención (expired)', ('kind', ))
+ACTIVE_SEARCHES = metrics.Gauge('wallbot_active_searches', 'Búsquedas activas y consultas distintas', ('kind', ))
+NOTIFY_QUEUE = metrics.Gauge('wallbot_notification_queue', 'Estado de la cola de notificaciones', ('field', ))
+COMPONENT_STATS = metrics.Gauge('wallbot_component', 'Contadores internos de cachés, pools y limitadores',
+                                ('component', 'field'))
+
+# Long polling de Telegram: segundos de cada getUpdates y espera máxima entre reconexiones
+POLLING_TIMEOUT = int(os.getenv('POLLING_TIMEOUT', '20'))
+POLLING_MAX_BACKOFF = float(os.getenv('POLLING_MAX_BACKOFF', '60'))
+RECONNECTS = metrics.Counter('wallbot_telegram_reconnects_total',
+                             'Reintentos de conexión con Telegram (long polling o registro del webhook)')
+# Modo webhook: con WEBHOOK_URL (pública, detrás de un proxy inverso) Telegram envía las actualizaciones
+# a un servidor HTTP propio en WEBHOOK_HOST:WEBHOOK_PORT en lugar de hacer long polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+
+ADMIN_CHAT_IDS = [x.strip() for x in os.getenv('ADMIN_CHAT_IDS', '').split(',') if x.strip()]
+
+# Conexiones keep-alive reutilizadas entre barridos, una sesión por API
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '15'))
+# Todas las llamadas a Wallapop comparten límite de peticiones/s y circuit breaker
+wallapop_limiter = TokenBucket(float(os.getenv('WALLAPOP_RATE', '5')),
+                               float(os.getenv('WALLAPOP_BURST', '10')))
+wallapop_breaker = CircuitBreaker(threshold=int(os.getenv('BREAKER_THRESHOLD', '5')),
+                                  cooldown=float(os.getenv('BREAKER_COOLDOWN', '30')),
+                                  max_cooldown=float(os.getenv('BREAKER_MAX_COOLDOWN', '900')))
+wallapop_http = HttpPool('wallapop', pool_size=int(os.getenv('WALLAPOP_POOL_SIZE', str(executor.per_host))),
+                         timeout=HTTP_TIMEOUT, headers=WALLAPOP_HEADERS,
+                         limiter=wallapop_limiter, breaker=wallapop_breaker)
+telegram_http = HttpPool('telegram', pool_size=int(os.getenv('TELEGRAM_POOL_SIZE', '4')),
+                         timeout=HTTP_TIMEOUT)
+user_agents = UserAgentPool()
+
+# Cola de mensajes a Telegram: el barrido encola y los workers envían respetando los límites.
+# Los scrapers solo guardan en outbox; el proceso del bot lee de ahí lo que encolan
+notifier = NotificationDispatcher(db, telegram_http, URL,
+                                  workers=0 if ROLE == 'scraper' else int(os.getenv('NOTIFY_WORKERS', '2')),
+                                  global_rate=float(os.getenv('TELEGRAM_GLOBAL_RATE', '30')),
+                                  chat_rate=float(os.getenv('TELEGRAM_CHAT_RATE', '1')),
+                                  max_retries=int(os.getenv('NOTIFY_MAX_RETRIES', '5')),
+                                  poll_interval=float(os.getenv('OUTBOX_POLL_INTERVAL', '1')) if ROLE == 'bot' else 0)
+
+# Valoraciones de vendedores: se piden solo al notificar y se cachean
+seller_cache = SellerCache(ttl=int(os.getenv('SELLER_CACHE_TTL', str(6 * 60 * 60))),
+                           maxsize=int(os.getenv('SELLER_CACHE_SIZE', '5000')),
+                           db=db if os.getenv('SELLER_CACHE_PERSIST', '1') == '1' else None)
+
+# Filtro de Bloom (fichero con mmap junto a la db) de los items que ya conoce cada chat
+BLOOM_CAPACITY = int(os.getenv('BLOOM_CAPACITY', '1000000'))
+seen_filter = None
+# Con varios procesos no sirve: no ve lo que guardan los demás
+if BLOOM_CAPACITY > 0 and ROLE == 'all':
+    seen_filter = RotatingBloomFilter(os.path.join(data_dir, 'seen.bloom'),
+                                      BLOOM_CAPACITY, float(os.getenv('BLOOM_ERROR_RATE', '0.01')))
+# Precio de los items ya vistos por chat, para decidir novedades y bajadas sin consultar la db
+item_cache = ItemCache(db, maxsize=int(os.getenv('ITEM_CACHE_SIZE', '200000')), seen_filter=seen_filter,
+                       shared=ROLE != 'all')
+
+# Chollos: un nuevo o una bajada a DEAL_THRESHOLD (fracción) o más por debajo de la mediana de los últimos
+# PRICE_WINDOW precios de su consulta, si hay al menos DEAL_MIN_SAMPLES
+DEAL_THRESHOLD = float(os.getenv('DEAL_THRESHOLD', '0.3'))
+rolling_prices = RollingPrices(db, window=int(os.getenv('PRICE_WINDOW', '200')),
+                               min_samples=int(os.getenv('DEAL_MIN_SAMPLES', '10')))
+# Percentiles y tendencia de cada consulta para /stats y las búsquedas con /p25 (necesita numpy)
+try:
+    market_stats = MarketStats(db, min_samples=int(os.getenv('MARKET_MIN_SAMPLES', '20')),
+                               trend_days=int(os.getenv('MARKET_TREND_DAYS', '90')))
+except RuntimeError as e:
+    market_stats = None
+    market_stats_error = str(e)
+
+# Reparto de consultas entre scrapers: latido y reparto cada SHARD_INTERVAL, muerto tras SHARD_DEAD_AFTER sin latido
+SHARD_INTERVAL = int(os.getenv('SHARD_INTERVAL', '10'))
+shard = ShardMember(db, os.getenv('WORKER_ID') or None) if ROLE == 'scraper' else None
+coordinator = ShardCoordinator(db, dead_after=int(os.getenv('SHARD_DEAD_AFTER', '30'))) if ROLE == 'bot' else None
+
+# Retención: se borran los items que ninguna búsqueda ha visto en ITEM_RETENTION_DAYS días (0 = nunca)
+ITEM_RETENTION_DAYS = float(os.getenv('ITEM_RETENTION_DAYS', '30'))
+# Las lápidas de los borrados evitan que vuelvan como nuevos durante TOMBSTONE_RETENTION_DAYS días
+TOMBSTONE_RETENTION_DAYS = float(os.getenv('TOMBSTONE_RETENTION_DAYS', '365'))
+# El historial de precios de un item se borra PRICE_HISTORY_DAYS días después de su último cambio si ya no está
+# en ninguna búsqueda
+PRICE_HISTORY_DAYS = float(os.getenv('PRICE_HISTORY_DAYS', '90'))
+RETENTION_INTERVAL = int(os.getenv('RETENTION_INTERVAL', '3600'))
+RETENTION_BATCH = int(os.getenv('RETENTION_BATCH', '500'))
 
 
 ICON_VIDEO_GAMES = u'\U0001F3AE'  # 🎮
@@ -41,6 +186,8 @@ ICON_DIRECT_HIT_ = u'\U0001F3AF'  # 🎯
 
 # Estado de usuarios para formularios paso a paso
 user_states = {}
+# Se activa al recibir SIGTERM/SIGINT; lo esperan el planificador y el polling
+stopped = asyncio.Event()
 
 def create_main_menu():
     """Crear menú principal con botones inline"""
@@ -107,7 +254,16 @@ def create_price_range_menu():
     return markup
 
 
-def notel(chat_id, price, title, url_item, obs=None, seller_info=None):
+def format_price(amount):
+    """Precio con el formato de moneda del locale (1.234,50 €)"""
+    try:
+        return locale.currency(amount, grouping=True)
+    except ValueError:
+        return '%.2f €' % amount
+
+
+@TRACER.traced('notel')
+def notel(chat_id, price, title, url_item, obs=None, seller_info=None, deal=None):
     # https://apps.timwhitlock.info/emoji/tables/unicode
     if obs is not None:
         text = ICON_EXCLAMATION
@@ -117,11 +273,15 @@ def notel(chat_id, price, title, url_item, obs=None, seller_info=None):
     text += '\n'
     if obs is not None:
         text += ICON_COLLISION__ + ' '
-    text += locale.currency(price, grouping=True)
+    text += format_price(price)
     if obs is not None:
         text += obs
         text += ' ' + ICON_COLLISION__
     text += '\n'
+    if deal is not None:
+        # (fracción por debajo de la mediana, mediana en céntimos)
+        text += '%s Chollo: %.0f%% por debajo de la mediana de la búsqueda (%s)\n' % (
+            u'\U0001F525', deal[0] * 100, format_price(deal[1] / 100))  # 🔥
     
     # Agregar información del vendedor si está disponible
     if seller_info:
@@ -143,14 +303,14 @@ def notel(chat_id, price, title, url_item, obs=None, seller_info=None):
     
     text += 'https://es.wallapop.com/item/'
     text += url_item
-    urlz0rb0t = URL + "sendMessage?chat_id=%s&parse_mode=markdown&text=%s" % (chat_id, text)
-    requests.get(url=urlz0rb0t)
+    notifier.enqueue(chat_id, text)
 
 
 def get_url_list(search):
     url = URL_ITEMS
     url += '&keywords='
-    url += "+".join(search.kws.split(" "))
+    # Las palabras negativas (-funda) solo se usan al filtrar títulos; en el orden de query_key
+    url += "+".join(sorted((kw for kw in search.kws.split() if not kw.startswith('-')), key=str.lower))
     url += '&time_filter=today'
     if search.cat_ids is not None:
         url += '&category_ids='
@@ -170,19 +330,21 @@ def get_url_list(search):
     return url
 
 
+@TRACER.traced('get_user_reviews')
 def get_user_reviews(user_id, headers):
     """Obtener las valoraciones de un usuario"""
     try:
-        reviews_url = f"https://api.wallapop.com/api/v3/users/{user_id}/reviews"
-        reviews_response = requests.get(url=reviews_url, headers=headers)
+        reviews_url = f"{URL_WALLAPOP_API}/users/{user_id}/reviews"
+        with executor.host_slot(reviews_url):
+            reviews_response = wallapop_http.get(reviews_url, endpoint='reviews', headers=headers)
         
         if reviews_response.status_code == 200:
             reviews = reviews_response.json()
             return reviews
         else:
-            return []
+            return None
     except:
-        return []
+        return None
 
 def calculate_average_rating(reviews):
     """Calcular la puntuación media de las valoraciones"""
@@ -192,105 +354,269 @@ def calculate_average_rating(reviews):
     total_score = sum(review.get('review', {}).get('scoring', 0) for review in reviews)
     return total_score / len(reviews)
 
-def get_items(url, chat_id, search_keywords):
-    try:
-   
-        ua = UserAgent()
-
-        headers = {
-            'Accept': 'application/json, text/plain, */*',
-            'Accept-Language': 'es,ru;q=0.9,en;q=0.8,de;q=0.7,pt;q=0.6',
-            'Connection': 'keep-alive',
-            'DeviceOS': '0',
-            'Origin': 'https://es.wallapop.com',
-            'Referer': 'https://es.wallapop.com/',
-            'Sec-Fetch-Dest': 'empty',
-            'Sec-Fetch-Mode': 'cors',
-            'Sec-Fetch-Site': 'same-site',
-            'User-Agent': f'{ua.random}',
-            'X-AppVersion': '75491',
-            'X-DeviceOS': '0',
-            'sec-ch-ua-mobile': '?0',
-        }
+def group_searches(searches):
+    """Agrupa las búsquedas por consulta.
+
+    {clave: (búsqueda representante, [chat_ids], {chat_id: percentil}, {kws: [chat_ids]})}.
+    El tercero son los chats que solo quieren avisos por debajo de un
+    percentil de la consulta (/p25); si un chat tiene dos búsquedas con la
+    misma consulta, el más bajo. El cuarto, las variantes de la consulta
+    (mismas palabras positivas, distintas negativas u orden) y sus chats:
+    una sola petición y cada título va a los chats de las variantes que
+    cumple.
+    """
+    groups = {}
+    for search in searches:
+        key = search.query_key()
+        if key not in groups:
+            groups[key] = (search, [], {}, {})
+        _, chat_ids, limits, variants = groups[key]
+        if search.chat_id not in chat_ids:
+            chat_ids.append(search.chat_id)
+        if search.max_percentile is not None:
+            limits[search.chat_id] = min(search.max_percentile, limits.get(search.chat_id, 100))
+        variants.setdefault(search.kws, [])
+        if search.chat_id not in variants[search.kws]:
+            variants[search.kws].append(search.chat_id)
+    return groups
+
+
+@TRACER.traced('fetch_page')
+def fetch_page(url, headers):
+    """Pide una página de resultados. Devuelve un SearchStream (items según llegan) o None si falla"""
+    with executor.host_slot(url):
+        response = wallapop_http.get(url, endpoint='search', headers=headers, stream=True)
+
+    if response.status_code != 200:
+        logging.error(f"Failed to fetch data: {response.status_code}")
+        response.close()
+        return None
 
-        response = requests.get(url=url, headers=headers)
-        
-        if response.status_code == 200:
-            data = response.json()
+    # El cuerpo se decodifica item a item en vez de cargar el JSON entero con response.json()
+    return SearchStream(response.iter_content(CHUNK_SIZE), on_close=response.close)
 
-            items = data.get('data', {}).get('section', {}).get('payload', {}).get('items', [])
 
-            for x in items:
-                # Filtrar solo los elementos que contengan las palabras clave en el título
-                title_lower = x['title'].lower()
-                keywords_lower = [kw.strip().lower() for kw in search_keywords.split()]
-                
-                # Verificar que todas las palabras clave estén en el título
-                if not all(keyword in title_lower for keyword in keywords_lower):
-                    continue
-                logging.info('Encontrado: id=%s, price=%s, title=%s, user=%s',
-                             str(x['id']),
-                             locale.currency(x['price']['amount'], grouping=True),
-                             x['title'],
-                             x['user_id'])
-
-                # Obtener información del vendedor
-                seller_info = None
-                try:
-                    user_reviews = get_user_reviews(x['user_id'], headers)
-                    is_top_profile = x.get('is_top_profile', {}).get('flag', False)
-                    
-                    seller_info = {
-                        'reviews_count': len(user_reviews),
-                        'is_top_profile': is_top_profile
-                    }
-                    
-                    if user_reviews:
-                        avg_rating = calculate_average_rating(user_reviews)
-                        seller_info['average_rating'] = avg_rating
-                except Exception as e:
-                    logging.warning(f"Error obteniendo info del vendedor {x['user_id']}: {e}")
-
-                i = db.search_item(x['id'], chat_id)
-                
-                if i is None:
-                    db.add_item(x['id'], chat_id, x['title'], x['price']['amount'], x['web_slug'], x['user_id'])
-                    notel(chat_id, x['price']['amount'], x['title'], x['web_slug'], seller_info=seller_info)
-                    logging.info('New: id=%s, price=%s, title=%s', str(x['id']), locale.currency(x['price']['amount'], grouping=True), x['title'])
-                else:
-                    money = str(x['price']['amount'])
-                    value_json = Decimal(sub(r'[^\d.]', '', money))
-                    value_db = Decimal(sub(r'[^\d.]', '', i.price))
-                    
-                    if value_json < value_db:
-                        new_obs = locale.currency(i.price, grouping=True)
-                        if i.observaciones is not None:
-                            new_obs += ' < ' + i.observaciones
-                        db.update_item(x['id'], money, new_obs)
-                        obs = ' < ' + new_obs
-                        notel(chat_id, x['price']['amount'], x['title'], x['web_slug'], obs, seller_info=seller_info)
-                        logging.info('Baja: id=%s, price=%s, title=%s', str(x['id']), locale.currency(x['price']['amount'], grouping=True), x['title'])
-        else:
-            logging.error(f"Failed to fetch data: {response.status_code}")
+def item_seen(x, state):
+    """Si el item es igual o más antiguo que el más nuevo visto en la última pasada"""
+    last_item_id, last_ts = state[0], state[1]
+    if str(x.id) == last_item_id:
+        return True
+    return bool(x.created_at and last_ts and x.created_at <= last_ts)
+
 
+def get_items(search, chat_ids, matcher=None, limits=None, variants=None):
+    hits = 0
+    try:
+        # El resto de cabeceras van en la sesión; solo cambia el User-Agent
+        headers = {'User-Agent': user_agents.random()}
+        url = get_url_list(search)
+        if variants is None:
+            variants = {search.kws: chat_ids}
+        if matcher is None:
+            matcher = compile_matcher(frozenset(variants))
+
+        # Con order_by=newest lo nuevo llega primero, así que basta con leer hasta el último
+        # item ya visto. Cada FULL_SCAN_INTERVAL se relee todo para detectar bajadas de precio.
+        state_key = json.dumps(search.query_key())
+        state = db.get_search_state(state_key)
+        now = time.time()
+        incremental = search.orde in (None, 'newest') and state is not None \
+            and now - state[2] < FULL_SCAN_INTERVAL
+
+        newest = None
+        reached = False
+        pages = 0
+        while url is not None:
+            page = fetch_page(url, headers)
+            if page is None:
+                # No se toca el estado para repetir la consulta entera la próxima vez
+                return hits
+            pages += 1
+
+            matched = []
+            routes = {}
+            with page:
+                for x in page:
+                    if newest is None:
+                        newest = (str(x.id), x.created_at)
+                    if incremental and item_seen(x, state):
+                        reached = True
+                        break
+
+                    # Filtrar solo los elementos que contengan las palabras clave en el título
+                    # (sin acentos ni mayúsculas, y ninguna de las negativas): una pasada por título
+                    # y el item va a los chats de cada variante de la consulta que cumple
+                    chats = set()
+                    for kws in matcher.match(x.title):
+                        chats.update(variants.get(kws, ()))
+                    if not chats:
+                        continue
+                    routes[str(x.id)] = chats
+                    logging.info('Encontrado: id=%s, price=%s, title=%s, user=%s',
+                                 str(x.id),
+                                 format_price(x.price),
+                                 x.title,
+                                 x.user_id)
+                    matched.append(x)
+            next_page = page.next_page
+
+            # Cada chat suscrito tiene su propio estado de novedades y bajadas
+            if matched:
+                ITEMS.inc(len(matched), kind='seen')
+                hits += process_items(matched, chat_ids, headers, state_key, limits,
+                                      routes if len(variants) > 1 else None)
+
+            if reached or not next_page:
+                url = None
+            elif pages >= MAX_PAGES:
+                logging.warning('Búsqueda "%s" cortada tras %d páginas', search.kws, pages)
+                url = None
+            else:
+                url = URL_ITEMS + '&next_page=' + quote(next_page)
+
+        if newest is None and state is not None:
+            newest = (state[0], state[1])
+        last_full_scan = state[2] if incremental else now
+        db.save_search_state(state_key, newest[0] if newest else None, newest[1] if newest else None,
+                             last_full_scan)
+        heartbeat.success()
+
+    except CircuitOpenError as e:
+        logging.warning('Búsqueda "%s" aplazada: %s', search.kws, e)
     except Exception as e:
         logging.error(e)
+    return hits
+
 
+def get_seller_info(x, headers):
+    """Información del vendedor del item, de la caché si es reciente"""
+    is_top_profile = x.top_profile
+    seller_info = seller_cache.get(x.user_id)
+    if seller_info is not None:
+        seller_info['is_top_profile'] = is_top_profile
+        return seller_info
 
-def handle_exception(self, exception):
-    logging.exception(exception)
-    logging.error("Ha ocurrido un error con la llamada a Telegram. Se reintenta la conexión")
-    print("Ha ocurrido un error con la llamada a Telegram. Se reintenta la conexión")
-    bot.polling(none_stop=True, timeout=3000)
+    try:
+        user_reviews = get_user_reviews(x.user_id, headers)
+        seller_info = {
+            'reviews_count': len(user_reviews or []),
+            'is_top_profile': is_top_profile
+        }
+        if user_reviews:
+            avg_rating = calculate_average_rating(user_reviews)
+            seller_info['average_rating'] = avg_rating
+        # Si la petición ha fallado no se cachea el "sin valoraciones"
+        if user_reviews is not None:
+            seller_cache.put(x.user_id, seller_info)
+    except Exception as e:
+        logging.warning(f"Error obteniendo info del vendedor {x.user_id}: {e}")
+    return seller_info
+
+
+def process_items(items, chat_ids, headers, query_key=None, limits=None, routes=None):
+    """Novedades y bajadas de precio de una página de resultados para todos los chats suscritos.
+
+    Qué items conoce ya cada chat sale de item_cache; los cambios se guardan en
+    una sola transacción y las notificaciones se mandan después del commit.
+    Con `query_key` los nuevos y los cambios de precio van al historial y
+    cada precio se compara con la mediana de la consulta (chollos). Los chats
+    de `limits` ({chat_id: percentil}) solo reciben los avisos con precio hasta
+    ese percentil de la consulta; se guardan igual, así una bajada posterior
+    por debajo sí avisa. Con `routes` ({str(item_id): chats}) cada item es
+    solo para los chats cuya variante de la consulta lo cumple. Devuelve los
+    avisos mandados, que el planificador toma como novedades de la consulta:
+    no cuenta los que ha guardado otro scraper ni los que quedan por encima
+    del percentil.
+    """
+    item_ids = [x.id for x in items]
+    new_items = []
+    updates = []
+    seen = []
+    alerts = []
+    prices = {}
+    deals = {}
+    if query_key is not None:
+        for x in items:
+            cents = to_cents(x.price)
+            # Cada item contra la mediana de lo visto antes que él
+            deal = rolling_prices.score(query_key, cents)
+            if deal is not None and deal[0] >= DEAL_THRESHOLD:
+                deals[str(x.id)] = deal
+            rolling_prices.add(query_key, x.id, cents)
+    # Percentiles de antes de esta página; sin bastantes precios (None) se avisa de todo
+    thresholds = {}
+    if limits and query_key is not None and market_stats is not None:
+        thresholds = {chat_id: market_stats.percentile(query_key, q) for chat_id, q in limits.items()}
+    for chat_id in chat_ids:
+        chat_items = items if routes is None else [x for x in items if chat_id in routes[str(x.id)]]
+        if not chat_items:
+            continue
+        known, stale = item_cache.prices(item_ids if routes is None else [x.id for x in chat_items], chat_id)
+        for x in chat_items:
+            old_cents = known.get(str(x.id))
+            cents = to_cents(x.price)
+            if old_cents is None:
+                new_items.append((x.id, chat_id, x.title, cents, x.web_slug, x.user_id))
+                alerts.append((x, chat_id, None))
+                prices[str(x.id)] = cents
+                continue
+            # lastSeen para la retención, como mucho una vez al día por item
+            if str(x.id) in stale:
+                seen.append((x.id, chat_id, x.title, old_cents, x.web_slug, x.user_id))
+
+            # Precios en céntimos enteros, sin parsear texto
+            if cents < old_cents:
+                # Solo el precio anterior: la serie completa está en price_history (/history)
+                new_obs = format_price(old_cents / 100)
+                updates.append((cents, new_obs, x.id, chat_id))
+                alerts.append((x, chat_id, ' < ' + new_obs))
+            if cents != old_cents:
+                # También las subidas; si ya está en item_price, el upsert no escribe nada
+                prices[str(x.id)] = cents
+
+    history = [(item_id, query_key, cents) for item_id, cents in prices.items()] if query_key is not None else ()
+    claimed = item_cache.save(new_items, updates, seen, prices=history)
+    if history and market_stats is not None:
+        market_stats.invalidate(query_key)
+
+    sent = 0
+    for x, chat_id, obs in alerts:
+        # Con varios scrapers avisa solo el que ha guardado el item o la bajada
+        if claimed is not None and (str(x.id), str(chat_id)) not in claimed:
+            continue
+        threshold = thresholds.get(chat_id)
+        if threshold is not None and to_cents(x.price) > threshold:
+            ITEMS.inc(kind='above_percentile')
+            continue
+        ITEMS.inc(kind='new' if obs is None else 'price_drop')
+        deal = deals.get(str(x.id))
+        if deal is not None:
+            ITEMS.inc(kind='deal')
+        seller_info = get_seller_info(x, headers)
+        notel(chat_id, x.price, x.title, x.web_slug, obs, seller_info=seller_info, deal=deal)
+        logging.info('%s: id=%s, chat=%s, price=%s, title=%s', 'New' if obs is None else 'Baja',
+                     str(x.id), chat_id, format_price(x.price), x.title)
+        sent += 1
+    return sent
 
 
 # INI Actualización de db a partir de la librería de Telegram
-# bot = telebot.TeleBot(TOKEN, exception_handler=handle_exception)
-bot = telebot.TeleBot(TOKEN)
+# Los handlers son corrutinas en el mismo bucle de eventos que el planificador:
+# no pueden bloquear, lo que va a la db pasa por asyncio.to_thread
+bot = AsyncTeleBot(TOKEN)
+webhook_server = None
+if WEBHOOK_URL:
+    # Sin WEBHOOK_SECRET vale uno aleatorio: la url se vuelve a registrar en cada arranque
+    webhook_server = WebhookServer(bot, WEBHOOK_URL, os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32),
+                                   host=os.getenv('WEBHOOK_HOST', '0.0.0.0'),
+                                   port=int(os.getenv('WEBHOOK_PORT', '8443')),
+                                   workers=int(os.getenv('WEBHOOK_WORKERS', '8')),
+                                   queue_size=int(os.getenv('WEBHOOK_QUEUE_SIZE', '100')),
+                                   max_connections=int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40')))
 
 
 @bot.message_handler(commands=['start', 'help', 's', 'h'])
-def send_welcome(message):
+async def send_welcome(message):
     text = '🤖 ¡Hola! Soy **WallBot**\n\n'
     text += '🔍 Tu asistente para búsquedas en Wallapop\n\n'
     text += '✨ **Características:**\n'
@@ -300,62 +626,62 @@ def send_welcome(message):
     text += '• 📱 Interfaz visual fácil de usar\n\n'
     text += '👇 **Usa los botones para empezar:**'
     
-    bot.send_message(message.chat.id, text, parse_mode="Markdown", reply_markup=create_main_menu())
+    await bot.send_message(message.chat.id, text, parse_mode="Markdown", reply_markup=create_main_menu())
 
 
 # Manejadores de callbacks para botones inline
 @bot.callback_query_handler(func=lambda call: True)
-def handle_callback(call):
+async def handle_callback(call):
     try:
         chat_id = call.message.chat.id
         user_id = call.from_user.id
         
         if call.data == "main_menu":
-            show_main_menu(call.message)
+            await show_main_menu(call.message)
         
         elif call.data == "add_search":
-            start_add_search_wizard(call.message)
+            await start_add_search_wizard(call.message)
         
         elif call.data == "list_searches":
-            show_searches_list(call.message)
+            await show_searches_list(call.message)
         
         elif call.data == "show_categories":
-            show_categories_menu(call.message)
+            await show_categories_menu(call.message)
         
         elif call.data == "show_help":
-            show_help(call.message)
+            await show_help(call.message)
         
         elif call.data.startswith("cat_"):
             category_id = call.data[4:]
             if user_id in user_states:
                 user_states[user_id]['category'] = category_id
-            select_price_range(call.message, category_id)
+            await select_price_range(call.message, category_id)
         
         elif call.data.startswith("price_"):
-            handle_price_selection(call.message, call.data, user_id)
+            await handle_price_selection(call.message, call.data, user_id)
         
         elif call.data.startswith("del_"):
             encoded_kws = call.data[4:]
-            handle_delete_search(call.message, encoded_kws)
+            await handle_delete_search(call.message, encoded_kws)
         
         elif call.data.startswith("wizprice_"):
-            handle_wizard_price_selection(call.message, call.data, user_id)
+            await handle_wizard_price_selection(call.message, call.data, user_id)
         
         # Responder al callback para quitar el loading
-        bot.answer_callback_query(call.id)
+        await bot.answer_callback_query(call.id)
         
     except Exception as e:
         logging.error(f"Error en callback: {e}")
-        bot.answer_callback_query(call.id, "❌ Error procesando la solicitud")
+        await bot.answer_callback_query(call.id, "❌ Error procesando la solicitud")
 
-def show_main_menu(message):
+async def show_main_menu(message):
     text = '🏠 **Menú Principal**\n\n'
     text += 'Selecciona una opción:'
     
-    bot.edit_message_text(text, message.chat.id, message.message_id, 
-                         parse_mode="Markdown", reply_markup=create_main_menu())
+    await bot.edit_message_text(text, message.chat.id, message.message_id, 
+                               parse_mode="Markdown", reply_markup=create_main_menu())
 
-def start_add_search_wizard(message):
+async def start_add_search_wizard(message):
     text = '➕ **Añadir nueva búsqueda - Paso 1/2**\n\n'
     text += '🔍 **¿Qué quieres buscar?**\n'
     text += 'Escribe las palabras clave del producto:\n\n'
@@ -366,28 +692,28 @@ def start_add_search_wizard(message):
     btn_back = types.InlineKeyboardButton("🔙 Volver al menú", callback_data="main_menu")
     markup.add(btn_back)
     
-    bot.edit_message_text(text, message.chat.id, message.message_id,
-                         parse_mode="Markdown", reply_markup=markup)
+    await bot.edit_message_text(text, message.chat.id, message.message_id,
+                               parse_mode="Markdown", reply_markup=markup)
     
     # Establecer estado del usuario
     user_states[message.chat.id] = {'step': 'waiting_keywords'}
 
-def show_categories_menu(message):
+async def show_categories_menu(message):
     text = '📂 **Categorías Populares**\n\n'
     text += 'Selecciona una categoría para búsquedas rápidas:'
     
-    bot.edit_message_text(text, message.chat.id, message.message_id,
-                         parse_mode="Markdown", reply_markup=create_categories_menu())
+    await bot.edit_message_text(text, message.chat.id, message.message_id,
+                               parse_mode="Markdown", reply_markup=create_categories_menu())
 
-def select_price_range(message, category_id):
+async def select_price_range(message, category_id):
     text = '💰 **Selecciona rango de precio**\n\n'
     text += f'📂 Categoría: {category_id}\n'
     text += 'Elige el rango de precio que te interesa:'
     
-    bot.edit_message_text(text, message.chat.id, message.message_id,
-                         parse_mode="Markdown", reply_markup=create_price_range_menu())
+    await bot.edit_message_text(text, message.chat.id, message.message_id,
+                               parse_mode="Markdown", reply_markup=create_price_range_menu())
 
-def handle_price_selection(message, price_data, user_id):
+async def handle_price_selection(message, price_data, user_id):
     # Procesar selección de precio y finalizar búsqueda
     price_range = price_data[6:]  # Quitar "price_"
     
@@ -395,13 +721,13 @@ def handle_price_selection(message, price_data, user_id):
         price_range = None
     elif price_range == "custom":
         # Solicitar precio personalizado
-        ask_custom_price(message)
+        await ask_custom_price(message)
         return
     
     # Finalizar creación de búsqueda con categoría y precio
-    finalize_category_search(message, user_id, price_range)
+    await finalize_category_search(message, user_id, price_range)
 
-def ask_custom_price(message):
+async def ask_custom_price(message):
     text = '✍️ **Precio personalizado**\n\n'
     text += '💰 Escribe el rango de precio:\n'
     text += '📝 _Formato: min-max_\n'
@@ -412,10 +738,10 @@ def ask_custom_price(message):
     btn_back = types.InlineKeyboardButton("🔙 Volver", callback_data="show_categories")
     markup.add(btn_back)
     
-    bot.edit_message_text(text, message.chat.id, message.message_id,
-                         parse_mode="Markdown", reply_markup=markup)
+    await bot.edit_message_text(text, message.chat.id, message.message_id,
+                               parse_mode="Markdown", reply_markup=markup)
 
-def finalize_category_search(message, user_id, price_range):
+async def finalize_category_search(message, user_id, price_range):
     if user_id not in user_states:
         return
     
@@ -446,7 +772,7 @@ def finalize_category_search(message, user_id, price_range):
     cs.username = message.chat.username
     cs.active = 1
     
-    db.add_search(cs)
+    await asyncio.to_thread(db.add_search, cs)
     
     # Mensaje de confirmación
     text = '✅ **Búsqueda añadida correctamente**\n\n'
@@ -455,15 +781,15 @@ def finalize_category_search(message, user_id, price_range):
         text += f'💰 Precio: {price_range}€\n'
     text += '\n🔔 Recibirás notificaciones cuando encuentre resultados'
     
-    bot.edit_message_text(text, message.chat.id, message.message_id,
-                         parse_mode="Markdown", reply_markup=create_main_menu())
+    await bot.edit_message_text(text, message.chat.id, message.message_id,
+                               parse_mode="Markdown", reply_markup=create_main_menu())
     
     # Limpiar estado
     if user_id in user_states:
         del user_states[user_id]
 
-def show_searches_list(message):
-    searches = db.get_chat_searchs(message.chat.id)
+async def show_searches_list(message):
+    searches = await asyncio.to_thread(db.get_chat_searchs, message.chat.id)
     
     if not searches:
         text = '📋 **Mis búsquedas**\n\n'
@@ -492,32 +818,32 @@ def show_searches_list(message):
         btn_back = types.InlineKeyboardButton("🔙 Menú Principal", callback_data="main_menu")
         markup.add(btn_back)
     
-    bot.edit_message_text(text, message.chat.id, message.message_id,
-                         parse_mode="Markdown", reply_markup=markup)
+    await bot.edit_message_text(text, message.chat.id, message.message_id,
+                               parse_mode="Markdown", reply_markup=markup)
 
-def handle_delete_search(message, encoded_kws):
+async def handle_delete_search(message, encoded_kws):
     try:
         # Decodificar las palabras clave
         kws = encoded_kws.replace('_', ' ')
         
         # Borrar la búsqueda usando el método existente
-        db.del_chat_search(message.chat.id, kws)
+        await asyncio.to_thread(db.del_chat_search, message.chat.id, kws)
         
         # Mostrar confirmación y lista actualizada
         text = '✅ **Búsqueda eliminada correctamente**\n\n'
         text += f'�️ Eliminada: "{kws}"\n\n'
         text += '📋 Lista actualizada:'
         
-        bot.edit_message_text(text, message.chat.id, message.message_id, parse_mode="Markdown")
-        time.sleep(1)  # Pausa breve para mostrar confirmación
-        show_searches_list(message)
+        await bot.edit_message_text(text, message.chat.id, message.message_id, parse_mode="Markdown")
+        await asyncio.sleep(1)  # Pausa breve para mostrar confirmación
+        await show_searches_list(message)
         
     except Exception as e:
         logging.error(f"Error eliminando búsqueda: {e}")
-        bot.edit_message_text('❌ Error al eliminar la búsqueda', 
-                            message.chat.id, message.message_id)
+        await bot.edit_message_text('❌ Error al eliminar la búsqueda', 
+                                  message.chat.id, message.message_id)
 
-def show_help(message):
+async def show_help(message):
     text = '❓ **Ayuda - WallBot**\n\n'
     text += '🤖 **¿Qué hace este bot?**\n'
     text += 'Busca productos en Wallapop y te notifica cuando encuentra resultados o bajadas de precio.\n\n'
@@ -528,27 +854,185 @@ def show_help(message):
     text += '• 📱 Interfaz visual fácil\n\n'
     text += '📝 **Comandos tradicionales:**\n'
     text += '• `/add producto,min-max,categoría`\n'
+    text += '• `/add iphone -funda` - Excluir palabras con -\n'
     text += '• `/list` - Ver búsquedas\n'
-    text += '• `/del producto` - Borrar búsqueda\n\n'
+    text += '• `/del producto` - Borrar búsqueda\n'
+    text += '• `/history enlace` - Historial de precios de un anuncio\n'
+    text += '• `/stats producto` - Precios de una búsqueda\n'
+    text += '• `/p25 producto` - Avisar solo por debajo del percentil 25\n\n'
     text += '💡 **Tip:** Usa palabras específicas para mejores resultados'
     
-    bot.edit_message_text(text, message.chat.id, message.message_id,
-                         parse_mode="Markdown", reply_markup=create_main_menu())
+    await bot.edit_message_text(text, message.chat.id, message.message_id,
+                               parse_mode="Markdown", reply_markup=create_main_menu())
+
+
+@bot.message_handler(commands=['schedule'])
+async def show_schedule(message):
+    # Solo para administradores: próximas consultas programadas
+    if str(message.chat.id) not in ADMIN_CHAT_IDS:
+        return
+    now = time.time()
+    text = ''
+    if coordinator is not None:
+        # Con varios procesos las consultas las planifica cada scraper: aquí solo el reparto
+        for worker, queries in coordinator.snapshot().items():
+            text += '%s | %d consultas\n' % (worker, queries)
+        await bot.send_message(message.chat.id, text or 'Sin scrapers vivos')
+        return
+    for row in scheduler.snapshot()[:20]:
+        when = 'en curso' if row['next_run'] is None else '%+.0fs' % (row['next_run'] - now)
+        text += '%s | cada %.0fs | %s | %d/%d\n' % (row['key'][0], row['interval'], when, row['hits'], row['runs'])
+    await bot.send_message(message.chat.id, text or 'Sin búsquedas programadas')
+
+
+@bot.message_handler(commands=['trace', 'profile'])
+async def start_tracing(message):
+    # Solo para administradores: /trace N traza las próximas N consultas, /profile N las perfila
+    if str(message.chat.id) not in ADMIN_CHAT_IDS:
+        return
+    parametros = str(message.text).split()
+    n = int(parametros[1]) if len(parametros) > 1 and parametros[1].isdigit() else 10
+    if parametros[0].lstrip('/').startswith('trace'):
+        TRACER.trace_next(n)
+        text = 'Trazando las próximas %d consultas en %s' % (n, TRACER.directory)
+    else:
+        TRACER.profile_next(n)
+        text = 'Perfilando las próximas %d consultas; el resultado irá a %s y al log' % (n, TRACER.directory)
+    await bot.send_message(message.chat.id, text)
+
+
+def history_text(item, summary, points, median):
+    """Mensaje de /history: resumen de item_price, mediana de la consulta y los últimos cambios"""
+    def day(ts):
+        return datetime.datetime.fromtimestamp(ts).strftime('%d/%m/%Y %H:%M')
+
+    text = '%s %s\n' % (u'\U0001F4C8', item.title)  # 📈
+    if summary is not None:
+        _, first_cents, first_ts, min_cents, last_cents, _, changes = summary
+        text += 'Primer precio: %s (%s)\n' % (format_price(first_cents / 100), day(first_ts))
+        text += 'Mínimo: %s\n' % format_price(min_cents / 100)
+        text += 'Actual: %s (%d cambios)\n' % (format_price(last_cents / 100), changes)
+    if median is not None:
+        text += 'Mediana de la búsqueda: %s\n' % format_price(median / 100)
+    if points:
+        text += '\n'
+        for ts, cents in points:
+            text += '%s  %s\n' % (day(ts), format_price(cents / 100))
+    text += 'https://es.wallapop.com/item/' + str(item.url)
+    return text
+
+
+# /history id, url o slug de un anuncio que ha llegado en un aviso
+@bot.message_handler(commands=['history', 'historial'])
+async def show_history(message):
+    parametros = str(message.text).split(' ', 1)
+    if len(parametros) < 2 or not parametros[1].strip():
+        await bot.send_message(message.chat.id, 'Uso: /history <enlace o id del anuncio>')
+        return
+    # https://es.wallapop.com/item/<slug>?... -> <slug>
+    ref = parametros[1].strip().split('?')[0].rstrip('/').rsplit('/', 1)[-1]
+    item = await asyncio.to_thread(db.find_item, message.chat.id, ref)
+    if item is None:
+        await bot.send_message(message.chat.id, 'No encuentro ese anuncio entre los de tus búsquedas')
+        return
+    summary = await asyncio.to_thread(db.get_item_price, item.item_id)
+    points = await asyncio.to_thread(db.get_price_history, item.item_id, 20)
+    median = None
+    if summary is not None and summary[0] is not None:
+        # De la db y no de rolling_prices: con ROLE=bot este proceso no barre
+        rows = await asyncio.to_thread(db.get_search_prices, summary[0], rolling_prices.window)
+        if len(rows) >= rolling_prices.min_samples:
+            median = statistics.median(cents for _, cents in rows)
+    await bot.send_message(message.chat.id, history_text(item, summary, points, median))
+
+
+async def find_chat_search(message, usage):
+    """Búsqueda activa del chat cuyo texto es el del comando (o la única que tenga), o None avisando"""
+    parametros = str(message.text).split(' ', 1)
+    kws = ' '.join(parametros[1].lower().split()) if len(parametros) > 1 else ''
+    searches = await asyncio.to_thread(db.get_chat_searchs, message.chat.id)
+    if not kws and len(searches) == 1:
+        return searches[0]
+    for search in searches:
+        if ' '.join(search.kws.lower().split()) == kws:
+            return search
+    await bot.send_message(message.chat.id, usage if not kws else 'No tienes ninguna búsqueda "%s"' % kws)
+    return None
+
+
+def stats_text(search, summary):
+    """Mensaje de /stats: percentiles sin atípicos, bandas, tendencia y mediana por semana"""
+    def euros(cents):
+        return format_price(cents / 100)
+
+    text = '%s %s\n' % (u'\U0001F4CA', search.kws)  # 📊
+    if 'percentiles' not in summary:
+        text += 'Aún hay pocos precios (%d) para sacar estadísticas' % summary['count']
+        return text
+    p = summary['percentiles']
+    text += '%d precios; %d atípicos fuera de %s - %s\n' % (summary['count'], summary['outliers'],
+                                                        euros(summary['low']), euros(summary['high']))
+    text += 'p10 %s | p25 %s | mediana %s | p75 %s | p90 %s\n' % (
+        euros(p[10]), euros(p[25]), euros(p[50]), euros(p[75]), euros(p[90]))
+    text += 'Media: %s\n' % euros(summary['mean'])
+    if 'trend_30d' in summary:
+        text += 'Tendencia: %+.1f%% en 30 días\n' % (summary['trend_30d'] * 100)
+        text += '\nMediana de salida por semana:\n'
+        for weeks, median, count in summary['weeks'][:8]:
+            when = 'esta semana' if weeks == 0 else 'hace %d sem.' % weeks
+            text += '%s: %s (%d)\n' % (when, euros(median), count)
+    if search.max_percentile is not None:
+        text += '\nSolo avisa hasta el p%d' % search.max_percentile
+        if search.max_percentile in p:
+            text += ' (%s)' % euros(p[search.max_percentile])
+    return text
+
+
+# /stats búsqueda: distribución de precios de la consulta
+@bot.message_handler(commands=['stats', 'estadisticas'])
+async def show_stats(message):
+    if market_stats is None:
+        await bot.send_message(message.chat.id, 'Estadísticas no disponibles en este servidor')
+        return
+    search = await find_chat_search(message, 'Uso: /stats <búsqueda>')
+    if search is None:
+        return
+    summary = await asyncio.to_thread(market_stats.summary, json.dumps(search.query_key()))
+    await bot.send_message(message.chat.id, stats_text(search, summary))
+
+
+# /p25 búsqueda: activa o quita el aviso solo por debajo del percentil 25 de la búsqueda
+@bot.message_handler(commands=['p25'])
+async def toggle_percentile(message):
+    if market_stats is None:
+        await bot.send_message(message.chat.id, 'Estadísticas no disponibles en este servidor')
+        return
+    search = await find_chat_search(message, 'Uso: /p25 <búsqueda>')
+    if search is None:
+        return
+    percentile = None if search.max_percentile is not None else 25
+    await asyncio.to_thread(db.set_search_percentile, message.chat.id, search.kws, percentile)
+    if percentile is None:
+        text = '%s: avisos de todos los precios' % search.kws
+    else:
+        text = '%s: solo avisos por debajo del percentil 25 de la búsqueda (ver /stats %s)' % (search.kws,
+                                                                                              search.kws)
+    await bot.send_message(message.chat.id, text)
 
 
 @bot.message_handler(commands=['del', 'borrar', 'd'])
-def delete_search(message):
+async def delete_search(message):
     parametros = str(message.text).split(' ', 1)
     if len(parametros) < 2:
         # Solo puso el comando
         return
-    db.del_chat_search(message.chat.id, ' '.join(parametros[1:]))
+    await asyncio.to_thread(db.del_chat_search, message.chat.id, ' '.join(parametros[1:]))
 
 
 @bot.message_handler(commands=['lis', 'listar', 'l'])
-def get_searchs(message):
+async def get_searchs(message):
     text = ''
-    for chat_search in db.get_chat_searchs(message.chat.id):
+    for chat_search in await asyncio.to_thread(db.get_chat_searchs, message.chat.id):
         if len(text) > 0:
             text += '\n'
         text += chat_search.kws
@@ -561,13 +1045,15 @@ def get_searchs(message):
         if chat_search.cat_ids is not None:
             text += '|'
             text += chat_search.cat_ids
+        if chat_search.max_percentile is not None:
+            text += '|p%d' % chat_search.max_percentile
     if len(text) > 0:
-        bot.send_message(message.chat.id, (text,))
+        await bot.send_message(message.chat.id, (text,))
 
 
 # /add búsqueda,min-max,categorías separadas por comas
 @bot.message_handler(commands=['add', 'añadir', 'append', 'a'])
-def add_search(message):
+async def add_search(message):
     cs = ChatSearch()
     cs.chat_id = message.chat.id
     parametros = str(message.text).split(' ', 1)
@@ -592,7 +1078,7 @@ def add_search(message):
     cs.name = message.from_user.first_name
     cs.active = 1
     logging.info('%s', cs)
-    db.add_search(cs)
+    await asyncio.to_thread(db.add_search, cs)
     
     # Enviar mensaje de confirmación
     confirmation_text = f"✅ *Búsqueda añadida correctamente*\n\n"
@@ -608,12 +1094,12 @@ def add_search(message):
     if cs.cat_ids is not None:
         confirmation_text += f"📂 Categorías: `{cs.cat_ids}`\n"
     
-    bot.send_message(message.chat.id, confirmation_text, parse_mode='Markdown')
+    await bot.send_message(message.chat.id, confirmation_text, parse_mode='Markdown')
 
 
 # Manejador para texto cuando el usuario está en un wizard
 @bot.message_handler(func=lambda message: message.chat.id in user_states)
-def handle_wizard_text(message):
+async def handle_wizard_text(message):
     user_id = message.chat.id
     state = user_states.get(user_id, {})
     
@@ -622,20 +1108,20 @@ def handle_wizard_text(message):
         keywords = message.text.strip()
         
         if not keywords:
-            bot.send_message(user_id, "❌ Por favor, escribe algo para buscar")
+            await bot.send_message(user_id, "❌ Por favor, escribe algo para buscar")
             return
         
         # Guardar keywords y mostrar opciones de precio
         user_states[user_id]['keywords'] = keywords
         user_states[user_id]['step'] = 'select_price'
         
-        show_price_selection_step(message, keywords)
+        await show_price_selection_step(message, keywords)
     
     elif state.get('step') == 'waiting_custom_price':
         # Usuario escribió precio personalizado
-        handle_custom_price_input(message)
+        await handle_custom_price_input(message)
 
-def show_price_selection_step(message, keywords):
+async def show_price_selection_step(message, keywords):
     text = f'➕ **Añadir nueva búsqueda - Paso 2/2**\n\n'
     text += f'🔍 Producto: `{keywords}`\n\n'
     text += '� **¿Qué rango de precio te interesa?**\n'
@@ -664,10 +1150,10 @@ def show_price_selection_step(message, keywords):
     btn_back = types.InlineKeyboardButton("🔙 Cambiar búsqueda", callback_data="add_search")
     markup.add(btn_back)
     
-    bot.send_message(message.chat.id, text, parse_mode='Markdown', reply_markup=markup)
+    await bot.send_message(message.chat.id, text, parse_mode='Markdown', reply_markup=markup)
 
 
-def handle_wizard_price_selection(message, callback_data, user_id):
+async def handle_wizard_price_selection(message, callback_data, user_id):
     price_selection = callback_data[9:]  # Quitar "wizprice_"
     state = user_states.get(user_id, {})
     keywords = state.get('keywords', '')
@@ -690,7 +1176,7 @@ def handle_wizard_price_selection(message, callback_data, user_id):
         markup.add(btn_cancel)
         
         # Enviar un mensaje nuevo en lugar de editar
-        bot.send_message(message.chat.id, text, parse_mode="Markdown", reply_markup=markup)
+        await bot.send_message(message.chat.id, text, parse_mode="Markdown", reply_markup=markup)
         
         user_states[user_id]['step'] = 'waiting_custom_price'
         return
@@ -706,9 +1192,9 @@ def handle_wizard_price_selection(message, callback_data, user_id):
             max_price = parts[1] if len(parts) > 1 and parts[1] else None
     
     # Crear la búsqueda
-    create_final_search(message, user_id, keywords, min_price, max_price)
+    await create_final_search(message, user_id, keywords, min_price, max_price)
 
-def create_final_search(message, user_id, keywords, min_price, max_price):
+async def create_final_search(message, user_id, keywords, min_price, max_price):
     try:
         # Crear búsqueda
         cs = ChatSearch()
@@ -721,7 +1207,7 @@ def create_final_search(message, user_id, keywords, min_price, max_price):
         cs.active = 1
         
         logging.info('Creando búsqueda: %s', cs)
-        db.add_search(cs)
+        await asyncio.to_thread(db.add_search, cs)
         
         # Mensaje de confirmación final
         text = '✅ **¡Búsqueda creada exitosamente!**\n\n'
@@ -741,7 +1227,7 @@ def create_final_search(message, user_id, keywords, min_price, max_price):
         markup = create_main_menu()
         
         # Usar send_message en lugar de edit_message_text para evitar problemas
-        bot.send_message(user_id, text, parse_mode='Markdown', reply_markup=markup)
+        await bot.send_message(user_id, text, parse_mode='Markdown', reply_markup=markup)
         
         # Limpiar estado
         if user_id in user_states:
@@ -752,14 +1238,14 @@ def create_final_search(message, user_id, keywords, min_price, max_price):
         error_text = "❌ **Error al crear la búsqueda**\n\n"
         error_text += "Inténtalo de nuevo con /start"
         
-        bot.send_message(user_id, error_text, parse_mode='Markdown')
+        await bot.send_message(user_id, error_text, parse_mode='Markdown')
         
         # Limpiar estado incluso si hay error
         if user_id in user_states:
             del user_states[user_id]
 
 
-def handle_custom_price_input(message):
+async def handle_custom_price_input(message):
     user_id = message.chat.id
     state = user_states.get(user_id, {})
     keywords = state.get('keywords', '')
@@ -814,8 +1300,8 @@ def handle_custom_price_input(message):
         success_text += f"💰 Precio: {min_price or '0'}€ - {max_price or '∞'}€\n\n"
         success_text += "⏳ Creando búsqueda..."
         
-        bot.send_message(user_id, success_text, parse_mode='Markdown')
-        create_final_search(message, user_id, keywords, min_price, max_price)
+        await bot.send_message(user_id, success_text, parse_mode='Markdown')
+        await create_final_search(message, user_id, keywords, min_price, max_price)
         
     except ValueError as e:
         error_text = f"❌ **Error en el formato**\n\n"
@@ -827,14 +1313,14 @@ def handle_custom_price_input(message):
         error_text += f"• `150` → máximo 150€\n\n"
         error_text += f"💡 Vuelve a escribir el precio:"
         
-        bot.send_message(user_id, error_text, parse_mode='Markdown')
+        await bot.send_message(user_id, error_text, parse_mode='Markdown')
         
     except Exception as e:
         logging.error(f"Error procesando precio personalizado: {e}")
         error_text = f"❌ **Error inesperado**\n\n"
         error_text += f"Inténtalo de nuevo o cancela con /start"
         
-        bot.send_message(user_id, error_text, parse_mode='Markdown')
+        await bot.send_message(user_id, error_text, parse_mode='Markdown')
 
 def is_valid_price(price_str):
     """Validar que una cadena sea un precio válido (número positivo)"""
@@ -852,13 +1338,16 @@ def is_valid_price(price_str):
 
 # Configurar ruta de logs según el entorno
 pathlog = 'wallbot.log'
+if shard is not None:
+    # Varios scrapers comparten el directorio de logs: cada uno rota su propio fichero
+    pathlog = 'wallbot-%s.log' % shard.worker_id
 if PROFILE is None:
     pathlog = '/logs/' + pathlog
 else:
     # En Docker o entornos controlados, usar directorio específico
     log_dir = os.getenv('LOG_DIR', '/app/logs')
     os.makedirs(log_dir, exist_ok=True)
-    pathlog = os.path.join(log_dir, 'wallbot.log')
+    pathlog = os.path.join(log_dir, pathlog)
 
 logging.basicConfig(
     handlers=[RotatingFileHandler(pathlog, maxBytes=1000000, backupCount=10)],
@@ -866,7 +1355,20 @@ logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %H:%M:%S')
 
-locale.setlocale(locale.LC_ALL, 'es_ES.UTF-8')
+try:
+    locale.setlocale(locale.LC_ALL, 'es_ES.UTF-8')
+except locale.Error as e:
+    # Fuera de Docker puede no estar generado el locale; format_price tira de un formato fijo
+    logging.warning("Locale es_ES.UTF-8 no disponible: %s", e)
+
+if market_stats is None:
+    logging.warning('Sin estadísticas de mercado (/stats, /p25): %s', market_stats_error)
+
+# Trazas y perfilado bajo demanda (también con /trace N y /profile N)
+TRACER.directory = os.getenv('TRACE_DIR', os.path.dirname(pathlog) or '.')
+TRACER.format = os.getenv('TRACE_FORMAT', 'jsonl')
+TRACER.trace_next(int(os.getenv('TRACE_SWEEPS', '0')))
+TRACER.profile_next(int(os.getenv('PROFILE_SWEEPS', '0')))
 
 #logger = telebot.logger
 #formatter = logging.Formatter('[%(asctime)s] %(thread)d {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s',
@@ -879,43 +1381,257 @@ locale.setlocale(locale.LC_ALL, 'es_ES.UTF-8')
 
 # FIN
 
-def wallapop():
-    while True:
-        # Recupera de db las búsquedas que hay que hacer en wallapop con sus respectivos chats_id
-        for search in db.get_chats_searchs():
-            u = get_url_list(search)
-
-            # Lanza las búsquedas y notificaciones ...
-            get_items(u, search.chat_id, search.kws)
+def collect_metrics():
+    """Copia a gauges el estado que llevan la cola, las cachés, los pools y el circuito"""
+    for field, value in notifier.stats().items():
+        NOTIFY_QUEUE.set(value, field=field)
+    components = {
+        'db': db.stats(),
+        'seller_cache': seller_cache.stats(),
+        'item_cache': item_cache.stats(),
+        'rolling_prices': rolling_prices.stats(),
+        'market_stats': market_stats.stats() if market_stats is not None else {},
+        'seen_filter': seen_filter.stats() if seen_filter is not None else {},
+        'http_wallapop': wallapop_http.stats(),
+        'http_telegram': telegram_http.stats(),
+        'wallapop_limiter': wallapop_limiter.stats(),
+        'wallapop_breaker': wallapop_breaker.stats(),
+        'webhook': webhook_server.stats() if webhook_server is not None else {},
+        'shard_coordinator': coordinator.stats() if coordinator is not None else {},
+    }
+    for component, stats in components.items():
+        for field, value in stats.items():
+            if isinstance(value, (int, float)):
+                COMPONENT_STATS.set(value, component=component, field=field)
+    states = (CircuitBreaker.CLOSED, CircuitBreaker.HALF_OPEN, CircuitBreaker.OPEN)
+    COMPONENT_STATS.set(states.index(wallapop_breaker.state), component='wallapop_breaker', field='state_code')
 
-        # Borrar items antiguos (> 24hrs?)
-        # No parece buena idea. Vuelven a entrar cada 5min algunos
-        # db.deleteItems(24)
 
-        time.sleep(300)
-        continue
+def run_query(key, search, chat_ids, matcher, limits=None, variants=None):
+    """Lanza una consulta y la vuelve a programar según las novedades que traiga"""
+    hits = 0
+    try:
+        with SWEEP_DURATION.time(), TRACER.sweep('get_items', kws=search.kws, chats=len(chat_ids)):
+            hits = get_items(search, chat_ids, matcher, limits, variants)
+    finally:
+        scheduler.done(key, hits)
 
 
-def recovery(times):
+async def wait_stop(timeout):
+    """Como executor.wait, pero sin bloquear el bucle de eventos. Devuelve True si hay que parar"""
     try:
-        time.sleep(times)
+        await asyncio.wait_for(stopped.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+async def wallapop():
+    """Planificador: en el bucle de eventos del bot, lanza al pool de búsquedas las consultas a las que les toca"""
+    launched = 0
+    last_report = time.monotonic()
+    while not stopped.is_set():
+        # Recupera de db las búsquedas que hay que hacer en wallapop con sus respectivos chats_id
+        searches = await asyncio.to_thread(db.get_chats_searchs)
+        # Una sola petición por consulta distinta, repartida a todos sus chats
+        groups = group_searches(searches)
+        if shard is not None:
+            # Scraper: solo las consultas que le ha asignado el coordinador
+            owned = await asyncio.to_thread(shard.owned)
+            groups = {key: group for key, group in groups.items() if json.dumps(key) in owned}
+        scheduler.sync(groups.keys())
+        heartbeat.beat(len(groups), scheduler.shortest_interval())
+        ACTIVE_SEARCHES.set(len(searches), kind='searches')
+        ACTIVE_SEARCHES.set(len(groups), kind='queries')
+        # Un solo autómata con las palabras de todas las búsquedas activas, cacheado mientras no cambien
+        matcher = compile_matcher(frozenset(kws for _, _, _, variants in groups.values() for kws in variants))
+
+        # Con el circuito abierto no se lanza nada: las consultas esperan su turno en la cola
+        if wallapop_breaker.retry_in() > 0:
+            if await wait_stop(min(wallapop_breaker.retry_in(), SCHEDULER_TICK)):
+                break
+            continue
+
+        # Lanza en paralelo las consultas a las que les toca ...
+        for key in scheduler.due():
+            search, chat_ids, limits, variants = groups[key]
+            executor.submit(run_query, key, search, chat_ids, matcher, limits, variants)
+            launched += 1
+
+        if time.monotonic() - last_report >= SWEEP_INTERVAL:
+            logging.info('Planificador: %d consultas lanzadas, %d consultas activas (%d búsquedas)',
+                         launched, len(groups), len(searches))
+            logging.info('Caché de vendedores: %s', seller_cache.stats())
+            logging.info('Caché de items: %s', item_cache.stats())
+            logging.info('HTTP: %s %s', wallapop_http.stats(), telegram_http.stats())
+            logging.info('Wallapop: limitador %s, circuito %s', wallapop_limiter.stats(), wallapop_breaker.stats())
+            logging.info('Notificaciones: %s', notifier.stats())
+            launched = 0
+            last_report = time.monotonic()
+
+        if await wait_stop(min(scheduler.next_wakeup(), SCHEDULER_TICK)):
+            break
+
+
+def retention():
+    """Mantenimiento cada RETENTION_INTERVAL: filtro de vistos, borrado por lotes de caducados y compactación"""
+    while True:
+        # El filtro se rehace desde la db si no existe o se ha llenado
+        if seen_filter is not None and seen_filter.needs_rebuild:
+            try:
+                item_cache.rebuild_filter()
+                logging.info('Filtro de items vistos rehecho: %s', seen_filter.stats())
+            except Exception as e:
+                logging.error('No se pudo rehacer el filtro de items vistos: %s', e)
+
+        now = time.time()
+        expired = 0
+        while ITEM_RETENTION_DAYS > 0:
+            batch = db.expire_items(now - ITEM_RETENTION_DAYS * 24 * 60 * 60, RETENTION_BATCH, now)
+            item_cache.forget(batch)
+            expired += len(batch)
+            # Entre lote y lote se suelta la db para no frenar los barridos
+            if len(batch) < RETENTION_BATCH or executor.wait(0.1):
+                break
+        tombstones = 0
+        while True:
+            deleted = db.expire_tombstones(now - TOMBSTONE_RETENTION_DAYS * 24 * 60 * 60, RETENTION_BATCH)
+            tombstones += deleted
+            if deleted < RETENTION_BATCH or executor.wait(0.1):
+                break
+        if expired or tombstones:
+            item_cache.load_tombstones()
+        histories = 0
+        while PRICE_HISTORY_DAYS > 0:
+            deleted = db.expire_price_history(now - PRICE_HISTORY_DAYS * 24 * 60 * 60, RETENTION_BATCH)
+            histories += deleted
+            if deleted < RETENTION_BATCH or executor.wait(0.1):
+                break
+        free_pages = db.compact()
+        ITEMS.inc(expired, kind='expired')
+        logging.info('Retención: %d items caducados, %d lápidas borradas, %d historiales de precio borrados, '
+                     '%s páginas libres', expired, tombstones, histories, free_pages)
+        if executor.wait(RETENTION_INTERVAL):
+            return
+
+
+async def polling():
+    """Long polling de Telegram; si se corta, se reconecta en bucle esperando 1s, 2s, 4s... hasta POLLING_MAX_BACKOFF"""
+    backoff = 1
+    while not stopped.is_set():
+        started = time.monotonic()
         logging.info("Conexión a Telegram.")
-        print("Conexión a Telegram")
-        bot.polling(none_stop=True, timeout=3000)
-    except Exception as e:
-        logging.error("Ha ocurrido un error con la llamada a Telegram. Se reintenta la conexión", e)
-        print("Ha ocurrido un error con la llamada a Telegram. Se reintenta la conexión")
-        if times > 16:
-            times = 16
-        recovery(times*2)
+        try:
+            # Si antes se usó el modo webhook, getUpdates da error mientras siga registrado
+            await bot.remove_webhook()
+            # Con non_stop=False la librería devuelve el control al primer error en vez de reintentar ella
+            await bot.polling(non_stop=False, timeout=POLLING_TIMEOUT)
+        except Exception as e:
+            logging.error("Ha ocurrido un error con la llamada a Telegram: %s", e)
+        if stopped.is_set():
+            return
+        # Si la conexión ha aguantado un rato, se vuelve a empezar por la espera mínima
+        if time.monotonic() - started > POLLING_MAX_BACKOFF:
+            backoff = 1
+        RECONNECTS.inc()
+        logging.error("Se ha cortado la conexión a Telegram. Se reintenta en %.0fs", backoff)
+        if await wait_stop(backoff):
+            return
+        backoff = min(backoff * 2, POLLING_MAX_BACKOFF)
+
+
+async def webhook():
+    """Modo webhook: levanta el servidor y registra la url en Telegram, reintentando con la misma espera que polling"""
+    await webhook_server.start()
+    try:
+        backoff = 1
+        while True:
+            try:
+                await webhook_server.register()
+                logging.info("Webhook registrado en Telegram: %s", WEBHOOK_URL)
+                break
+            except Exception as e:
+                RECONNECTS.inc()
+                logging.error("No se pudo registrar el webhook en Telegram. Se reintenta en %.0fs: %s", backoff, e)
+            if await wait_stop(backoff):
+                return
+            backoff = min(backoff * 2, POLLING_MAX_BACKOFF)
+        await stopped.wait()
+    finally:
+        await webhook_server.stop()
+
+
+def shutdown(signum):
+    logging.info("Parando (señal %s)...", signum)
+    executor.shutdown(wait_running=False)
+    stopped.set()
+
+
+async def coordinate():
+    """ROLE=bot: reparte las consultas activas entre los scrapers vivos cada SHARD_INTERVAL segundos"""
+    while not stopped.is_set():
+        searches = await asyncio.to_thread(db.get_chats_searchs)
+        keys = [json.dumps(key) for key in group_searches(searches)]
+        await asyncio.to_thread(coordinator.rebalance, keys)
+        heartbeat.beat()
+        ACTIVE_SEARCHES.set(len(searches), kind='searches')
+        ACTIVE_SEARCHES.set(len(keys), kind='queries')
+        if await wait_stop(SHARD_INTERVAL):
+            return
+
+
+async def shard_heartbeat():
+    """ROLE=scraper: latido en la tabla worker cada SHARD_INTERVAL segundos, aunque el planificador esté parado"""
+    while not stopped.is_set():
+        await asyncio.to_thread(shard.beat)
+        if await wait_stop(SHARD_INTERVAL):
+            return
+
+
+async def run():
+    """Bot (polling o webhook) y planificador en un solo bucle de eventos; las consultas siguen en los hilos de executor"""
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, shutdown, signum)
+    tasks = []
+    if ROLE != 'bot':
+        tasks.append(asyncio.create_task(wallapop()))
+    if ROLE != 'scraper':
+        tasks.append(asyncio.create_task(webhook() if webhook_server is not None else polling()))
+    if coordinator is not None:
+        tasks.append(asyncio.create_task(coordinate()))
+    if shard is not None:
+        tasks.append(asyncio.create_task(shard_heartbeat()))
+    await stopped.wait()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if ROLE != 'scraper':
+        await bot.close_session()
 
 
 def main():
     print("JanJanJan starting...")
-    logging.info("JanJanJan starting...")
-    db.setup(readVersion())
-    threading.Thread(target=wallapop).start()
-    recovery(1)
+    logging.info("JanJanJan starting (ROLE=%s)...", ROLE)
+    readVersion()
+    db.setup()
+    if ROLE != 'bot':
+        item_cache.warm()
+    if ROLE != 'scraper':
+        notifier.start()
+    if METRICS_PORT:
+        metrics.REGISTRY.on_collect(collect_metrics)
+        metrics.start_http_server(METRICS_PORT, heartbeat)
+    # La retención la hace un solo proceso
+    if ROLE != 'scraper':
+        threading.Thread(target=retention, name='retention', daemon=True).start()
+    asyncio.run(run())
+    notifier.shutdown()
+    if shard is not None:
+        shard.leave()
+    if seen_filter is not None:
+        seen_filter.close()
+    db.close()
 
 
 def readVersion():
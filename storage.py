@@ -0,0 +1,199 @@
+"""Interfaz común de almacenamiento del bot.
+
+``DBHelper`` (SQLite, un fichero y una conexión) y ``PgHelper``
+(PostgreSQL con un pool de conexiones, para varios procesos que escriben a
+la vez) implementan los mismos métodos con la misma semántica: búsquedas,
+items, caché de vendedores, cola de notificaciones (outbox) y las tablas de
+retención y reparto de consultas. Como en ``DBHelper``, los métodos no
+lanzan excepciones de la db: la imprimen y devuelven un valor por defecto.
+
+``tests/test_storage.py`` pasa las mismas pruebas a los dos.
+"""
+
+SEARCH_COLUMNS = ('chat_id', 'kws', 'cat_ids', 'min_price', 'max_price', 'dist', 'publish_date', 'ord',
+                  'username', 'name', 'active', 'max_percentile')
+
+
+def _blank(value):
+    # "/add algo,-100" deja min_price = ''
+    return None if isinstance(value, str) and not value.strip() else value
+
+
+def _default(value, default):
+    return default if value is None else value
+
+
+def search_row(chat_search):
+    """Valores de una búsqueda en el orden de SEARCH_COLUMNS, con los valores por defecto de la tabla"""
+    cs = chat_search
+    return (str(cs.chat_id), cs.kws, cs.cat_ids, _blank(cs.min_price), _blank(cs.max_price),
+            _default(cs.dist, 400), _default(cs.publish_date, 24), _default(cs.orde, 'newest'),
+            cs.username, cs.name, _default(cs.active, 1), cs.max_percentile)
+
+
+class Storage:
+    """Métodos que usa el bot. Las subclases implementan todos"""
+
+    def setup(self):
+        """Crea las tablas o las migra a la última versión"""
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def stats(self):
+        """Contadores para /metrics"""
+        return {}
+
+    # Búsquedas
+    def add_search(self, chat_search):
+        """(chat_id, kws) es único: volver a añadir una búsqueda la reemplaza y reactiva"""
+        raise NotImplementedError
+
+    def get_chat_searchs(self, chat_id):
+        """Búsquedas activas de un chat: [ChatSearch]"""
+        raise NotImplementedError
+
+    def get_chats_searchs(self):
+        """Búsquedas activas de todos los chats: [ChatSearch]"""
+        raise NotImplementedError
+
+    def del_chat_search(self, chat_id, kws):
+        raise NotImplementedError
+
+    def set_search_percentile(self, chat_id, kws, percentile):
+        """Cambia max_percentile de una búsqueda activa (None lo quita). True si existe"""
+        raise NotImplementedError
+
+    # Items
+    def add_item(self, item_id, chat_id, title, price, url, user, publish_date=None, observaciones=None):
+        raise NotImplementedError
+
+    def update_item(self, item_id, price, obs, chat_id):
+        raise NotImplementedError
+
+    def delete_items(self, hours_live):
+        raise NotImplementedError
+
+    def search_item(self, item_id, chat_id):
+        """Item o None"""
+        raise NotImplementedError
+
+    def search_items(self, item_ids, chat_id):
+        """{str(itemId): Item} de los que existan"""
+        raise NotImplementedError
+
+    def save_items(self, new_items, updates, seen=(), now=None, prices=()):
+        """Inserta, abarata y marca como vistos en una transacción.
+
+        prices: tuplas (item_id, clave de consulta, céntimos) para el historial de
+        precios; solo se apunta un punto si el precio del item ha cambiado.
+        Devuelve el conjunto de (str(item_id), str(chat_id)) que ha insertado
+        o abaratado esta llamada (y no otro proceso), o None si ha fallado.
+        """
+        raise NotImplementedError
+
+    def find_item(self, chat_id, ref):
+        """Item del chat cuyo id o url (slug) es `ref`, o None"""
+        raise NotImplementedError
+
+    def get_item_prices(self, limit):
+        """(itemId, chatId, precio, lastSeen) de los `limit` items más recientes, del más nuevo al más viejo"""
+        raise NotImplementedError
+
+    def get_item_pairs(self, after_rowid, limit):
+        """(posición, itemId, chatId) en orden de posición a partir de `after_rowid`"""
+        raise NotImplementedError
+
+    def count_items(self):
+        raise NotImplementedError
+
+    # Retención
+    def expire_items(self, cutoff, limit, now=None):
+        """Borra hasta `limit` items no vistos desde `cutoff` dejando su lápida. Devuelve [(itemId, chatId, hash)]"""
+        raise NotImplementedError
+
+    def expire_tombstones(self, cutoff, limit):
+        raise NotImplementedError
+
+    def get_tombstone_hashes(self):
+        raise NotImplementedError
+
+    def get_tombstones(self, hashes):
+        """{hash: último precio}"""
+        raise NotImplementedError
+
+    # Historial de precios
+    def get_price_history(self, item_id, limit=50):
+        """Los últimos `limit` puntos (ts, céntimos) del item, del más viejo al más nuevo"""
+        raise NotImplementedError
+
+    def get_item_price(self, item_id):
+        """(clave de consulta, primer precio, su ts, mínimo, último, su ts, cambios) o None"""
+        raise NotImplementedError
+
+    def get_search_prices(self, query_key, limit):
+        """[(itemId, último precio)] de los `limit` items de la consulta con cambios más recientes"""
+        raise NotImplementedError
+
+    def get_price_series(self, query_key, since=0):
+        """[(id, firstTs, firstCents, lastCents, lastTs)] de los items de la consulta con lastTs >= `since`.
+
+        id es un entero estable por item (rowid o item_price.id) para sustituir
+        en memoria los que han cambiado de precio.
+        """
+        raise NotImplementedError
+
+    def expire_price_history(self, cutoff, limit):
+        """Borra el historial de hasta `limit` items sin cambios desde `cutoff` que ya no están en item"""
+        raise NotImplementedError
+
+    def compact(self, pages=1000):
+        """Devuelve espacio al sistema si el motor lo necesita; el número de páginas libres o None"""
+        raise NotImplementedError
+
+    # Vendedores
+    def get_seller(self, user_id):
+        """(fetchedAt, info) o None"""
+        raise NotImplementedError
+
+    def save_seller(self, user_id, info, fetched_at):
+        raise NotImplementedError
+
+    # Outbox
+    def add_outbox(self, chat_id, text, created_at):
+        """Id del mensaje o None"""
+        raise NotImplementedError
+
+    def get_outbox(self):
+        raise NotImplementedError
+
+    def delete_outbox(self, outbox_id):
+        raise NotImplementedError
+
+    def retry_outbox(self, outbox_id, attempts):
+        raise NotImplementedError
+
+    # Estado de las consultas y reparto entre procesos
+    def get_search_state(self, query_key):
+        raise NotImplementedError
+
+    def save_search_state(self, query_key, last_item_id, last_ts, last_full_scan):
+        raise NotImplementedError
+
+    def heartbeat_worker(self, worker_id, role, now):
+        raise NotImplementedError
+
+    def get_workers(self, alive_since, role='scraper'):
+        raise NotImplementedError
+
+    def delete_workers(self, before=None, worker_id=None):
+        raise NotImplementedError
+
+    def get_assignments(self, worker_id=None):
+        """{clave de consulta: workerId}, o None si ha fallado"""
+        raise NotImplementedError
+
+    def save_assignments(self, assigned, removed, now):
+        """True si se ha guardado"""
+        raise NotImplementedError
@@ -0,0 +1,215 @@
+"""Trazas de tiempo por barrido y perfilado con cProfile, bajo demanda.
+
+Desactivado no cuesta casi nada: ``traced`` solo mira un entero antes de
+llamar a la función. Para activarlo se piden N barridos, por variable de
+entorno al arrancar o con los comandos de administración ``/trace N`` y
+``/profile N``. Las trazas se escriben en JSON lines (un barrido por línea)
+o en el formato de Chrome (chrome://tracing, Perfetto).
+"""
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+
+
+class _NoopContext:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NOOP = _NoopContext()
+
+
+class _Sweep:
+    def __init__(self, tracer, name, args, trace, profile):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.trace = trace
+        self.profile = profile
+
+    def __enter__(self):
+        local = self.tracer._local
+        if self.trace:
+            local.events = []
+            with self.tracer._lock:
+                self.tracer.recording += 1
+        if self.profile:
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError as e:
+                # Otro perfilador activo en el proceso
+                logging.warning("No se pudo perfilar: %s", e)
+                self.profile = False
+                self.tracer._add_profile(None)
+        self.start = time.time()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.t0
+        if self.profile:
+            self.profiler.disable()
+            self.tracer._add_profile(self.profiler)
+        if self.trace:
+            local = self.tracer._local
+            events, local.events = local.events, None
+            with self.tracer._lock:
+                self.tracer.recording -= 1
+            self.tracer._write(self.name, self.args, self.start, self.t0, duration, events)
+        return False
+
+
+class _Span:
+    __slots__ = ('events', 'name', 'args', 't0')
+
+    def __init__(self, events, name, args):
+        self.events = events
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.events.append((self.name, self.t0, time.perf_counter() - self.t0, self.args))
+        return False
+
+
+class Tracer:
+    def __init__(self, directory='.', fmt='jsonl', trace_sweeps=0, profile_sweeps=0):
+        self.directory = directory
+        self.format = fmt
+        self.trace_left = trace_sweeps
+        self.profile_left = profile_sweeps
+        # Barridos trazándose ahora mismo; si es 0, los spans no hacen nada
+        self.recording = 0
+        self._profile_stats = None
+        self._profile_running = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def trace_next(self, n):
+        with self._lock:
+            self.trace_left = n
+
+    def profile_next(self, n):
+        with self._lock:
+            self.profile_left = n
+
+    def sweep(self, name, **args):
+        """Contexto de un barrido; solo traza/perfila si quedan barridos pedidos"""
+        if not self.trace_left and not self.profile_left:
+            return NOOP
+        with self._lock:
+            trace = self.trace_left > 0
+            # cProfile solo admite un perfilador activo a la vez (Python >= 3.12): uno por vez
+            profile = self.profile_left > 0 and not self._profile_running
+            if trace:
+                self.trace_left -= 1
+            if profile:
+                self.profile_left -= 1
+                self._profile_running += 1
+        return _Sweep(self, name, args, trace, profile)
+
+    def span(self, name, **args):
+        if not self.recording:
+            return NOOP
+        events = getattr(self._local, 'events', None)
+        if events is None:
+            return NOOP
+        return _Span(events, name, args)
+
+    def traced(self, name=None):
+        """Decorador: mide la función como span cuando el barrido se está trazando"""
+        def decorator(fn):
+            span_name = name or fn.__name__
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.recording:
+                    return fn(*args, **kwargs)
+                with self.span(span_name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _path(self, suffix):
+        return os.path.join(self.directory, 'trace-%s.%s' % (time.strftime('%Y%m%d'), suffix))
+
+    def _write(self, name, args, start, t0, duration, events):
+        try:
+            if self.format == 'chrome':
+                self._write_chrome(name, args, start, t0, duration, events)
+            else:
+                self._write_jsonl(name, args, start, t0, duration, events)
+        except Exception as e:
+            logging.warning("No se pudo escribir la traza: %s", e)
+
+    def _write_jsonl(self, name, args, start, t0, duration, events):
+        record = {
+            'sweep': name,
+            'args': args,
+            'start': start,
+            'duration': duration,
+            'spans': [{'name': n, 'offset': round(t - t0, 6), 'duration': round(d, 6), 'args': a}
+                      for n, t, d, a in events],
+        }
+        line = json.dumps(record, default=str)
+        with self._lock, open(self._path('jsonl'), 'a') as f:
+            f.write(line + '\n')
+
+    def _write_chrome(self, name, args, start, t0, duration, events):
+        # Formato "JSON Array" de Chrome: el ']' final es opcional, así que se puede ir añadiendo
+        pid = os.getpid()
+        tid = threading.get_ident()
+        start_us = start * 1e6
+        trace = [{'name': name, 'ph': 'X', 'ts': start_us, 'dur': duration * 1e6,
+                  'pid': pid, 'tid': tid, 'args': args}]
+        for n, t, d, a in events:
+            trace.append({'name': n, 'ph': 'X', 'ts': start_us + (t - t0) * 1e6, 'dur': d * 1e6,
+                          'pid': pid, 'tid': tid, 'args': a})
+        path = self._path('json')
+        with self._lock:
+            new = not os.path.exists(path)
+            with open(path, 'a') as f:
+                if new:
+                    f.write('[\n')
+                for event in trace:
+                    f.write(json.dumps(event, default=str) + ',\n')
+
+    def _add_profile(self, profiler):
+        with self._lock:
+            if profiler is None:
+                pass
+            elif self._profile_stats is None:
+                self._profile_stats = pstats.Stats(profiler)
+            else:
+                self._profile_stats.add(profiler)
+            self._profile_running -= 1
+            if self._profile_running or self.profile_left or self._profile_stats is None:
+                return
+            stats, self._profile_stats = self._profile_stats, None
+        path = os.path.join(self.directory, 'profile-%s.prof' % time.strftime('%Y%m%d-%H%M%S'))
+        try:
+            stats.dump_stats(path)
+            out = io.StringIO()
+            stats.stream = out
+            stats.sort_stats('cumulative').print_stats(20)
+            logging.info("Perfil guardado en %s\n%s", path, out.getvalue())
+        except Exception as e:
+            logging.warning("No se pudo guardar el perfil: %s", e)
+
+
+# Tracer del proceso; ssbo lo configura al arrancar
+TRACER = Tracer()
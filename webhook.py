@@ -0,0 +1,121 @@
+import asyncio
+import hmac
+import logging
+import time
+from urllib.parse import urlsplit
+
+from aiohttp import web
+from telebot import types
+
+from metrics import Histogram
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+UPDATE_LATENCY = Histogram('wallbot_webhook_update_seconds',
+                           'Tiempo desde que llega una actualización por el webhook hasta que acaban sus handlers')
+
+
+class WebhookServer:
+    """Servidor HTTP (aiohttp) que recibe las actualizaciones de Telegram en modo webhook.
+
+    Va en el mismo bucle de eventos que el bot. Cada POST tiene que traer la
+    cabecera ``X-Telegram-Bot-Api-Secret-Token`` con ``secret``; si no, 401.
+    La actualización se deja en una cola de ``queue_size`` y se responde a
+    Telegram sin esperar a los handlers. ``workers`` tareas vacían la cola,
+    así que se atienden varias actualizaciones a la vez pero nunca más de
+    ``workers``. Con la cola llena la respuesta espera a que haya hueco, y
+    Telegram no abre más de ``max_connections`` peticiones a la vez.
+    """
+
+    def __init__(self, bot, url, secret, host='0.0.0.0', port=8443, path=None, workers=8, queue_size=100,
+                 max_connections=40):
+        self.bot = bot
+        self.url = url
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.path = path or urlsplit(url).path or '/'
+        self.workers = workers
+        self.max_connections = max_connections
+        self._queue = asyncio.Queue(queue_size)
+        self._tasks = []
+        self._runner = None
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.invalid = 0
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(self.path, self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logging.info("Webhook escuchando en %s:%d%s", self.host, self.port, self.path)
+
+    async def register(self):
+        """Da de alta la url en Telegram con el secreto; lanza la excepción de la API si falla"""
+        await self.bot.set_webhook(url=self.url, secret_token=self.secret, max_connections=self.max_connections)
+
+    async def _handle(self, request):
+        token = request.headers.get(SECRET_HEADER, '').encode()
+        if not hmac.compare_digest(token, self.secret.encode()):
+            self.rejected += 1
+            return web.Response(status=401)
+        try:
+            update = types.Update.de_json(await request.text())
+        except Exception as e:
+            self.invalid += 1
+            logging.warning("Actualización no válida en el webhook: %s", e)
+            return web.Response(status=400)
+        await self._queue.put((time.monotonic(), update))
+        self.received += 1
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            received_at, update = await self._queue.get()
+            try:
+                await self.bot.process_new_updates([update])
+            except Exception as e:
+                self.failed += 1
+                logging.error("Error procesando la actualización %s: %s", update.update_id, e)
+            finally:
+                self.processed += 1
+                UPDATE_LATENCY.observe(time.monotonic() - received_at)
+                self._queue.task_done()
+
+    async def join(self):
+        """Espera a que se hayan procesado todas las actualizaciones recibidas"""
+        await self._queue.join()
+
+    async def stop(self, timeout=10):
+        """Deja de aceptar peticiones, espera hasta ``timeout`` s a que se vacíe la cola y para los workers.
+
+        Lo que ya está en la cola se respondió con 200 y Telegram no lo vuelve a
+        enviar, por eso se procesa antes de parar. Solo las peticiones que no se
+        llegaron a responder las guarda Telegram hasta el próximo arranque.
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._tasks:
+            try:
+                await asyncio.wait_for(self.join(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning("Se descartan %d actualizaciones del webhook sin procesar", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        return {
+            'queue_depth': self._queue.qsize(),
+            'received': self.received,
+            'processed': self.processed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'invalid': self.invalid,
+        }